@@ -0,0 +1,247 @@
+"""Flask-Admin views that stay usable on big tables.
+
+Flask-Admin's defaults count every row on every list page, lazy-load each
+row's relationships, let any column be filtered or sorted (most of which are
+full scans) and fill relationship dropdowns with the whole related table.
+IndexedModelView instead:
+
+- caps the page size and how deep the pager goes (OFFSET is a scan too);
+- shows an estimated row count, cached for `count_ttl` seconds, on unfiltered
+  lists and a next/previous pager on filtered ones;
+- joins the many-to-one relationships it lists in the same query;
+- only filters and sorts on columns that lead an index, checked when the view
+  is created;
+- looks up related rows for forms by prefix (strings) or id (integers).
+
+LiveGamesView is a read-only page of what's being played right now, built from
+a handful of aggregate queries and this process's request rates.
+"""
+import threading
+import time
+
+from flask_admin import BaseView, expose
+from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla import filters
+from flask_admin.contrib.sqla.ajax import QueryAjaxModelLoader
+from sqlalchemy import Integer, UniqueConstraint, func, select, text
+
+from metrics import RATE_WINDOW, metrics
+
+# endpoints that waiting pages hit over and over
+POLL_ENDPOINTS = ('events', 'lobby', 'votingwait', 'votingwait_votes', 'waitround')
+
+_counts = {}   # table name -> (expires, estimate)
+_counts_lock = threading.Lock()
+
+
+def estimate_rows(session, table):
+    """Roughly how many rows `table` has, without counting them."""
+    bind = session.get_bind()
+    if bind.dialect.name == 'postgresql':
+        n = session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:name AS regclass)"),
+            {'name': table.name}
+        ).scalar()
+        if n and n > 0:
+            return n
+    # both ends of the primary key index; off by however many rows were deleted
+    pk = table.primary_key.columns.values()[0]
+    low, high = session.execute(select(func.min(pk), func.max(pk))).one()
+    return 0 if high is None else high - low + 1
+
+
+def indexed_columns(table):
+    # columns a lookup can start an index with
+    columns = {c.name for c in table.primary_key.columns}
+    for index in table.indexes:
+        columns.add(index.columns.values()[0].name)
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            columns.add(constraint.columns.values()[0].name)
+    return columns
+
+
+def indexed_filters(model, *names):
+    """Equality and in-list filters (plus ranges on integers) for `names`,
+    which all have to lead an index on the model's table."""
+    missing = set(names) - indexed_columns(model.__table__)
+    if missing:
+        raise ValueError(f"{model.__name__} has no index starting with {', '.join(sorted(missing))}")
+    result = []
+    for name in names:
+        column = getattr(model, name)
+        if isinstance(column.type, Integer):
+            result += [filters.IntEqualFilter(column, name), filters.IntInListFilter(column, name),
+                       filters.IntGreaterFilter(column, name), filters.IntSmallerFilter(column, name)]
+        else:
+            result += [filters.FilterEqual(column, name), filters.FilterInList(column, name)]
+    return result
+
+
+class IndexedAjaxLoader(QueryAjaxModelLoader):
+    # prefix ranges instead of ILIKE '%term%', so the lookup can use an index
+    def get_list(self, term, offset=0, limit=10):
+        field = self._cached_fields[0]
+        query = self.get_query()
+        if isinstance(field.type, Integer):
+            if not term.isdigit():
+                return []
+            query = query.filter(field == int(term))
+        else:
+            query = query.filter(field >= term, field < term + '\uffff')
+        return query.order_by(field).offset(offset).limit(limit).all()
+
+
+class IndexedModelView(ModelView):
+    page_size = 50
+    can_set_page_size = True
+    page_size_options = (20, 50, 100)
+    max_page = 200
+    count_ttl = 60
+    # counts happen in get_list, only when they're cheap
+    simple_list_pager = True
+    column_display_pk = True
+    column_default_sort = ('id', True)
+    column_sortable_list = ('id',)
+    # columns to filter on, each has to lead an index
+    indexed_filter_columns = ()
+    # relationship name -> field looked up by IndexedAjaxLoader
+    ajax_lookups = {}
+
+    def __init__(self, model, session, **kwargs):
+        self.column_filters = indexed_filters(model, *self.indexed_filter_columns)
+        self.form_ajax_refs = {
+            name: IndexedAjaxLoader(name, session, getattr(model, name).property.mapper.class_,
+                                    fields=[field], page_size=10)
+            for name, field in self.ajax_lookups.items()
+        }
+        super().__init__(model, session, **kwargs)
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        page = min(page or 0, self.max_page)
+        _, rows = super().get_list(page, sort_column, sort_desc, search, filters, execute, page_size)
+        count = None if search or filters else self.estimated_count()
+        return count, rows
+
+    def estimated_count(self):
+        table = self.model.__table__
+        now = time.monotonic()
+        with _counts_lock:
+            cached = _counts.get(table.name)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        count = estimate_rows(self.session, table)
+        with _counts_lock:
+            _counts[table.name] = (now + self.count_ttl, count)
+        return count
+
+
+class UserView(IndexedModelView):
+    column_list = ('id', 'username', 'display_name')
+    column_sortable_list = ('id', 'username')
+    indexed_filter_columns = ('username',)
+
+
+class IngredientsView(IndexedModelView):
+    column_list = ('id', 'name', 'category')
+    column_sortable_list = ('id', 'name')
+    indexed_filter_columns = ('name',)
+
+
+def _username(view, context, model, name):
+    user = getattr(model, name)
+    return user.username if user is not None else None
+
+
+class PlayerGameView(IndexedModelView):
+    column_list = ('id', 'game_id', 'user', 'score')
+    column_formatters = {'user': _username}
+    indexed_filter_columns = ('game_id', 'user_id')
+    ajax_lookups = {'user': 'username'}
+
+
+class GameRoundView(IndexedModelView):
+    column_list = ('id', 'game_id', 'phase', 'ingredients')
+    indexed_filter_columns = ('game_id',)
+    # a round's answers are edited from the Responses view
+    form_excluded_columns = ('responses',)
+
+
+class ResponsesView(IndexedModelView):
+    column_list = ('id', 'round_id', 'user', 'text', 'text_norm', 'votes')
+    column_formatters = {'user': _username}
+    indexed_filter_columns = ('round_id', 'user_id')
+    ajax_lookups = {'user': 'username', 'round': 'id'}
+
+
+class LiveGamesView(BaseView):
+    """Active games by phase, the most recently active ones and how often
+    waiting pages are polling. Read only."""
+
+    recent_limit = 50
+
+    def __init__(self, db, Game, GameRound, PlayerGame, **kwargs):
+        self.db = db
+        self.Game = Game
+        self.GameRound = GameRound
+        self.PlayerGame = PlayerGame
+        super().__init__(**kwargs)
+
+    @expose('/')
+    def index(self):
+        session = self.db.session
+        Game, GameRound, PlayerGame = self.Game, self.GameRound, self.PlayerGame
+        active = Game.active.is_(True)
+
+        games, players = session.execute(
+            select(func.count(func.distinct(Game.id)), func.count(PlayerGame.id))
+            .select_from(Game).outerjoin(PlayerGame, PlayerGame.game_id == Game.id)
+            .where(active)
+        ).one()
+
+        # each active game's newest round, straight off ix_game_round_game_id
+        latest = (
+            select(func.max(GameRound.id).label('round_id'))
+            .join(Game, Game.id == GameRound.game_id)
+            .where(active)
+            .group_by(GameRound.game_id)
+            .subquery()
+        )
+        phases = dict(session.execute(
+            select(GameRound.phase, func.count())
+            .join(latest, GameRound.id == latest.c.round_id)
+            .group_by(GameRound.phase)
+        ).all())
+        in_rounds = sum(phases.values())
+        if games > in_rounds:
+            phases['lobby'] = games - in_rounds
+
+        recent = (
+            select(Game.id, Game.code, Game.round_num, Game.last_activity)
+            .where(active)
+            .order_by(Game.last_activity.desc())
+            .limit(self.recent_limit)
+            .subquery()
+        )
+        rows = session.execute(
+            select(
+                recent,
+                select(func.count()).where(PlayerGame.game_id == recent.c.id)
+                .scalar_subquery().label('players'),
+                select(GameRound.phase).where(GameRound.game_id == recent.c.id)
+                .order_by(GameRound.id.desc()).limit(1)
+                .scalar_subquery().label('phase'),
+            ).order_by(recent.c.last_activity.desc())
+        ).all()
+
+        rates = metrics.rates()
+        polls = {endpoint: rates.get(endpoint, 0.0) for endpoint in POLL_ENDPOINTS}
+        poll_rate = sum(polls.values())
+        return self.render(
+            'admin/livegames.html',
+            games=games, players=players, phases=sorted(phases.items()),
+            recent=rows, now=time.time(), polls=polls, poll_rate=poll_rate,
+            polls_per_game=poll_rate / games if games else 0.0,
+            request_rate=sum(rates.values()), rate_window=RATE_WINDOW,
+        )
@@ -0,0 +1,174 @@
+"""Admission control and poll pacing.
+
+Every request is counted in flight, per class, from the first before_request
+hook until teardown:
+
+write
+    POSTs, which change game state; always admitted.
+page
+    other GETs. Once ADMISSION_CAPACITY requests are in flight they wait up
+    to ADMISSION_DEFER seconds for one to finish, then get a 503.
+poll
+    a waiting page (marked @admission.poll) being reloaded, i.e. sent with
+    If-None-Match. Turned away with a 503 as soon as half the capacity is in
+    use, so polls give way long before anything else does.
+
+A 503 carries Retry-After, and for HTML a page that reloads itself after that
+long. Open /events streams are capped separately (ADMISSION_MAX_STREAMS)
+since each one holds a thread for minutes.
+
+How long waiting pages should wait between polls follows the load: from
+POLL_INTERVAL_MS when idle up to POLL_INTERVAL_MAX_MS at capacity or just
+after shedding. Templates read it through poll_interval_ms(), /events sends
+it as the stream's `retry:` field and every response carries it in
+X-Poll-Interval. The counts are per process; ADMISSION_CAPACITY=0 turns
+shedding off but keeps the pacing.
+"""
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, current_app, g, has_request_context, render_template_string, request
+
+CLASSES = ('write', 'page', 'poll')
+
+RETRY_PAGE = """<!DOCTYPE html>
+<html><head><meta http-equiv="refresh" content="{{ seconds }}"><title>Busy</title></head>
+<body><p>The server is busy, trying again in {{ seconds }} seconds...</p></body></html>
+"""
+
+
+class Admission:
+    def __init__(self, capacity=32, defer=0.25, max_streams=500, poll_ms=1000, poll_max_ms=10000):
+        self.capacity = capacity
+        self.defer = defer
+        self.max_streams = max_streams
+        self.poll_ms = poll_ms
+        self.poll_max_ms = poll_max_ms
+        self.inflight = dict.fromkeys(CLASSES, 0)
+        self.streams = 0
+        self.shed = defaultdict(int)   # class -> requests turned away
+        self._last_shed = float('-inf')
+        self._cond = threading.Condition()
+
+    def init_app(self, app):
+        self.capacity = app.config.get('ADMISSION_CAPACITY', self.capacity)
+        self.defer = app.config.get('ADMISSION_DEFER', self.defer)
+        self.max_streams = app.config.get('ADMISSION_MAX_STREAMS', self.max_streams)
+        self.poll_ms = app.config.get('POLL_INTERVAL_MS', self.poll_ms)
+        self.poll_max_ms = app.config.get('POLL_INTERVAL_MAX_MS', self.poll_max_ms)
+        # registered before everything else so a shed request costs nothing
+        app.before_request_funcs.setdefault(None, []).insert(0, self._admit)
+        app.after_request(self._advise)
+        app.teardown_request(self._release)
+        app.jinja_env.globals['poll_interval_ms'] = self.poll_interval_ms
+
+    @staticmethod
+    def poll(view):
+        """Marks a waiting page whose reloads may be shed."""
+        view.admission_poll = True
+        return view
+
+    # request hooks
+
+    def _classify(self):
+        if request.method not in ('GET', 'HEAD'):
+            return 'write'
+        view = current_app.view_functions.get(request.endpoint)
+        if getattr(view, 'admission_poll', False) and request.if_none_match:
+            return 'poll'
+        return 'page'
+
+    def _admit(self):
+        cls = self._classify()
+        with self._cond:
+            if self.capacity and not self._has_room(cls):
+                if cls == 'page' and self.defer:
+                    deadline = time.monotonic() + self.defer
+                    while not self._has_room(cls):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                if not self._has_room(cls):
+                    self.shed[cls] += 1
+                    self._last_shed = time.monotonic()
+                    return self.busy()
+            self.inflight[cls] += 1
+        g.admission_class = cls
+
+    def _has_room(self, cls):
+        total = sum(self.inflight.values())
+        if cls == 'write':
+            return True
+        if cls == 'poll':
+            return total < self.capacity // 2
+        return total < self.capacity
+
+    def _advise(self, response):
+        response.headers['X-Poll-Interval'] = str(self.poll_interval_ms())
+        return response
+
+    def _release(self, exc):
+        cls = g.pop('admission_class', None)
+        if cls is not None:
+            with self._cond:
+                self.inflight[cls] -= 1
+                self._cond.notify()
+
+    # responses
+
+    def busy(self):
+        """503 with Retry-After set from the current load, jittered so the
+        clients that were turned away together don't all come back together."""
+        seconds = math.ceil(self.poll_interval_ms() / 1000 * random.uniform(1, 1.5))
+        if request.accept_mimetypes.accept_html and not request.path.startswith('/events/'):
+            body = render_template_string(RETRY_PAGE, seconds=seconds)
+            resp = Response(body, status=503, mimetype='text/html')
+        else:
+            resp = Response('', status=503)
+        resp.headers['Retry-After'] = str(seconds)
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+
+    def poll_interval_ms(self, at_least=0):
+        pressure = 0.0
+        if self.capacity:
+            # not counting the request asking
+            others = sum(self.inflight.values())
+            if has_request_context() and 'admission_class' in g:
+                others -= 1
+            pressure = min(1.0, others / self.capacity)
+        # shedding pins it at the max, easing off over the next max interval
+        since_shed = (time.monotonic() - self._last_shed) * 1000
+        pressure = max(pressure, 1.0 - since_shed / self.poll_max_ms)
+        interval = self.poll_ms * (self.poll_max_ms / self.poll_ms) ** pressure
+        return max(int(interval), at_least)
+
+    # event streams
+
+    def open_stream(self):
+        with self._cond:
+            if self.max_streams and self.streams >= self.max_streams:
+                self.shed['stream'] += 1
+                self._last_shed = time.monotonic()
+                return False
+            self.streams += 1
+            return True
+
+    def streaming(self, events):
+        # holds the slot open_stream() took until the client goes away
+        try:
+            yield from events
+        finally:
+            with self._cond:
+                self.streams -= 1
+
+    def stats(self):
+        with self._cond:
+            return dict(self.inflight), self.streams, dict(self.shed)
+
+
+admission = Admission()
@@ -0,0 +1,264 @@
+"""Cold storage for finished games.
+
+Finished games are moved out of game/player_game/game_round/responses/vote by
+the reaper once they're past FINISHED_GAME_TTL. Each game becomes one compact
+JSON line (players, rounds, answers, votes) and lines are appended to
+ARCHIVE_DIR/games-NNNNNN.jsonl.gz in gzip members of up to
+ARCHIVE_BLOCK_GAMES games. A segment is a plain concatenation of members, so
+zcat reads it whole, and a new one starts once it passes ARCHIVE_SEGMENT_BYTES.
+
+archived_game maps a game id to its segment and the offset and length of its
+member, so reading one game back is a seek and one small decompression. The
+index rows go in with the deletes, in the reaper's transaction, after the
+bytes are on disk; a crash in between leaves an unreferenced member and the
+game is archived again on the next pass. Game ids are AUTOINCREMENT so an
+archived id is never handed out again.
+
+    python archive.py run [--older-than SECONDS]    # archive finished games now
+    python archive.py show GAME_ID                  # print a game's replay
+"""
+import fcntl
+import glob
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import insert, select
+
+log = logging.getLogger(__name__)
+
+
+class GameArchive:
+    def __init__(self, enabled=True, block_games=32, segment_bytes=64 << 20):
+        self.enabled = enabled
+        self.block_games = block_games
+        self.segment_bytes = segment_bytes
+        self.directory = None
+
+    def init_app(self, app, db, **models):
+        self.db = db
+        self.m = SimpleNamespace(**models)
+        self.enabled = app.config.get('ARCHIVE_FINISHED_GAMES', self.enabled)
+        self.block_games = app.config.get('ARCHIVE_BLOCK_GAMES', self.block_games)
+        self.segment_bytes = app.config.get('ARCHIVE_SEGMENT_BYTES', self.segment_bytes)
+        self.directory = app.config.get('ARCHIVE_DIR') or os.path.join(app.instance_path, 'archive')
+
+    # writing
+
+    def store(self, game_ids):
+        """Appends these games to the archive and stages their index rows in
+        the session; the caller deletes them and commits."""
+        records = self.records(game_ids)
+        if not records:
+            return 0
+        entries = self._append(records)
+        self.db.session.execute(insert(self.m.ArchivedGame), entries)
+        return len(entries)
+
+    def records(self, game_ids):
+        # five queries for the whole batch
+        m = self.m
+        session = self.db.session
+        game_ids = list(game_ids)
+        games = {}
+        for row in session.execute(
+            select(m.Game.id, m.Game.host_id, m.Game.round_num, m.Game.last_activity)
+            .where(m.Game.id.in_(game_ids), m.Game.active.is_(False))
+            .order_by(m.Game.id)
+        ):
+            games[row.id] = {'id': row.id, 'host_id': row.host_id, 'round_num': row.round_num,
+                             'finished_at': row.last_activity, 'players': [], 'rounds': []}
+        if not games:
+            return []
+
+        for game_id, user_id, display_name, score in session.execute(
+            select(m.PlayerGame.game_id, m.PlayerGame.user_id, m.User.display_name, m.PlayerGame.score)
+            .outerjoin(m.User, m.User.id == m.PlayerGame.user_id)
+            .where(m.PlayerGame.game_id.in_(games))
+            .order_by(m.PlayerGame.id)
+        ):
+            games[game_id]['players'].append([user_id, display_name, score or 0])
+
+        rounds = {}
+        for round_id, game_id, ingredients, phase in session.execute(
+            select(m.GameRound.id, m.GameRound.game_id, m.GameRound.ingredients, m.GameRound.phase)
+            .where(m.GameRound.game_id.in_(games))
+            .order_by(m.GameRound.id)
+        ):
+            rounds[round_id] = {'id': round_id, 'ingredients': ingredients, 'phase': phase,
+                                'answers': [], 'votes': []}
+            games[game_id]['rounds'].append(rounds[round_id])
+
+        if rounds:
+            round_ids = select(m.GameRound.id).where(m.GameRound.game_id.in_(games))
+            for response_id, round_id, user_id, text, votes in session.execute(
+                select(m.Responses.id, m.Responses.round_id, m.Responses.user_id, m.Responses.text,
+                       m.Responses.votes)
+                .where(m.Responses.round_id.in_(round_ids))
+                .order_by(m.Responses.id)
+            ):
+                rounds[round_id]['answers'].append([response_id, user_id, text, votes or 0])
+            for round_id, voter_id, response_id in session.execute(
+                select(m.Vote.round_id, m.Vote.voter_id, m.Vote.response_id)
+                .where(m.Vote.round_id.in_(round_ids))
+                .order_by(m.Vote.id)
+            ):
+                rounds[round_id]['votes'].append([voter_id, response_id])
+        return list(games.values())
+
+    def _append(self, records):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        # one writer at a time across worker processes
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            segment = self._current_segment()
+            with open(self._path(segment), 'ab') as f:
+                for i in range(0, len(records), self.block_games):
+                    block = records[i:i + self.block_games]
+                    data = gzip.compress(
+                        ''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in block).encode('utf-8'),
+                        mtime=0,
+                    )
+                    start = f.tell()
+                    f.write(data)
+                    entries += [{'game_id': r['id'], 'segment': segment, 'start': start,
+                                 'length': len(data), 'finished_at': r['finished_at']} for r in block]
+                f.flush()
+                os.fsync(f.fileno())
+        return entries
+
+    def _current_segment(self):
+        segments = sorted(glob.glob(os.path.join(self.directory, 'games-*.jsonl.gz')))
+        if not segments:
+            return 1
+        last = int(os.path.basename(segments[-1])[6:12])
+        if os.path.getsize(segments[-1]) >= self.segment_bytes:
+            return last + 1
+        return last
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"games-{segment:06d}.jsonl.gz")
+
+    # reading
+
+    def load(self, game_id):
+        """A finished game's record, from the archive or, if it hasn't been
+        archived yet, the live tables. None if there's no such finished game."""
+        entry = self.db.session.get(self.m.ArchivedGame, game_id)
+        if entry is None:
+            records = self.records([game_id])
+            return records[0] if records else None
+        with open(self._path(entry.segment), 'rb') as f:
+            f.seek(entry.start)
+            data = f.read(entry.length)
+        prefix = f'{{"id":{game_id},'.encode()
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as block:
+            for line in block:
+                if line.startswith(prefix):
+                    return json.loads(line)
+        log.error("game %d is indexed in segment %d at %d but isn't there", game_id, entry.segment, entry.start)
+        return None
+
+    def scan(self):
+        """Every archived game's record, in archive order. Only the games
+        archived_game points at, so a member left behind by a crash (see
+        above) isn't read twice."""
+        m = self.m
+        entries = self.db.session.execute(
+            select(m.ArchivedGame.segment, m.ArchivedGame.start, m.ArchivedGame.length, m.ArchivedGame.game_id)
+            .order_by(m.ArchivedGame.segment, m.ArchivedGame.start)
+            .execution_options(yield_per=5000)
+        )
+        f = segment = None
+        try:
+            for (seg, start, length), rows in itertools.groupby(entries, key=lambda e: e[:3]):
+                ids = {row.game_id for row in rows}
+                if seg != segment:
+                    if f is not None:
+                        f.close()
+                    f, segment = open(self._path(seg), 'rb'), seg
+                f.seek(start)
+                with gzip.GzipFile(fileobj=io.BytesIO(f.read(length))) as block:
+                    for line in block:
+                        record = json.loads(line)
+                        if record['id'] in ids:
+                            yield record
+        finally:
+            if f is not None:
+                f.close()
+
+    def replay(self, game_id):
+        """The game as a sequence of events, oldest first: who played, then
+        each round's answers, votes and standings, then the final scores."""
+        record = self.load(game_id)
+        if record is None:
+            return
+        names = {uid: name for uid, name, _ in record['players']}
+        yield {'event': 'game', 'game_id': record['id'], 'host_id': record['host_id'],
+               'finished_at': record['finished_at'],
+               'players': [{'user_id': uid, 'display_name': name} for uid, name, _ in record['players']]}
+        scores = dict.fromkeys(names, 0)
+        owners = {}
+        for number, rnd in enumerate(record['rounds'], 1):
+            yield {'event': 'round', 'round': number, 'round_id': rnd['id'], 'ingredients': rnd['ingredients']}
+            for response_id, user_id, text, _ in rnd['answers']:
+                owners[response_id] = user_id
+                yield {'event': 'answer', 'round_id': rnd['id'], 'response_id': response_id,
+                       'user_id': user_id, 'display_name': names.get(user_id), 'text': text}
+            for voter_id, response_id in rnd['votes']:
+                owner = owners.get(response_id)
+                if owner is not None:
+                    scores[owner] = scores.get(owner, 0) + 1
+                yield {'event': 'vote', 'round_id': rnd['id'], 'voter_id': voter_id, 'response_id': response_id}
+            yield {'event': 'results', 'round_id': rnd['id'], 'scores': dict(scores)}
+        yield {'event': 'finished',
+               'scores': [{'user_id': uid, 'display_name': name, 'score': score}
+                          for uid, name, score in sorted(record['players'], key=lambda p: -p[2])]}
+
+
+archive = GameArchive()
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    from hello import app, db, reaper
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('run', help='archive finished games now')
+    p.add_argument('--older-than', type=int, default=0, help='only games finished this many seconds ago')
+    p = sub.add_parser('show', help="print a game's replay as JSON lines")
+    p.add_argument('game_id', type=int)
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.command == 'run':
+            total = 0
+            while True:
+                m = archive.m
+                ids = db.session.execute(
+                    select(m.Game.id)
+                    .where(m.Game.active.is_(False), m.Game.last_activity < time.time() - args.older_than)
+                    .limit(reaper.batch_size)
+                ).scalars().all()
+                if not ids:
+                    break
+                archive.store(ids)
+                reaper.delete_games(ids)
+                total += len(ids)
+            print(f"archived {total} games", file=sys.stderr)
+        else:
+            found = False
+            for event in archive.replay(args.game_id):
+                found = True
+                print(json.dumps(event))
+            if not found:
+                sys.exit(f"no finished game {args.game_id}")
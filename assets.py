@@ -0,0 +1,260 @@
+"""Static asset pipeline.
+
+    python assets.py build
+
+writes fingerprinted copies of everything the templates use to static/dist/:
+one minified CSS bundle per page (BUNDLES), each with .gz and .br
+precompressed copies, and for every image resized WebP/AVIF variants plus a
+resized fallback in the original format. static/dist/manifest.json maps the
+source names to the built files.
+
+Templates call stylesheets('<bundle>') and picture('<image>', ...). With a
+manifest they point at /assets/..., which is served with a one year immutable
+Cache-Control (the name changes whenever the content does) and the
+precompressed copy the browser accepts. Without one (a fresh checkout) they
+fall back to the plain files under /static, so nothing needs building in
+development.
+
+Pillow is needed for the image variants and brotli for the .br copies; the
+build skips those steps with a warning when they aren't installed.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+from io import BytesIO
+
+from flask import request, send_from_directory, url_for
+from markupsafe import Markup, escape
+
+# bundle name -> the CSS files a page loads, in cascade order
+BUNDLES = {
+    'base': ['base.css'],
+    'login': ['base.css', 'login.css'],
+    'signup': ['base.css', 'signup.css'],
+    'dashboard': ['base.css', 'dashboard.css'],
+    'lobby': ['base.css', 'lobby.css'],
+    'game': ['base.css', 'game.css'],
+    'voting': ['base.css', 'voting.css'],
+    'votingwait': ['base.css', 'votingwait.css'],
+    'votingwaitvotes': ['base.css', 'votingwaitvotes.css'],
+    'roundresults': ['base.css', 'roundresults.css'],
+    'waitround': ['waitround.css'],
+    'winner': ['winner.css'],
+}
+
+IMAGES = ['pantrypaniclogo.png', 'leda-chung-cafe-screen.jpg']
+IMAGE_WIDTHS = (400, 800, 1200, 1920)
+# the <img> fallback for browsers without AVIF/WebP
+FALLBACK_WIDTH = 800
+IMAGE_FORMATS = (('avif', 'AVIF', {'quality': 50}), ('webp', 'WEBP', {'quality': 80}))
+
+ONE_YEAR = 365 * 24 * 3600
+
+
+class Assets:
+    def __init__(self):
+        self.manifest = {'css': {}, 'images': {}}
+
+    def init_app(self, app):
+        self.static_dir = app.static_folder
+        self.dist_dir = os.path.join(app.static_folder, 'dist')
+        path = os.path.join(self.dist_dir, 'manifest.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                self.manifest = json.load(f)
+        else:
+            app.logger.info("no %s, serving unbuilt assets from /static", path)
+
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+        app.jinja_env.globals.update(stylesheets=self.stylesheets, picture=self.picture)
+
+    # template helpers
+
+    def stylesheets(self, bundle):
+        built = self.manifest['css'].get(bundle)
+        if built:
+            hrefs = [url_for('assets', filename=built)]
+        else:
+            hrefs = [url_for('static', filename=name) for name in BUNDLES[bundle]]
+        return Markup('\n'.join(f'<link rel="stylesheet" href="{href}">' for href in hrefs))
+
+    def picture(self, name, alt='', sizes='100vw', **attrs):
+        img_attrs = ''.join(f' {k.rstrip("_")}="{escape(v)}"' for k, v in attrs.items())
+        built = self.manifest['images'].get(name)
+        if not built:
+            src = url_for('static', filename=name)
+            return Markup(f'<img src="{src}" alt="{escape(alt)}"{img_attrs}>')
+
+        sources = []
+        for fmt, variants in built['variants'].items():
+            srcset = ', '.join(f"{url_for('assets', filename=path)} {width}w" for width, path in variants)
+            sources.append(f'<source type="image/{fmt}" srcset="{srcset}" sizes="{escape(sizes)}">')
+        src = url_for('assets', filename=built['fallback'])
+        if built['width']:
+            img_attrs = f' width="{built["width"]}" height="{built["height"]}"' + img_attrs
+        return Markup(
+            '<picture>' + ''.join(sources)
+            + f'<img src="{src}" alt="{escape(alt)}"{img_attrs}>'
+            + '</picture>'
+        )
+
+    # serving
+
+    def serve(self, filename):
+        accepted = request.headers.get('Accept-Encoding', '')
+        encoding = None
+        for enc, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if enc in accepted and os.path.exists(os.path.join(self.dist_dir, filename + suffix)):
+                encoding = enc
+                break
+
+        if encoding:
+            resp = send_from_directory(self.dist_dir, filename + ('.br' if encoding == 'br' else '.gz'),
+                                       mimetype=mimetypes.guess_type(filename)[0], max_age=ONE_YEAR)
+            resp.headers['Content-Encoding'] = encoding
+        else:
+            resp = send_from_directory(self.dist_dir, filename, max_age=ONE_YEAR)
+        resp.headers['Cache-Control'] = f'public, max-age={ONE_YEAR}, immutable'
+        resp.vary.add('Accept-Encoding')
+        return resp
+
+
+assets = Assets()
+
+
+# build
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    # only after the colon: "a :hover" and "a:hover" are different selectors
+    css = re.sub(r':\s+', ':', css)
+    css = css.replace(';}', '}')
+    return css.strip()
+
+
+def _fingerprint(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+
+
+def _write(dist, name, data):
+    with open(os.path.join(dist, name), 'wb') as f:
+        f.write(data)
+
+
+def _precompress(dist, name, data, brotli):
+    _write(dist, name + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli:
+        _write(dist, name + '.br', brotli.compress(data, quality=11))
+
+
+def build_css(static_dir, dist, brotli):
+    built = {}
+    for bundle, files in BUNDLES.items():
+        parts = []
+        for name in files:
+            with open(os.path.join(static_dir, name), encoding='utf-8') as f:
+                parts.append(minify_css(f.read()))
+        data = '\n'.join(parts).encode('utf-8')
+        name = _fingerprint(bundle + '.css', data)
+        _write(dist, name, data)
+        _precompress(dist, name, data, brotli)
+        built[bundle] = name
+    return built
+
+
+def build_images(static_dir, dist, Image):
+    built = {}
+    for name in IMAGES:
+        with Image.open(os.path.join(static_dir, name)) as im:
+            im.load()
+        stem, ext = os.path.splitext(name)
+        widths = [w for w in IMAGE_WIDTHS if w < im.width] + [min(im.width, IMAGE_WIDTHS[-1])]
+        variants = {}
+        for fmt, pil_format, options in IMAGE_FORMATS:
+            variants[fmt] = []
+            for width in widths:
+                resized = im.resize((width, round(im.height * width / im.width)), Image.LANCZOS)
+                out = _encode(resized, pil_format, options)
+                if out is None:
+                    print(f"  {pil_format} not supported by this Pillow, skipping")
+                    del variants[fmt]
+                    break
+                path = _fingerprint(f"{stem}-{width}.{fmt}", out)
+                _write(dist, path, out)
+                variants[fmt].append((width, path))
+
+        width = min(widths[-1], FALLBACK_WIDTH)
+        fallback = im.resize((width, round(im.height * width / im.width)), Image.LANCZOS)
+        pil_format = 'JPEG' if ext.lower() in ('.jpg', '.jpeg') else im.format or 'PNG'
+        out = _encode(fallback, pil_format, {'optimize': True, 'quality': 85} if pil_format == 'JPEG' else {'optimize': True})
+        path = _fingerprint(f"{stem}-{width}{ext}", out)
+        _write(dist, path, out)
+        built[name] = {'width': fallback.width, 'height': fallback.height,
+                       'fallback': path, 'variants': variants}
+    return built
+
+
+def _encode(im, pil_format, options):
+    buf = BytesIO()
+    try:
+        im.save(buf, pil_format, **options)
+    except (KeyError, OSError):
+        return None
+    return buf.getvalue()
+
+
+def _copy_images(static_dir, dist):
+    # no Pillow: fingerprint the originals so they still get cached
+    built = {}
+    for name in IMAGES:
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            data = f.read()
+        path = _fingerprint(name, data)
+        shutil.copyfile(os.path.join(static_dir, name), os.path.join(dist, path))
+        built[name] = {'width': None, 'height': None, 'fallback': path, 'variants': {}}
+    return built
+
+
+def build(static_dir):
+    dist = os.path.join(static_dir, 'dist')
+    shutil.rmtree(dist, ignore_errors=True)
+    os.makedirs(dist)
+
+    try:
+        import brotli
+    except ImportError:
+        print("brotli not installed, skipping .br copies")
+        brotli = None
+    try:
+        from PIL import Image
+    except ImportError:
+        print("Pillow not installed, copying images without resizing")
+        Image = None
+
+    manifest = {'css': build_css(static_dir, dist, brotli)}
+    manifest['images'] = build_images(static_dir, dist, Image) if Image else _copy_images(static_dir, dist)
+    with open(os.path.join(dist, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return dist
+
+
+if __name__ == '__main__':
+    import sys
+
+    if sys.argv[1:] != ['build']:
+        sys.exit("usage: python assets.py build")
+    static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    dist = build(static_dir)
+    total = 0
+    for name in sorted(os.listdir(dist)):
+        size = os.path.getsize(os.path.join(dist, name))
+        total += size
+        print(f"{size:>10}  {name}")
+    print(f"{total:>10}  total")
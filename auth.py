@@ -0,0 +1,167 @@
+"""Password hashing off the request threads.
+
+Hashes are computed on a small bounded pool so a burst of logins can only use
+`workers` cores, leaving the rest for the game routes. The hash method (and so
+its cost) comes from config; a stored hash made with other parameters is
+re-hashed in the same pool task the first time its password is verified.
+
+Flask-Login's user loader is served from a small LRU/TTL cache of lightweight
+user records so polling clients don't cost a user lookup per request.
+"""
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_login import UserMixin
+from sqlalchemy import event, select
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, method='scrypt:32768:8:1', workers=2, max_queue=64, timeout=10):
+        self.method = method
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._pool = None
+        self._slots = None
+        self._prefix = None
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._count = 0
+        self._seconds = 0.0
+        self._slowest = 0.0
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', self.method)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.max_queue = app.config.get('PASSWORD_HASH_QUEUE', self.max_queue)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pwhash')
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_queue)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, stored, password):
+        """Returns (ok, upgraded_hash); upgraded_hash is None unless the stored
+        hash was made with different parameters and needs replacing."""
+        return self._run(self._verify, stored, password)
+
+    def needs_rehash(self, stored):
+        return stored.split('$', 1)[0] != self.prefix()
+
+    def prefix(self):
+        # "scrypt" and "scrypt:32768:8:1" are the same method, so compare
+        # against what werkzeug actually writes for the configured one
+        if self._prefix is None:
+            self._prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return self._prefix
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hashes': self._count,
+                'hash_seconds_total': round(self._seconds, 6),
+                'hash_seconds_max': round(self._slowest, 6),
+                'queue_depth': self._waiting,
+                'workers': self.workers,
+            }
+
+    def _verify(self, stored, password):
+        if not check_password_hash(stored, password):
+            return False, None
+        if self.needs_rehash(stored):
+            return True, generate_password_hash(password, self.method)
+        return True, None
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HasherBusy()
+        with self._lock:
+            self._waiting += 1
+        try:
+            return self._pool.submit(self._timed, fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def _timed(self, fn, *args):
+        with self._lock:
+            self._waiting -= 1
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._count += 1
+                self._seconds += elapsed
+                self._slowest = max(self._slowest, elapsed)
+
+
+class CachedUser(UserMixin):
+    __slots__ = ('id', 'username', 'display_name')
+
+    def __init__(self, id, username, display_name):
+        self.id = id
+        self.username = username
+        self.display_name = display_name
+
+
+class UserCache:
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._users = OrderedDict()   # user id -> (loaded_at, CachedUser)
+        self._lock = threading.Lock()
+
+    def init_app(self, app, db, User):
+        self.size = app.config.get('USER_CACHE_SIZE', self.size)
+        self.ttl = app.config.get('USER_CACHE_TTL', self.ttl)
+        self.db = db
+        self.User = User
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(User, name, self._changed)
+
+    def _changed(self, mapper, connection, target):
+        self.invalidate(target.id)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            hit = self._users.get(user_id)
+            if hit is not None and now - hit[0] < self.ttl:
+                self._users.move_to_end(user_id)
+                return hit[1]
+
+        User = self.User
+        row = self.db.session.execute(
+            select(User.id, User.username, User.display_name).where(User.id == user_id)
+        ).first()
+        if row is None:
+            self.invalidate(user_id)
+            return None
+
+        user = CachedUser(*row)
+        with self._lock:
+            self._users[user_id] = (now, user)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+        return user
+
+
+hasher = PasswordHasher()
+user_cache = UserCache()
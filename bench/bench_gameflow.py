@@ -0,0 +1,298 @@
+"""End-to-end game flow benchmark.
+
+Plays N concurrent 4-player games against a throwaway SQLite database through
+Flask's test client (no network): signup/login -> creategame -> joingame ->
+startgame -> submitanswer -> votingwait polling -> addvote ->
+votingwait_votes polling -> continue_round -> winner. Polls send
+If-None-Match like a browser reload would.
+
+    python bench/bench_gameflow.py --games 50
+    python bench/bench_gameflow.py --compare bench/results/a.json bench/results/b.json
+
+Requests run with QUERY_BUDGET_STRICT=1, so a route going over its query
+budget answers 500 and the run fails.
+
+Each run writes a JSON result (throughput, p50/p95/p99 per route, DB queries
+per game, git commit) to bench/results/ so runs can be compared across commits.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, 'bench', 'results')
+
+INGREDIENTS = [
+    "Carrot", "Onions", "Spinach", "Potato", "Beans", "Broccoli", "Eggplant", "Corn",
+    "Yams", "Beef", "Chicken", "Pork", "Ham", "Turkey", "Bacon", "Lamb", "Tuna",
+    "Salmon", "Cheese", "Bread", "Tortilla", "Noodles",
+]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[i]
+
+
+class Recorder:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def call(self, route, fn, *args, **kwargs):
+        start = time.perf_counter()
+        resp = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.timings[route].append(elapsed)
+            self.statuses[route][resp.status_code] += 1
+        return resp
+
+    def summary(self):
+        routes = {}
+        for route, values in sorted(self.timings.items()):
+            values = sorted(values)
+            routes[route] = {
+                'count': len(values),
+                'mean_ms': round(sum(values) / len(values) * 1000, 3),
+                'p50_ms': round(percentile(values, 50) * 1000, 3),
+                'p95_ms': round(percentile(values, 95) * 1000, 3),
+                'p99_ms': round(percentile(values, 99) * 1000, 3),
+                'statuses': dict(self.statuses[route]),
+            }
+        return routes
+
+
+class Player:
+    def __init__(self, app, rec, username):
+        self.client = app.test_client()
+        self.rec = rec
+        self.username = username
+        self.etags = {}
+
+    def get(self, route, url):
+        return self.rec.call(route, self.client.get, url)
+
+    def post(self, route, url, data=None):
+        return self.rec.call(route, self.client.post, url, data=data)
+
+    def poll(self, route, url):
+        headers = {'If-None-Match': self.etags[url]} if url in self.etags else {}
+        resp = self.rec.call(route, self.client.get, url, headers=headers)
+        if resp.headers.get('ETag'):
+            self.etags[url] = resp.headers['ETag']
+        return resp
+
+
+def play_game(app, rec, game_no, rounds, polls):
+    players = [Player(app, rec, f"bench{game_no}_{i}") for i in range(4)]
+    for p in players:
+        p.post('signup', '/signup', {'username': p.username, 'password': 'pw', 'display_name': p.username})
+        r = p.post('login', '/login', {'username': p.username, 'password': 'pw'})
+        assert '/dashboard' in r.location, r.location
+
+    host = players[0]
+    r = host.get('creategame', '/creategame')
+    game_id = int(re.search(r'/gamelobby/(\d+)', r.location).group(1))
+    page = host.get('lobby', f'/gamelobby/{game_id}').get_data(as_text=True)
+    code = re.search(r'Lobby: #(\w+)', page).group(1)
+    for p in players[1:]:
+        p.post('joingame', '/joingame', {'game_code': code})
+        p.get('joingame', f'/joingame/{game_id}')
+        p.poll('lobby', f'/gamelobby/{game_id}')
+
+    r = host.get('startgame', f'/startgame/{game_id}')
+    round_id = int(re.search(r'/game/\d+/(\d+)', r.location).group(1))
+
+    for n in range(rounds):
+        for i, p in enumerate(players):
+            p.get('actualgame', f'/game/{game_id}/{round_id}')
+            p.post('submitanswer', f'/submitanswer/{game_id}/{round_id}',
+                   {'answer': f'dish {game_no} {n} {i}'})
+            # everyone who already submitted reloads while they wait
+            for waiting in players[:i + 1]:
+                for _ in range(polls):
+                    waiting.poll('votingwait', f'/votingwait/{game_id}/{round_id}')
+
+        for i, p in enumerate(players):
+            page = p.get('voting', f'/voting/{game_id}/{round_id}').get_data(as_text=True)
+            choice = re.search(r'/addvote/\d+/\d+/(\d+)', page).group(1)
+            p.post('addvote', f'/addvote/{game_id}/{round_id}/{choice}')
+            for waiting in players[:i + 1]:
+                for _ in range(polls):
+                    waiting.poll('votingwait_votes', f'/votingwait_votes/{game_id}/{round_id}')
+
+        r = host.get('endround', f'/endround/{game_id}/{round_id}')
+        if n == rounds - 1:
+            break
+        for p in players:
+            p.poll('roundresults', f'/roundresults/{game_id}/{round_id}')
+        for p in players:
+            r = p.get('continue_round', f'/continue/{game_id}/{round_id}')
+        round_id = int(re.search(r'/game/\d+/(\d+)', r.location).group(1))
+
+    for p in players:
+        p.get('winner', f'/winner/{game_id}')
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix='pantry-bench-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+    os.environ['PASSWORD_HASH_METHOD'] = args.hash_method
+    os.environ.setdefault('REAPER_INTERVAL', '0')
+    os.environ.setdefault('QUERY_BUDGET_STRICT', '1')
+    sys.path.insert(0, ROOT)
+
+    from sqlalchemy import event
+    import hello
+    import migrations
+
+    app = hello.app
+    with app.app_context():
+        hello.db.create_all()
+        migrations.stamp(hello.db.engine)
+        hello.db.session.add_all(hello.Ingredients(name=n) for n in INGREDIENTS)
+        hello.db.session.commit()
+        engine = hello.db.engine
+
+    queries = [0]
+    query_lock = threading.Lock()
+
+    def count_query(*_):
+        with query_lock:
+            queries[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', count_query)
+
+    rec = Recorder()
+    errors = []
+
+    def worker(game_no):
+        try:
+            play_game(app, rec, game_no, args.rounds, args.polls)
+        except Exception as e:
+            errors.append(f"game {game_no}: {e!r}")
+
+    start = time.perf_counter()
+    games = list(range(args.games))
+    for batch_start in range(0, len(games), args.concurrency):
+        threads = [threading.Thread(target=worker, args=(g,))
+                   for g in games[batch_start:batch_start + args.concurrency]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    hello.store.flush()
+    elapsed = time.perf_counter() - start
+
+    routes = rec.summary()
+    for route, r in routes.items():
+        failures = sum(n for status, n in r['statuses'].items() if status >= 500)
+        if failures:
+            errors.append(f"{route}: {failures} requests failed (over the query budget?)")
+    total_requests = sum(r['count'] for r in routes.values())
+    result = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {'games': args.games, 'concurrency': args.concurrency, 'rounds': args.rounds,
+                   'polls': args.polls, 'hash_method': args.hash_method},
+        'elapsed_s': round(elapsed, 3),
+        'games_per_s': round(args.games / elapsed, 3),
+        'requests_per_s': round(total_requests / elapsed, 3),
+        'queries_per_game': round(queries[0] / args.games, 1),
+        'errors': errors,
+        'routes': routes,
+    }
+    return result
+
+
+def report(result):
+    print(f"commit {result['commit']}  {result['elapsed_s']}s  "
+          f"{result['games_per_s']} games/s  {result['requests_per_s']} req/s  "
+          f"{result['queries_per_game']} queries/game")
+    print(f"{'route':<18}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, r in result['routes'].items():
+        print(f"{route:<18}{r['count']:>8}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+    for e in result['errors']:
+        print("ERROR", e)
+
+
+def compare(old_path, new_path, threshold):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def delta(a, b):
+        return (b - a) / a * 100 if a else 0.0
+
+    regressions = 0
+    print(f"{old['commit']} -> {new['commit']}")
+    for key in ('games_per_s', 'requests_per_s'):
+        d = delta(old[key], new[key])
+        flag = '  REGRESSION' if d < -threshold else ''
+        regressions += bool(flag)
+        print(f"{key:<18}{old[key]:>10}{new[key]:>10}{d:>+9.1f}%{flag}")
+    d = delta(old['queries_per_game'], new['queries_per_game'])
+    flag = '  REGRESSION' if d > threshold else ''
+    regressions += bool(flag)
+    print(f"{'queries_per_game':<18}{old['queries_per_game']:>10}{new['queries_per_game']:>10}{d:>+9.1f}%{flag}")
+    for route in sorted(set(old['routes']) | set(new['routes'])):
+        a, b = old['routes'].get(route), new['routes'].get(route)
+        if not a or not b:
+            print(f"{route:<18} only in {'new' if b else 'old'}")
+            continue
+        d = delta(a['p95_ms'], b['p95_ms'])
+        flag = '  REGRESSION' if d > threshold else ''
+        regressions += bool(flag)
+        print(f"{route + ' p95':<18}{a['p95_ms']:>10}{b['p95_ms']:>10}{d:>+9.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=10, help='games played at once')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--polls', type=int, default=2, help='reloads per waiting player per step')
+    parser.add_argument('--hash-method', default='pbkdf2:sha256:1000',
+                        help='cheap by default so hashing does not drown out the game routes')
+    parser.add_argument('--out', help='result file (default bench/results/<time>-<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent change flagged as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+
+    result = run(args)
+    report(result)
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS, exist_ok=True)
+        out = os.path.join(RESULTS, f"{time.strftime('%Y%m%d-%H%M%S')}-{result['commit'] or 'nogit'}.json")
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"saved {out}")
+    sys.exit(1 if result['errors'] else 0)
+
+
+if __name__ == '__main__':
+    main()
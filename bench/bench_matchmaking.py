@@ -0,0 +1,243 @@
+"""Quick match benchmark.
+
+Seeds --players users against a throwaway SQLite database and sends them to
+POST /quickmatch through Flask's test client in bursts: --burst players at
+once, --gap seconds apart. Reports
+
+- joins/s and join latency (the POST itself),
+- fill latency: from a player's POST to the matcher seating them in a game,
+- that nobody was left out, seated twice or put in a game of more than 4,
+
+then has --race-joiners players hit /joingame on each of --race-games open
+games at the same moment and counts games that ended up over 4 players.
+
+    python bench/bench_matchmaking.py --players 2000 --burst 500 --gap 0.25
+
+Results go to bench/results/matchmaking-<time>-<commit>.json.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_gameflow import INGREDIENTS, RESULTS, ROOT, git_commit, percentile  # noqa: E402
+
+
+def latencies(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3),
+    }
+
+
+def logged_in(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+    return client
+
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix='pantry-match-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+    os.environ.setdefault('REAPER_INTERVAL', '0')
+    # measure the matchmaker, not load shedding
+    os.environ.setdefault('ADMISSION_CAPACITY', '0')
+    os.environ['MATCH_MAX_WAIT'] = str(args.max_wait)
+    os.environ['MATCH_BATCH_MS'] = str(args.batch_ms)
+    sys.path.insert(0, ROOT)
+
+    from sqlalchemy import func, insert, select
+    import hello
+    import migrations
+    from matchmaking import SEATS, matchmaker
+
+    app = hello.app
+    users = args.players + args.race_games * (args.race_joiners + 1)
+    with app.app_context():
+        hello.db.create_all()
+        migrations.stamp(hello.db.engine)
+        hello.db.session.add_all(hello.Ingredients(name=n) for n in INGREDIENTS)
+        hello.db.session.execute(insert(hello.User), [
+            {'username': f"match{i}", 'display_name': f"match{i}", 'password_hash': '-'}
+            for i in range(users)
+        ])
+        hello.db.session.commit()
+        user_ids = hello.db.session.execute(select(hello.User.id).order_by(hello.User.id)).scalars().all()
+
+    players = user_ids[:args.players]
+    clients = {uid: logged_in(app, uid) for uid in players}
+    # players come from the dashboard, so they're in the user cache already
+    for client in clients.values():
+        client.get('/quickmatch')
+    joined_at = {}
+    join_times = []
+    errors = []
+    lock = threading.Lock()
+
+    def join(uid):
+        start = time.monotonic()
+        resp = clients[uid].post('/quickmatch')
+        elapsed = time.monotonic() - start
+        with lock:
+            joined_at[uid] = start
+            join_times.append(elapsed)
+            if resp.status_code != 302 or '/quickmatch' not in resp.location:
+                errors.append(f"join {uid}: {resp.status_code} {resp.location}")
+
+    burst_rates = []
+    start = time.monotonic()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        for i in range(0, len(players), args.burst):
+            burst = players[i:i + args.burst]
+            t = time.monotonic()
+            list(pool.map(join, burst))
+            burst_rates.append(len(burst) / (time.monotonic() - t))
+            if i + args.burst < len(players):
+                time.sleep(args.gap)
+    join_elapsed = time.monotonic() - start
+
+    # one player too few for a game is left waiting; everyone else is seated
+    # within max_wait of the last arrival
+    leftover = len(players) % SEATS if len(players) % SEATS < matchmaker.min_players else 0
+    deadline = time.monotonic() + args.max_wait + 10
+    while time.monotonic() < deadline and matchmaker.stats()['players'] < len(players) - leftover:
+        time.sleep(0.01)
+    with matchmaker._cond:
+        matched = dict(matchmaker.matched)
+    fill = [matched[uid][1] - joined_at[uid] for uid in players if uid in matched]
+    unmatched = [uid for uid in players if uid not in matched]
+
+    # each player picks their game up from the waiting page
+    for uid in players:
+        if uid in matched:
+            resp = clients[uid].get('/quickmatch')
+            if f"/gamelobby/{matched[uid][0]}" not in (resp.location or ''):
+                errors.append(f"waiting page {uid}: {resp.status_code} {resp.location}")
+
+    with app.app_context():
+        session = hello.db.session
+        PlayerGame = hello.PlayerGame
+        sizes = Counter(session.execute(
+            select(func.count()).select_from(PlayerGame).group_by(PlayerGame.game_id)
+        ).scalars())
+        seatings = Counter(session.execute(
+            select(PlayerGame.user_id).where(PlayerGame.user_id.in_(players))
+        ).scalars())
+
+    # racing joins onto open games by id, the way /joingame is reached from a code
+    racers = iter(user_ids[args.players:])
+    race_games = []
+    with app.app_context():
+        for _ in range(args.race_games):
+            host = next(racers)
+            game = hello.Game(host_id=host, round_num=1, active=True, code=hello.codes.allocate())
+            hello.db.session.add(game)
+            hello.db.session.flush()
+            hello.db.session.add(PlayerGame(game_id=game.id, user_id=host, score=0, seat=0))
+            race_games.append(game.id)
+        hello.db.session.commit()
+
+    race_clients = [(game_id, logged_in(app, next(racers)))
+                    for game_id in race_games for _ in range(args.race_joiners)]
+    barrier = threading.Barrier(len(race_clients))
+
+    def race(entry):
+        game_id, client = entry
+        barrier.wait()
+        client.get(f'/joingame/{game_id}')
+
+    with ThreadPoolExecutor(len(race_clients)) as pool:
+        list(pool.map(race, race_clients))
+    with app.app_context():
+        race_sizes = hello.db.session.execute(
+            select(PlayerGame.game_id, func.count())
+            .where(PlayerGame.game_id.in_(race_games)).group_by(PlayerGame.game_id)
+        ).all()
+
+    stats = matchmaker.stats()
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {'players': args.players, 'burst': args.burst, 'gap': args.gap,
+                   'concurrency': args.concurrency, 'max_wait': args.max_wait, 'batch_ms': args.batch_ms,
+                   'race_games': args.race_games, 'race_joiners': args.race_joiners},
+        'joins_per_s': round(len(players) / join_elapsed, 1),
+        'peak_burst_joins_per_s': round(max(burst_rates), 1),
+        'join': latencies(join_times),
+        'fill': latencies(fill),
+        'games': stats['games'],
+        'game_sizes': {str(k): v for k, v in sorted(sizes.items())},
+        'unmatched': len(unmatched) - leftover,
+        'seated_twice': sum(1 for n in seatings.values() if n > 1),
+        'overfilled_games': sum(n for size, n in sizes.items() if size > SEATS),
+        'race': {'games': len(race_games),
+                 'max_players': max((n for _, n in race_sizes), default=0),
+                 'overfilled_games': sum(1 for _, n in race_sizes if n > SEATS)},
+        'errors': errors[:20],
+    }
+
+
+def report(result):
+    print(f"commit {result['commit']}  {result['joins_per_s']} joins/s  "
+          f"(peak burst {result['peak_burst_joins_per_s']}/s)  {result['games']} games")
+    print(f"{'':<8}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name in ('join', 'fill'):
+        r = result[name]
+        if r['count']:
+            print(f"{name:<8}{r['count']:>8}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['max_ms']:>10}")
+    print(f"game sizes {result['game_sizes']}  unmatched {result['unmatched']}  "
+          f"seated twice {result['seated_twice']}  overfilled {result['overfilled_games']}")
+    race = result['race']
+    print(f"race: {race['games']} games, at most {race['max_players']} players, "
+          f"{race['overfilled_games']} overfilled")
+    for e in result['errors']:
+        print("ERROR", e)
+
+
+def failed(result):
+    return bool(result['errors'] or result['unmatched'] or result['seated_twice']
+                or result['overfilled_games'] or result['race']['overfilled_games'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=2000)
+    parser.add_argument('--burst', type=int, default=500, help='players arriving at once')
+    parser.add_argument('--gap', type=float, default=0.25, help='seconds between bursts')
+    parser.add_argument('--concurrency', type=int, default=32, help='requests in flight at once')
+    parser.add_argument('--max-wait', type=int, default=1, help='MATCH_MAX_WAIT for the run')
+    parser.add_argument('--batch-ms', type=int, default=20, help='MATCH_BATCH_MS for the run')
+    parser.add_argument('--race-games', type=int, default=20)
+    parser.add_argument('--race-joiners', type=int, default=8, help='players racing for the 3 free seats')
+    parser.add_argument('--out', help='result file (default bench/results/matchmaking-<time>-<commit>.json)')
+    args = parser.parse_args()
+
+    result = run(args)
+    report(result)
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS, exist_ok=True)
+        out = os.path.join(RESULTS, f"matchmaking-{time.strftime('%Y%m%d-%H%M%S')}-{result['commit'] or 'nogit'}.json")
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"saved {out}")
+    sys.exit(1 if failed(result) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""Worker scaling benchmark.
+
+Starts serve.py with 1, 2, 4, ... workers against a throwaway SQLite database
+and plays the same games as bench_gameflow.py over real HTTP, so events and
+game state have to cross process boundaries. Reports games/s and requests/s
+per worker count and the speedup over one worker.
+
+    python bench/bench_workers.py --workers 1 2 4 --games 40 --concurrency 16
+
+Results are written to bench/results/ next to the game flow runs. Scaling is
+bounded by the cores on the machine (the result records os.cpu_count()) and
+by SQLite's single writer.
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_gameflow import INGREDIENTS, RESULTS, ROOT, Recorder, git_commit, play_game  # noqa: E402
+
+
+class HttpResponse:
+    def __init__(self, resp):
+        self.status_code = resp.status
+        self.headers = resp.headers
+        self.location = resp.getheader('Location')
+        self.data = resp.read()
+
+    def get_data(self, as_text=False):
+        return self.data.decode('utf-8') if as_text else self.data
+
+
+class HttpClient:
+    # just enough of Flask's test client for play_game(): cookies, no redirects
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.cookies = {}
+        self.conn = None
+
+    def request(self, method, url, body=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f"{k}={v}" for k, v in self.cookies.items())
+        if body is not None:
+            body = urlencode(body)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+            try:
+                self.conn.request(method, url, body=body, headers=headers)
+                resp = HttpResponse(self.conn.getresponse())
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # the server closed a keep-alive connection; reconnect once
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        for header in resp.headers.get_all('Set-Cookie') or ():
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        if resp.headers.get('Connection', '').lower() == 'close':
+            self.conn.close()
+            self.conn = None
+        return resp
+
+    def get(self, url, headers=None):
+        return self.request('GET', url, headers=headers)
+
+    def post(self, url, data=None):
+        return self.request('POST', url, body=data or {})
+
+
+class HttpApp:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def test_client(self):
+        return HttpClient(self.host, self.port)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def prepare_database(env):
+    # same seed as bench_gameflow, in a subprocess so this one never imports the app
+    script = (
+        "import hello, migrations\n"
+        "with hello.app.app_context():\n"
+        "    hello.db.create_all()\n"
+        "    migrations.stamp(hello.db.engine)\n"
+        f"    hello.db.session.add_all(hello.Ingredients(name=n) for n in {INGREDIENTS!r})\n"
+        "    hello.db.session.commit()\n"
+    )
+    subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, check=True)
+
+
+def wait_for(port, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"serve.py exited with {proc.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("serve.py did not start listening")
+
+
+def run_one(workers, args):
+    tmp = tempfile.mkdtemp(prefix='pantry-workers-')
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': 'sqlite:///' + os.path.join(tmp, 'bench.db'),
+        'EVENT_DB': os.path.join(tmp, 'events.db'),
+        'PASSWORD_HASH_METHOD': args.hash_method,
+        'REAPER_INTERVAL': '0',
+        # the same code path at every worker count, so only the count changes
+        'EVENT_BACKEND': 'sqlite',
+        'GAMESTATE_WRITE_BEHIND': '0',
+        'MATCH_BACKEND': 'database',
+    })
+    prepare_database(env)
+
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, 'serve.py', '--workers', str(workers), '--port', str(port)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_for(port, proc)
+        app = HttpApp('127.0.0.1', port)
+        rec = Recorder()
+        errors = []
+        games = iter(range(args.games))
+        games_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with games_lock:
+                    game_no = next(games, None)
+                if game_no is None:
+                    return
+                try:
+                    play_game(app, rec, game_no, args.rounds, args.polls)
+                except Exception as e:
+                    errors.append(f"game {game_no}: {e!r}")
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+    routes = rec.summary()
+    total_requests = sum(r['count'] for r in routes.values())
+    return {
+        'workers': workers,
+        'elapsed_s': round(elapsed, 3),
+        'games_per_s': round(args.games / elapsed, 3),
+        'requests_per_s': round(total_requests / elapsed, 3),
+        'p95_ms': {route: r['p95_ms'] for route, r in routes.items()},
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--games', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=16, help='games played at once')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--polls', type=int, default=2, help='reloads per waiting player per step')
+    parser.add_argument('--hash-method', default='pbkdf2:sha256:1000')
+    parser.add_argument('--out', help='result file (default bench/results/workers-<time>-<commit>.json)')
+    args = parser.parse_args()
+
+    runs = []
+    for workers in args.workers:
+        run = run_one(workers, args)
+        runs.append(run)
+        speedup = run['games_per_s'] / runs[0]['games_per_s'] if runs[0]['games_per_s'] else 0
+        print(f"{workers:>3} workers  {run['elapsed_s']:>8}s  {run['games_per_s']:>8} games/s  "
+              f"{run['requests_per_s']:>9} req/s  x{speedup:.2f}", flush=True)
+        for e in run['errors']:
+            print("ERROR", e)
+
+    result = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'cpu_count': os.cpu_count(),
+        'params': {'games': args.games, 'concurrency': args.concurrency, 'rounds': args.rounds,
+                   'polls': args.polls, 'hash_method': args.hash_method},
+        'runs': runs,
+    }
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS, exist_ok=True)
+        out = os.path.join(RESULTS, f"workers-{time.strftime('%Y%m%d-%H%M%S')}-{result['commit'] or 'nogit'}.json")
+    with open(out, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"saved {out}")
+    sys.exit(1 if any(r['errors'] for r in runs) else 0)
+
+
+if __name__ == '__main__':
+    main()
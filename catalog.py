@@ -0,0 +1,84 @@
+"""Ingredient catalog cache and per-game decks.
+
+The catalog is held in memory as a tuple of names and reloaded when an
+Ingredients row changes through the ORM (the admin) or after `ttl` seconds as a
+backstop for other processes. Each game gets a shuffled deck when it starts so
+a round draws its hand with a couple of pops, and nothing repeats within a game.
+"""
+import random
+import threading
+import time
+
+from sqlalchemy import event, select
+
+
+class IngredientCatalog:
+    def __init__(self, hand_size=3, rounds=3, ttl=300):
+        self.hand_size = hand_size
+        self.rounds = rounds
+        self.ttl = ttl
+        self._names = None
+        self._loaded_at = 0
+        self._decks = {}   # game id -> list of names still to be drawn
+        self._lock = threading.Lock()
+
+    def init_app(self, app, db, Ingredients, GameRound):
+        self.db = db
+        self.Ingredients = Ingredients
+        self.GameRound = GameRound
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(Ingredients, name, self._changed)
+
+    def _changed(self, mapper, connection, target):
+        self.invalidate()
+
+    def invalidate(self):
+        self._names = None
+
+    def names(self):
+        names = self._names
+        if names is None or time.monotonic() - self._loaded_at > self.ttl:
+            rows = self.db.session.execute(
+                select(self.Ingredients.name).order_by(self.Ingredients.id)
+            ).scalars()
+            names = self._names = tuple(rows)
+            self._loaded_at = time.monotonic()
+        return names
+
+    def new_deck(self, game_id, exclude=()):
+        names = self.names()
+        if exclude:
+            exclude = set(exclude)
+            names = [n for n in names if n not in exclude]
+        size = min(len(names), self.hand_size * self.rounds)
+        deck = random.sample(names, size)
+        with self._lock:
+            self._decks[game_id] = deck
+        return deck
+
+    def draw(self, game_id):
+        with self._lock:
+            deck = self._decks.get(game_id)
+        if deck is None:
+            # lost on restart; rebuild without what earlier rounds already used
+            deck = self.new_deck(game_id, exclude=self._used(game_id))
+        with self._lock:
+            if len(deck) < self.hand_size:
+                # more rounds than the deck was built for, start over
+                names = self.names()
+                deck = self._decks[game_id] = random.sample(names, min(len(names), self.hand_size * self.rounds))
+            hand = [deck.pop() for _ in range(self.hand_size)]
+        return hand
+
+    def discard(self, game_id):
+        with self._lock:
+            self._decks.pop(game_id, None)
+
+    def _used(self, game_id):
+        rows = self.db.session.execute(
+            select(self.GameRound.ingredients).where(self.GameRound.game_id == game_id)
+        ).scalars()
+        return {name.strip() for row in rows if row for name in row.split(',')}
+
+
+catalog = IngredientCatalog()
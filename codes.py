@@ -0,0 +1,62 @@
+"""Join code allocation.
+
+The codes of active games are loaded once and kept in a set, so handing out a
+new one is a few random draws against memory rather than a query per
+candidate. When a game ends its row gets a retired code ('#' + the id in base
+36, which can't collide with a real code) so the real one can be reused.
+"""
+import random
+import string
+import threading
+
+from sqlalchemy import select
+
+ALPHABET = string.ascii_uppercase + string.digits
+
+
+def retired_code(game_id):
+    digits = []
+    while True:
+        game_id, r = divmod(game_id, 36)
+        digits.append(ALPHABET[r])
+        if not game_id:
+            break
+    return '#' + ''.join(reversed(digits))
+
+
+class CodeAllocator:
+    def __init__(self, length=6):
+        self.length = length
+        self._live = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, db, Game):
+        self.db = db
+        self.Game = Game
+
+    def _load(self):
+        rows = self.db.session.execute(
+            select(self.Game.code).where(self.Game.active.is_(True))
+        ).scalars()
+        return set(rows)
+
+    def allocate(self):
+        if self._live is None:
+            live = self._load()
+            with self._lock:
+                if self._live is None:
+                    self._live = live
+        with self._lock:
+            while True:
+                code = ''.join(random.choices(ALPHABET, k=self.length))
+                if code not in self._live:
+                    self._live.add(code)
+                    return code
+
+    def release(self, code):
+        with self._lock:
+            if self._live is not None:
+                self._live.discard(code)
+
+
+codes = CodeAllocator()
@@ -0,0 +1,301 @@
+"""Per-game event stream.
+
+Routes call ``broker.publish(game_id, "vote-cast", ...)`` after they commit and
+waiting pages hold one ``/events/<game_id>`` connection open instead of
+reloading every second.
+
+Each publish also bumps the game's sequence number, which doubles as its state
+version: polled pages derive their ETag from it.
+
+Where sequence numbers come from and how events get to the other worker
+processes is up to the backend (EVENT_BACKEND):
+
+local
+    in-process counters, for a single process (the default).
+sqlite
+    an append-only log in a small SQLite file (EVENT_DB) shared by every worker
+    on the machine. Publishing takes the next number for the game in one
+    transaction; each worker polls the log every EVENT_POLL_INTERVAL seconds
+    and catches up before it publishes, so it sees everything in order.
+    Listeners registered with ``on_remote`` hear about events from other
+    workers, which is how their in-memory game state gets invalidated.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+
+class LocalBackend:
+    def __init__(self):
+        self.epoch = os.urandom(4).hex()
+        self._seq = {}
+        self._lock = threading.Lock()
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, game_id, event, data):
+        with self._lock:
+            seq = self._seq[game_id] = self._seq.get(game_id, 0) + 1
+            self.deliver(game_id, seq, event, data, remote=False)
+        return seq
+
+    def current(self, game_id):
+        return self._seq.get(game_id, 0)
+
+    def sync(self):
+        pass
+
+
+class SQLiteBackend:
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS event_log ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " game_id INTEGER NOT NULL,"
+        " seq INTEGER NOT NULL,"
+        " event TEXT NOT NULL,"
+        " data TEXT NOT NULL,"
+        " origin TEXT NOT NULL,"
+        " at FLOAT NOT NULL)",
+        # kept apart from the log so trimming old events never resets a
+        # game's version
+        "CREATE TABLE IF NOT EXISTS event_seq ("
+        " game_id INTEGER PRIMARY KEY,"
+        " seq INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS event_meta ("
+        " key TEXT PRIMARY KEY,"
+        " value TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_event_log_at ON event_log (at)",
+    )
+
+    def __init__(self, path, poll_interval=0.05, retention=600):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._reset()
+        # a worker forked from a process that already used the backend
+        # (serve.py, gunicorn --preload) needs its own identity and connections
+        os.register_at_fork(after_in_child=self._reset)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        # the epoch changes only when the log is recreated, so etags built
+        # from sequence numbers stay valid across restarts and workers
+        conn.execute("INSERT OR IGNORE INTO event_meta (key, value) VALUES ('epoch', ?)", (os.urandom(4).hex(),))
+        conn.execute("COMMIT")
+        self.epoch = conn.execute("SELECT value FROM event_meta WHERE key = 'epoch'").fetchone()[0]
+
+    def _reset(self):
+        self.origin = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self._local = threading.local()
+        self._poll_lock = threading.Lock()
+        self._last_id = None
+        self._poller = None
+        self._trimmed = 0.0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, game_id, event, data):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            seq = conn.execute(
+                "INSERT INTO event_seq (game_id, seq) VALUES (?, 1) "
+                "ON CONFLICT (game_id) DO UPDATE SET seq = seq + 1 RETURNING seq",
+                (game_id,)
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO event_log (game_id, seq, event, data, origin, at) VALUES (?, ?, ?, ?, ?, ?)",
+                (game_id, seq, event, json.dumps(data), self.origin, time.time())
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        # deliver everything up to and including our own event, in order
+        self.sync()
+        return seq
+
+    def current(self, game_id):
+        row = self._conn().execute("SELECT seq FROM event_seq WHERE game_id = ?", (game_id,)).fetchone()
+        return row[0] if row else 0
+
+    def sync(self):
+        if self._poller is None:
+            self._start_poller()
+        conn = self._conn()
+        with self._poll_lock:
+            if self._last_id is None:
+                # start at the end; older events are already in the database
+                self._last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM event_log").fetchone()[0]
+            rows = conn.execute(
+                "SELECT id, game_id, seq, event, data, origin FROM event_log WHERE id > ? ORDER BY id",
+                (self._last_id,)
+            ).fetchall()
+            for row_id, game_id, seq, event, data, origin in rows:
+                self._last_id = row_id
+                self.deliver(game_id, seq, event, json.loads(data), remote=origin != self.origin)
+
+    def _start_poller(self):
+        with self._poll_lock:
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._run, name='event-poller', daemon=True)
+                self._poller.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.sync()
+                self._trim()
+            except sqlite3.Error:
+                # busy or briefly unavailable; the next poll picks up from _last_id
+                pass
+
+    def _trim(self):
+        now = time.time()
+        if now - self._trimmed < self.retention / 10:
+            return
+        self._trimmed = now
+        self._conn().execute("DELETE FROM event_log WHERE at < ?", (now - self.retention,))
+
+
+class EventBroker:
+    def __init__(self, history=64):
+        self._cond = threading.Condition()
+        self._history = history
+        # game_id -> deque of (seq, event, data)
+        self._games = {}
+        self._seq = {}
+        self._activity = {}   # game_id -> wall time of its last publish
+        self._remote_listeners = []
+        self.backend = LocalBackend()
+        self.backend.start(self._deliver)
+
+    def init_app(self, app):
+        kind = app.config.get('EVENT_BACKEND', 'local')
+        if kind == 'sqlite':
+            path = app.config.get('EVENT_DB') or os.path.join(app.instance_path, 'events.db')
+            self.backend = SQLiteBackend(
+                path,
+                poll_interval=app.config.get('EVENT_POLL_INTERVAL', 0.05),
+                retention=app.config.get('EVENT_RETENTION', 600),
+            )
+        elif kind != 'local':
+            raise ValueError(f"unknown EVENT_BACKEND {kind!r}")
+        self.backend.start(self._deliver)
+
+    @property
+    def epoch(self):
+        return self.backend.epoch
+
+    @property
+    def shared(self):
+        return not isinstance(self.backend, LocalBackend)
+
+    def on_remote(self, fn):
+        # fn(game_id, event, data) runs for events published by other workers
+        self._remote_listeners.append(fn)
+        return fn
+
+    def publish(self, game_id, event, **data):
+        seq = self.backend.publish(game_id, event, data)
+        with self._cond:
+            self._activity[game_id] = time.time()
+        return seq
+
+    def sync(self):
+        # catch up with other workers' events before reading game state
+        self.backend.sync()
+
+    def _deliver(self, game_id, seq, event, data, remote):
+        with self._cond:
+            # last_seq() may already have read this far from the backend
+            if seq > self._seq.get(game_id, 0):
+                self._seq[game_id] = seq
+                log = self._games.get(game_id)
+                if log is None:
+                    log = self._games[game_id] = deque(maxlen=self._history)
+                log.append((seq, event, data))
+                self._cond.notify_all()
+        if remote:
+            for fn in self._remote_listeners:
+                fn(game_id, event, data)
+
+    def drain_activity(self):
+        # hand over (and reset) which games saw activity since the last call
+        with self._cond:
+            activity, self._activity = self._activity, {}
+        return activity
+
+    def last_seq(self, game_id):
+        seq = self._seq.get(game_id)
+        if seq is None:
+            # a game this worker hasn't seen an event for yet
+            seq = self.backend.current(game_id)
+            with self._cond:
+                seq = max(seq, self._seq.get(game_id, 0))
+                self._seq[game_id] = seq
+        return seq
+
+    def since(self, game_id, last_seq):
+        log = self._games.get(game_id, ())
+        return [e for e in log if e[0] > last_seq]
+
+    def wait(self, game_id, last_seq, timeout):
+        # block until something newer than last_seq shows up (or timeout)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                events = self.since(game_id, last_seq)
+                if events:
+                    return events
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._cond.wait(remaining)
+
+    def forget(self, game_id):
+        with self._cond:
+            self._games.pop(game_id, None)
+            self._cond.notify_all()
+
+
+def format_sse(seq, event, data):
+    return f"id: {seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream(broker, game_id, last_seq=0, keepalive=15, lifetime=300, retry_ms=2000):
+    # generator for a text/event-stream response; closes after `lifetime` so
+    # the browser reconnects (with Last-Event-ID) and threads get recycled
+    yield f"retry: {retry_ms}\n\n"
+    # a client that saw a newer id than we have (server restarted) starts fresh
+    last_seq = min(last_seq, broker.last_seq(game_id))
+    started = time.monotonic()
+    while time.monotonic() - started < lifetime:
+        events = broker.wait(game_id, last_seq, keepalive)
+        if not events:
+            yield ": keepalive\n\n"
+            continue
+        for seq, event, data in events:
+            last_seq = seq
+            yield format_sse(seq, event, data)
+
+
+broker = EventBroker()
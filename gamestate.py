@@ -0,0 +1,479 @@
+"""Live game state.
+
+Games that are being played are held in memory (players, scores, the current
+round with its answers and votes) so the submit/vote/wait loop never has to
+read the database. Writes are queued and a background thread persists them to
+the SQLAlchemy models in batches. A game that isn't in memory, e.g. after a
+restart, is loaded back from the database the first time it's touched.
+
+Each round moves submit -> vote -> results. The move happens once, under the
+game's lock, in the submit or vote that completes the phase, so waiting pages
+only ever read `round.phase`.
+
+With more than one worker process the lock and the queue are per process, so
+GAMESTATE_WRITE_BEHIND=0 switches to writing through: each submit and vote is
+committed before it returns, with the round row locked so the phase only moves
+once across workers, and other workers drop their copy of the game when they
+hear about the event (see events.py).
+
+Answers are compared by their normalized text, which is stored next to the
+raw text and unique per round. Each live round also keeps a trigram index of
+its answers (see similarity.py) so plurals and typos of an answer that's
+already in are turned away without going to the database.
+"""
+import atexit
+import logging
+import threading
+from collections import namedtuple
+from types import SimpleNamespace
+
+from sqlalchemy import bindparam, func, insert, literal, select, update
+from sqlalchemy.exc import IntegrityError
+
+from similarity import NgramIndex
+
+log = logging.getLogger(__name__)
+
+Player = namedtuple('Player', 'user_id display_name score')
+Answer = namedtuple('Answer', 'id user_id text votes')
+
+
+def normalize(text):
+    return " ".join(text.strip().lower().split())
+
+
+def record_vote(session, m, game_id, round_id, voter_id, response_id):
+    """Records one vote without reading anything first: the insert only
+    matches if the response is in this round and isn't the voter's own, a
+    second vote trips uniq_vote_per_round (IntegrityError), and both counters
+    are bumped in SQL. Returns False if the vote didn't match a response.
+    Runs in the caller's transaction."""
+    inserted = session.execute(
+        insert(m.Vote).from_select(
+            ['round_id', 'voter_id', 'response_id'],
+            select(literal(round_id), literal(voter_id), m.Responses.id).where(
+                m.Responses.id == response_id,
+                m.Responses.round_id == round_id,
+                m.Responses.user_id != voter_id,
+            )
+        )
+    ).rowcount
+    if not inserted:
+        return False
+
+    session.execute(
+        update(m.Responses)
+        .where(m.Responses.id == response_id)
+        .values(votes=m.Responses.votes + 1)
+    )
+    owner = select(m.Responses.user_id).where(m.Responses.id == response_id).scalar_subquery()
+    session.execute(
+        update(m.PlayerGame)
+        .where(m.PlayerGame.game_id == game_id, m.PlayerGame.user_id == owner)
+        .values(score=m.PlayerGame.score + 1)
+    )
+    return True
+
+
+class LiveRound:
+    __slots__ = ('id', 'ingredients', 'phase', 'answers', 'norms', 'similar', 'submitters', 'votes')
+
+    def __init__(self, id, ingredients, phase='submit', threshold=0.9):
+        self.id = id
+        self.ingredients = ingredients
+        self.phase = phase
+        self.answers = {}   # response id -> [user_id, text, votes]
+        self.norms = set()
+        self.similar = NgramIndex(threshold)
+        self.submitters = set()
+        self.votes = {}     # voter id -> response id
+
+    def add_answer(self, response_id, user_id, text, norm, votes=0):
+        self.answers[response_id] = [user_id, text, votes]
+        self.norms.add(norm)
+        self.similar.add(response_id, norm)
+        self.submitters.add(user_id)
+
+    def answer_list(self):
+        return [Answer(rid, a[0], a[1], a[2]) for rid, a in self.answers.items()]
+
+
+class LiveGame:
+    __slots__ = ('id', 'host_id', 'code', 'round_num', 'players', 'round', 'lock')
+
+    def __init__(self, id, host_id, code, round_num):
+        self.id = id
+        self.host_id = host_id
+        self.code = code
+        self.round_num = round_num
+        self.players = {}   # user id -> [display_name, score], in join order
+        self.round = None
+        self.lock = threading.Lock()
+
+    def player_list(self):
+        players = [Player(uid, p[0], p[1]) for uid, p in self.players.items()]
+        players.sort(key=lambda p: p.score, reverse=True)
+        return players
+
+
+class GameStore:
+    def __init__(self, flush_interval=0.2, batch_size=500, write_behind=True, near_duplicates=0.9):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.write_behind = write_behind
+        self.near_duplicates = near_duplicates
+        self._games = {}
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._next_response_id = None
+        self._writer = None
+
+    def init_app(self, app, db, **models):
+        self.app = app
+        self.db = db
+        self.m = SimpleNamespace(**models)
+        self.write_behind = app.config.get('GAMESTATE_WRITE_BEHIND', self.write_behind)
+        self.near_duplicates = app.config.get('NEAR_DUPLICATE_THRESHOLD', self.near_duplicates)
+        atexit.register(self.flush)
+
+    # reads
+
+    def get(self, game_id):
+        game = self._games.get(game_id)
+        if game is None:
+            game = self._load(game_id)
+            if game is not None:
+                with self._lock:
+                    game = self._games.setdefault(game_id, game)
+        return game
+
+    def round(self, game, round_id):
+        rnd = game.round
+        if rnd is not None and rnd.id == round_id:
+            return rnd
+        # an older round, e.g. someone with a stale tab; not worth caching
+        row = self.db.session.get(self.m.GameRound, round_id)
+        if row is None or row.game_id != game.id:
+            return None
+        old = self._load_round(row)
+        if rnd is not None and old.id < rnd.id:
+            old.phase = 'results'
+        return old
+
+    def drop(self, game_id):
+        # forget a game after its players change through the database; the
+        # next read reloads it (after pending writes land, see _load)
+        with self._lock:
+            self._games.pop(game_id, None)
+
+    # writes
+
+    def round_started(self, game_id, round_id, ingredients, round_num):
+        game = self._games.get(game_id)
+        if game is None:
+            return
+        with game.lock:
+            if game.round is None or round_id > game.round.id:
+                game.round = LiveRound(round_id, ingredients, threshold=self.near_duplicates)
+                game.round_num = round_num
+
+    def submit(self, game, round_id, user_id, text):
+        with game.lock:
+            rnd = game.round
+            if rnd is None or rnd.id != round_id:
+                return None, 'stale'
+            if rnd.phase != 'submit':
+                return None, 'closed'
+            norm = normalize(text)
+            if norm in rnd.norms:
+                return None, 'duplicate'
+            if rnd.similar.match(norm) is not None:
+                return None, 'similar'
+            if not self.write_behind:
+                return self._submit_now(game, rnd, user_id, text, norm)
+            response_id = self._allocate_response_id()
+            rnd.add_answer(response_id, user_id, text, norm)
+            self._queue(('response', response_id, round_id, user_id, text, norm))
+            self._advance(game)
+        return response_id, 'ok'
+
+    def vote(self, game, round_id, voter_id, response_id):
+        with game.lock:
+            rnd = game.round
+            if rnd is None or rnd.id != round_id:
+                return 'stale'
+            if rnd.phase != 'vote':
+                return 'closed'
+            answer = rnd.answers.get(response_id)
+            if answer is None:
+                return 'missing'
+            if answer[0] == voter_id:
+                return 'own'
+            if voter_id in rnd.votes:
+                return 'duplicate'
+            if not self.write_behind:
+                return self._vote_now(game, rnd, voter_id, response_id, answer)
+            # these in-memory counters are the vote/score totals the pages
+            # show; the database copies are bumped in SQL by record_vote
+            rnd.votes[voter_id] = response_id
+            answer[2] += 1
+            if answer[0] in game.players:
+                game.players[answer[0]][1] += 1
+            self._queue(('vote', game.id, round_id, voter_id, response_id))
+            self._advance(game)
+        return 'ok'
+
+    # write-through, for when other workers play the same game
+
+    def _lock_round(self, session, round_id):
+        # a no-op write: takes the round's row lock on a server database and
+        # the write lock on SQLite before anything is read, so concurrent
+        # submits for one round are serialized across workers
+        table = self.m.GameRound.__table__
+        return session.execute(
+            update(table).where(table.c.id == round_id).values(phase=table.c.phase)
+        ).rowcount
+
+    def _close_phase(self, session, game_id, round_id, done, after):
+        players = session.execute(
+            select(func.count()).select_from(self.m.PlayerGame).where(self.m.PlayerGame.game_id == game_id)
+        ).scalar()
+        if done < players:
+            return False
+        table = self.m.GameRound.__table__
+        session.execute(update(table).where(table.c.id == round_id).values(phase=after))
+        return True
+
+    def _submit_now(self, game, rnd, user_id, text, norm):
+        m = self.m
+        session = self.db.session
+        try:
+            if not self._lock_round(session, rnd.id):
+                session.rollback()
+                return None, 'stale'
+            phase = session.execute(select(m.GameRound.phase).where(m.GameRound.id == rnd.id)).scalar()
+            if phase != 'submit':
+                session.rollback()
+                rnd.phase = phase
+                return None, 'closed'
+            response_id = session.execute(
+                insert(m.Responses)
+                .values(round_id=rnd.id, user_id=user_id, text=text, text_norm=norm, votes=0)
+                .returning(m.Responses.id)
+            ).scalar()
+            submitted = session.execute(
+                select(func.count(func.distinct(m.Responses.user_id))).where(m.Responses.round_id == rnd.id)
+            ).scalar()
+            advanced = self._close_phase(session, game.id, rnd.id, submitted, 'vote')
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return None, 'duplicate'
+
+        rnd.add_answer(response_id, user_id, text, norm)
+        if advanced:
+            rnd.phase = 'vote'
+        return response_id, 'ok'
+
+    def _vote_now(self, game, rnd, voter_id, response_id, answer):
+        m = self.m
+        session = self.db.session
+        try:
+            if not self._lock_round(session, rnd.id):
+                session.rollback()
+                return 'stale'
+            phase = session.execute(select(m.GameRound.phase).where(m.GameRound.id == rnd.id)).scalar()
+            if phase != 'vote':
+                session.rollback()
+                rnd.phase = phase
+                return 'closed'
+            if not record_vote(session, m, game.id, rnd.id, voter_id, response_id):
+                session.rollback()
+                return 'missing'
+            votes = session.execute(
+                select(func.count()).select_from(m.Vote).where(m.Vote.round_id == rnd.id)
+            ).scalar()
+            advanced = self._close_phase(session, game.id, rnd.id, votes, 'results')
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return 'duplicate'
+
+        rnd.votes[voter_id] = response_id
+        answer[2] += 1
+        if answer[0] in game.players:
+            game.players[answer[0]][1] += 1
+        if advanced:
+            rnd.phase = 'results'
+        return 'ok'
+
+    def _advance(self, game):
+        # called with game.lock held, so each transition happens exactly once
+        rnd = game.round
+        if rnd is None or not game.players:
+            return False
+        players = len(game.players)
+        if rnd.phase == 'submit' and len(rnd.submitters) >= players:
+            rnd.phase = 'vote'
+        elif rnd.phase == 'vote' and len(rnd.votes) >= players:
+            rnd.phase = 'results'
+        else:
+            return False
+        self._queue(('phase', rnd.id, rnd.phase))
+        return True
+
+    # persistence
+
+    def flush(self):
+        with self._flush_lock:
+            with self._pending_lock:
+                ops, self._pending = self._pending, []
+            if ops:
+                with self.app.app_context():
+                    self._write(ops)
+
+    def _queue(self, op):
+        if not self.write_behind:
+            self._write([op])
+            return
+        with self._pending_lock:
+            self._pending.append(op)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+        if self._writer is None:
+            self._start_writer()
+
+    def _start_writer(self):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name='gamestate-writer', daemon=True)
+                self._writer.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception("game state flush failed")
+
+    def _write(self, ops):
+        m = self.m
+        session = self.db.session
+        responses = [
+            {'id': op[1], 'round_id': op[2], 'user_id': op[3], 'text': op[4], 'text_norm': op[5], 'votes': 0}
+            for op in ops if op[0] == 'response'
+        ]
+        votes = [op[1:] for op in ops if op[0] == 'vote']
+        phases = [{'round_id': op[1], 'phase': op[2]} for op in ops if op[0] == 'phase']
+
+        try:
+            if responses:
+                session.execute(insert(m.Responses), responses)
+            for game_id, round_id, voter_id, response_id in votes:
+                record_vote(session, m, game_id, round_id, voter_id, response_id)
+            if phases:
+                table = m.GameRound.__table__
+                session.execute(
+                    update(table).where(table.c.id == bindparam('round_id')).values(phase=bindparam('phase')),
+                    phases
+                )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            if len(ops) == 1:
+                if isinstance(e, IntegrityError) and ops[0][0] == 'vote':
+                    log.info("ignoring duplicate vote %r", ops[0])
+                else:
+                    log.exception("dropping unpersistable game op %r", ops[0])
+                self._discard(ops[0])
+                return
+            # one bad op shouldn't sink the batch, retry them one at a time
+            for op in ops:
+                self._write([op])
+
+    def _discard(self, op):
+        # the op never reached the database, so the game in memory has an
+        # answer, vote or phase it doesn't; drop the game so the next read
+        # loads what's really there
+        round_id = op[2] if op[0] != 'phase' else op[1]
+        with self._lock:
+            for game_id, game in list(self._games.items()):
+                if game.round is not None and game.round.id == round_id:
+                    del self._games[game_id]
+        if op[0] == 'response':
+            # its id may have been taken by another writer; skip past theirs
+            last = self.db.session.execute(select(func.max(self.m.Responses.id))).scalar()
+            with self._lock:
+                if self._next_response_id is not None:
+                    self._next_response_id = max(self._next_response_id, (last or 0) + 1)
+
+    def _allocate_response_id(self):
+        # ids are handed out here so the voting page can link to an answer
+        # before the writer has inserted it
+        with self._lock:
+            if self._next_response_id is None:
+                last = self.db.session.execute(select(func.max(self.m.Responses.id))).scalar()
+                self._next_response_id = (last or 0) + 1
+            response_id = self._next_response_id
+            self._next_response_id += 1
+        return response_id
+
+    # recovery
+
+    def _load(self, game_id):
+        # anything still queued for this game has to land before we read it back
+        self.flush()
+        m = self.m
+        session = self.db.session
+        row = session.get(m.Game, game_id)
+        if row is None:
+            return None
+
+        game = LiveGame(row.id, row.host_id, row.code, row.round_num)
+        players = session.execute(
+            select(m.PlayerGame.user_id, m.User.display_name, m.PlayerGame.score)
+            .join(m.User, m.User.id == m.PlayerGame.user_id)
+            .where(m.PlayerGame.game_id == game_id)
+            .order_by(m.PlayerGame.id)
+        )
+        for user_id, display_name, score in players:
+            game.players[user_id] = [display_name, score or 0]
+
+        latest = session.execute(
+            select(m.GameRound).where(m.GameRound.game_id == game_id).order_by(m.GameRound.id.desc())
+        ).scalars().first()
+        if latest is not None:
+            game.round = self._load_round(latest)
+            # players may have left since, which can complete a phase
+            with game.lock:
+                while self._advance(game):
+                    pass
+        return game
+
+    def _load_round(self, row):
+        m = self.m
+        session = self.db.session
+        rnd = LiveRound(row.id, row.ingredients, row.phase or 'submit', self.near_duplicates)
+        answers = session.execute(
+            select(m.Responses.id, m.Responses.user_id, m.Responses.text, m.Responses.text_norm,
+                   m.Responses.votes)
+            .where(m.Responses.round_id == row.id)
+            .order_by(m.Responses.id)
+        )
+        for response_id, user_id, text, norm, votes in answers:
+            rnd.add_answer(response_id, user_id, text, norm or normalize(text), votes or 0)
+        votes = session.execute(
+            select(m.Vote.voter_id, m.Vote.response_id).where(m.Vote.round_id == row.id)
+        )
+        for voter_id, response_id in votes:
+            rnd.votes[voter_id] = response_id
+        return rnd
+
+
+store = GameStore()
@@ -1,21 +1,44 @@
 from flask_sqlalchemy import SQLAlchemy 
-from flask import Flask, render_template, jsonify, request, redirect, url_for, flash
+from flask import Flask, render_template, jsonify, request, redirect, url_for, flash, Response, g, session, make_response, abort
 from flask_admin import Admin
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin, LoginManager, current_user, login_required, login_user, logout_user
 from sqlalchemy import select, and_
-
-import string, random
+from sqlalchemy.exc import IntegrityError
+
+import time, json
+from functools import wraps
+
+from events import broker, stream
+from gamestate import store
+from catalog import catalog
+from auth import hasher, user_cache, HasherBusy
+import migrations
+from config import Config, configure_database
+from codes import codes, retired_code
+from reaper import reaper
+from archive import archive
+from metrics import metrics, query_budget
+from admission import admission
+from matchmaking import matchmaker, QueueFull, SEATS
+from queries import queries
+from assets import assets
+from templating import fragments
+import leaderboard
 
 
 app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
-db = SQLAlchemy(app)
+app.config.from_object(Config)
+db = SQLAlchemy()
+configure_database(app, db)
+hasher.init_app(app)
+admission.init_app(app)
+broker.init_app(app)
+assets.init_app(app)
+fragments.init_app(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
-app.secret_key = 'keep it secret, keep it safe'
 
 
 
@@ -27,10 +50,14 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
 
     def set_password(self,password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.hash(password)
 
     def verify(self, password):
-        return check_password_hash(self.password_hash, password)
+        ok, upgraded = hasher.verify(self.password_hash, password)
+        if upgraded:
+            # hash parameters changed since this one was stored
+            self.password_hash = upgraded
+        return ok
 
 
 
@@ -40,20 +67,46 @@ class Ingredients(db.Model):
     category = db.Column(db.String(64), nullable=True)
 
 
+class UserStats(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    games_played = db.Column(db.Integer, default=0, nullable=False)
+    wins = db.Column(db.Integer, default=0, nullable=False)
+    votes_received = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_user_stats_rank', 'wins', 'votes_received'),
+    )
+
+
 class Game(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     host_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     round_num = db.Column(db.Integer, default=1)
     active = db.Column(db.Boolean, default=True)
     code = db.Column(db.String(8), unique=True, nullable=False)
+    last_activity = db.Column(db.Float, default=time.time)
+
+    __table_args__ = (
+        db.Index('ix_game_active_last_activity', 'active', 'last_activity'),
+        # archived games keep their ids (see archive.py), so never reuse one
+        {'sqlite_autoincrement': True},
+    )
 
 class PlayerGame(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     game_id = db.Column(db.Integer, db.ForeignKey('game.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     score = db.Column(db.Integer, default=0)
+    # 0 to SEATS - 1, handed out by matchmaker.take_seat()
+    seat = db.Column(db.Integer)
     user = db.relationship("User")
 
+    __table_args__ = (
+        db.Index('uniq_player_per_game', 'game_id', 'user_id', unique=True),
+        db.Index('uniq_seat_per_game', 'game_id', 'seat', unique=True),
+        db.Index('ix_player_game_user_id', 'user_id'),
+    )
+
 class GameRound(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     game_id = db.Column(db.Integer, db.ForeignKey('game.id'))
@@ -61,16 +114,45 @@ class GameRound(db.Model):
     phase  = db.Column(db.String(32), default='submit')
     responses = db.relationship('Responses', backref='round', lazy=True)
 
+    __table_args__ = (
+        db.Index('ix_game_round_game_id', 'game_id', 'id'),
+    )
+
 class Responses(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     round_id = db.Column(db.Integer, db.ForeignKey('game_round.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     text = db.Column(db.String(256))
+    # gamestate.normalize(text): what duplicates are checked against
+    text_norm = db.Column(db.String(256))
     votes = db.Column(db.Integer, default=0)
     user = db.relationship("User")
 
     __table_args__ = (
+        # implied by the one below, kept because SQLite can't drop it in place
         db.UniqueConstraint('round_id', 'text', name='uniq_response_per_round'),
+        db.Index('uniq_response_norm_per_round', 'round_id', 'text_norm', unique=True),
+        db.Index('ix_responses_user_id', 'user_id'),
+    )
+
+class ArchivedGame(db.Model):
+    # where a finished game's record is in the archive
+    game_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    segment = db.Column(db.Integer, nullable=False)
+    start = db.Column(db.Integer, nullable=False)
+    length = db.Column(db.Integer, nullable=False)
+    finished_at = db.Column(db.Float)
+
+class MatchQueue(db.Model):
+    # a quick match player who's waiting (no game_id yet) or has a game they
+    # haven't picked up; only used with MATCH_BACKEND=database
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, autoincrement=False)
+    joined_at = db.Column(db.Float, nullable=False)
+    game_id = db.Column(db.Integer)
+    matched_at = db.Column(db.Float)
+
+    __table_args__ = (
+        db.Index('ix_match_queue_waiting', 'game_id', 'joined_at'),
     )
 
 class Vote(db.Model):
@@ -86,37 +168,203 @@ class Vote(db.Model):
 
     __table_args__ = (
         db.UniqueConstraint('round_id', 'voter_id', name='uniq_vote_per_round'),
+        db.Index('ix_vote_response_id', 'response_id'),
     )
 
-# generate random game codes
-def generate_code(length=6):
-    chars = string.ascii_uppercase + string.digits
-    while True:
-        code = ''.join(random.choice(chars) for _ in range(length))
-        if not Game.query.filter_by(code=code).first():
-            return code
+user_cache.init_app(app, db, User)
+store.init_app(app, db, User=User, Game=Game, PlayerGame=PlayerGame,
+               GameRound=GameRound, Responses=Responses, Vote=Vote)
+
+catalog.init_app(app, db, Ingredients, GameRound)
+
+codes.init_app(app, db, Game)
+queries.init_app(app, db, User=User, Game=Game, PlayerGame=PlayerGame, GameRound=GameRound)
+reaper.init_app(app, db, Game=Game, PlayerGame=PlayerGame, GameRound=GameRound,
+                Responses=Responses, Vote=Vote)
+matchmaker.init_app(app, db, Game=Game, PlayerGame=PlayerGame, MatchQueue=MatchQueue)
+archive.init_app(app, db, User=User, Game=Game, PlayerGame=PlayerGame, GameRound=GameRound,
+                 Responses=Responses, Vote=Vote, ArchivedGame=ArchivedGame)
+metrics.init_app(app, db)
+
+def finish_game(game_id, players):
+    # mark a game over exactly once, count it on the leaderboard in the same
+    # transaction and hand its join code back
+    game = db.session.get(Game, game_id)
+    if game is None or not game.active:
+        return False
+    code = game.code
+    finished = (
+        Game.query
+            .filter_by(id=game_id, active=True)
+            .update({'active': False, 'code': retired_code(game_id)}, synchronize_session=False)
+    )
+    if finished:
+        leaderboard.record_game(db.session, UserStats, [(p.user_id, p.score) for p in players])
+    db.session.commit()
+    if finished:
+        codes.release(code)
+    return bool(finished)
+
+def advance_round(game, current_round_id):
+    # start the round after current_round_id exactly once, no matter how many
+    # players (or workers) ask at the same time; returns the round to send the
+    # player to, or None when the game is over
+    rnd = game.round
+    if rnd is not None and (rnd.id > current_round_id or rnd.phase != 'results'):
+        return rnd.id
+    if game.round_num >= 3:
+        return None
+
+    # compare-and-swap on round_num: only one request gets the row
+    expected = game.round_num
+    won = (
+        Game.query
+            .filter_by(id=game.id, round_num=expected)
+            .update({'round_num': expected + 1}, synchronize_session=False)
+    )
+    if not won:
+        # someone else advanced it and their round is committed by now
+        db.session.rollback()
+        store.drop(game.id)
+        game = store.get(game.id)
+        return game.round.id if game and game.round else None
+
+    newround = GameRound(game_id=game.id, ingredients=", ".join(catalog.draw(game.id)), phase="submit")
+    db.session.add(newround)
+    db.session.commit()
+    store.round_started(game.id, newround.id, newround.ingredients, expected + 1)
+    broker.publish(game.id, 'round-started', round_id=newround.id)
+    return newround.id
+
+# every publish bumps the game's version, so (epoch, game, version, viewer)
+# identifies a rendered page; the broker's epoch changes whenever its sequence
+# numbers start over, so a restart can't reuse etags
+
+def etag_by_version(view):
+    @wraps(view)
+    def wrapper(game_id, *args, **kwargs):
+        etag = f"{broker.epoch}-{game_id}-{g.event_seq}-{current_user.id}"
+        # pending flashes make the page differ, so always render those
+        if etag in request.if_none_match and '_flashes' not in session:
+            resp = Response(status=304)
+            resp.set_etag(etag)
+            return resp
+
+        resp = make_response(view(game_id, *args, **kwargs))
+        if resp.status_code == 200:
+            resp.set_etag(etag)
+            resp.headers['Cache-Control'] = 'private, no-cache'
+        return resp
+    return wrapper
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.get(int(user_id))
 
 
-from flask_admin.contrib.sqla import ModelView
+from adminviews import (UserView, IngredientsView, PlayerGameView, GameRoundView, ResponsesView,
+                        LiveGamesView)
 
 
 admin = Admin(app, name='Admin View')
-admin.add_view(ModelView(User,db.session))
-admin.add_view(ModelView(Ingredients, db.session))
-admin.add_view(ModelView(PlayerGame, db.session))
-admin.add_view(ModelView(GameRound, db.session))
-admin.add_view(ModelView(Responses, db.session))
+admin.add_view(UserView(User,db.session))
+admin.add_view(IngredientsView(Ingredients, db.session))
+admin.add_view(PlayerGameView(PlayerGame, db.session))
+admin.add_view(GameRoundView(GameRound, db.session))
+admin.add_view(ResponsesView(Responses, db.session))
+admin.add_view(LiveGamesView(db, Game, GameRound, PlayerGame, name='Live Games', endpoint='livegames'))
+
+@app.before_request
+def remember_event_seq():
+    # pages pass this to /events so nothing published mid-render gets missed
+    game_id = (request.view_args or {}).get('game_id')
+    if game_id is not None:
+        if broker.shared:
+            broker.sync()
+        g.event_seq = broker.last_seq(game_id)
+
+@broker.on_remote
+def forget_remote_changes(game_id, event, data):
+    # another worker changed this game; reload it from the database next time
+    store.drop(game_id)
+    if event in ('round-started', 'game-closed'):
+        catalog.discard(game_id)
+
+@app.context_processor
+def inject_event_seq():
+    return {'event_seq': g.get('event_seq', 0)}
+
+def auth_metrics():
+    stats = hasher.stats()
+    return [
+        '# TYPE password_hashes_total counter',
+        f"password_hashes_total {stats['hashes']}",
+        '# TYPE password_hash_seconds_total counter',
+        f"password_hash_seconds_total {stats['hash_seconds_total']}",
+        '# TYPE password_hash_seconds_max gauge',
+        f"password_hash_seconds_max {stats['hash_seconds_max']}",
+        '# TYPE password_hash_queue_depth gauge',
+        f"password_hash_queue_depth {stats['queue_depth']}",
+        '# TYPE password_hash_workers gauge',
+        f"password_hash_workers {stats['workers']}",
+    ]
+
+metrics.collectors.append(auth_metrics)
+
+def fragment_metrics():
+    stats = fragments.stats()
+    return [
+        '# TYPE template_fragment_cache_hits_total counter',
+        f"template_fragment_cache_hits_total {stats['hits']}",
+        '# TYPE template_fragment_cache_misses_total counter',
+        f"template_fragment_cache_misses_total {stats['misses']}",
+        '# TYPE template_fragment_cache_entries gauge',
+        f"template_fragment_cache_entries {stats['entries']}",
+    ]
+
+metrics.collectors.append(fragment_metrics)
+
+def admission_metrics():
+    inflight, streams, shed = admission.stats()
+    lines = ['# TYPE admission_inflight gauge']
+    lines += [f'admission_inflight{{class="{cls}"}} {n}' for cls, n in sorted(inflight.items())]
+    lines += ['# TYPE admission_streams gauge', f'admission_streams {streams}',
+              '# TYPE admission_shed_total counter']
+    lines += [f'admission_shed_total{{class="{cls}"}} {n}' for cls, n in sorted(shed.items())]
+    lines += ['# TYPE poll_interval_seconds gauge', f'poll_interval_seconds {admission.poll_interval_ms() / 1000}']
+    return lines
+
+metrics.collectors.append(admission_metrics)
+
+def matchmaking_metrics():
+    stats = matchmaker.stats()
+    return [
+        '# TYPE matchmaking_waiting gauge',
+        f"matchmaking_waiting {stats['waiting']}",
+        '# TYPE matchmaking_oldest_wait_seconds gauge',
+        f"matchmaking_oldest_wait_seconds {stats['oldest_wait']}",
+        '# TYPE matchmaking_games_total counter',
+        f"matchmaking_games_total {stats['games']}",
+        '# TYPE matchmaking_players_total counter',
+        f"matchmaking_players_total {stats['players']}",
+        '# TYPE matchmaking_wait_seconds_total counter',
+        f"matchmaking_wait_seconds_total {stats['wait_seconds']}",
+    ]
+
+metrics.collectors.append(matchmaking_metrics)
+
+# @query_budget: the most SQL statements a request to the view may run (see
+# metrics.py). Game pages allow for store.get() loading the game cold (five
+# statements) and a user_cache miss on top of their own writes.
 
 @app.route('/')
+@query_budget(1)
 def index():
     return redirect(url_for('login'))
 
 
 @app.route('/login', methods=["GET","POST"])
+@query_budget(3)
 def login():
     # Already logged in
     if current_user.is_authenticated:
@@ -126,17 +374,23 @@ def login():
     if request.method == "POST":
         username = request.form.get('username')
         password = request.form.get('password')
-        print(username, password)
         user = User.query.filter_by(username=username).first()
-        if user is None or not user.verify(password):
+        try:
+            ok = user is not None and user.verify(password)
+        except HasherBusy:
+            flash('Server is busy, try again in a moment.', 'alert')
+            return redirect(url_for('login'))
+        if not ok:
             flash('Login failed, try again.', 'alert')
             return redirect(url_for('login'))
-        if user and user.verify(password):
-            login_user(user)
-            return redirect(url_for('dashboard'))
+        if db.session.is_modified(user):
+            db.session.commit()
+        login_user(user)
+        return redirect(url_for('dashboard'))
     return render_template('login.html')
 
 @app.route('/signup', methods=['GET', 'POST'])
+@query_budget(4)
 def signup():
      # If already logged in, skip signup
     if current_user.is_authenticated:
@@ -159,10 +413,15 @@ def signup():
         
         # Create user with hashed and salted password
         user = User(username=username, display_name=display_name)
-        user.set_password(password)
+        try:
+            user.set_password(password)
+        except HasherBusy:
+            flash('Server is busy, try again in a moment.', 'alert')
+            return redirect(url_for('signup'))
 
         db.session.add(user)
         db.session.commit()
+        user_cache.invalidate(user.id)
 
         flash('Account created! Please log in.', 'success')
         return redirect(url_for('login'))
@@ -170,6 +429,7 @@ def signup():
     return render_template('signup.html')
 
 @app.route('/logout')
+@query_budget(1)
 @login_required
 def logout():
     logout_user()
@@ -177,19 +437,31 @@ def logout():
     return redirect(url_for('login'))
 
 @app.route('/dashboard')
+@query_budget(1)
 @login_required
 def dashboard():
     return render_template('dashboard.html')
 
 @app.route('/creategame')
+@query_budget(7)
 @login_required
 def creategame():
-    newgame = Game(host_id = current_user.id, round_num = 1, active = True, code = generate_code())
-    # create a new game with the host being the current user who just clicked create game
-    db.session.add(newgame)
-    db.session.commit()
+    # codes are only unique per process, so another worker may have just
+    # taken this one; the unique index catches that and we draw again
+    for _ in range(5):
+        newgame = Game(host_id = current_user.id, round_num = 1, active = True, code = codes.allocate())
+        # create a new game with the host being the current user who just clicked create game
+        db.session.add(newgame)
+        try:
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+    else:
+        flash("Couldn't create a game, try again.", "alert")
+        return redirect(url_for('dashboard'))
 
-    gamehost = PlayerGame(game_id = newgame.id, user_id = current_user.id, score=0)
+    gamehost = PlayerGame(game_id = newgame.id, user_id = current_user.id, score=0, seat=0)
     # add the user to the game setting the game id and the user id to the current user, also setting their score to be 0
     db.session.add(gamehost)
     db.session.commit()
@@ -198,40 +470,33 @@ def creategame():
     # put user into the lobby until the user is ready to start the game
 
 @app.route('/gamelobby/<int:game_id>')
+@query_budget(2)
+@admission.poll
 @login_required
+@etag_by_version
 def lobby(game_id):
 
-    game = Game.query.get(game_id)
-    if not game:
+    page = queries.lobby(game_id, current_user.id)
+    if page is None or not page.is_member:
         return redirect(url_for('dashboard'))
 
-    pg = PlayerGame.query.filter_by(game_id=game_id, user_id=current_user.id).first()
-    if not pg:
-        return redirect(url_for('dashboard'))
-
-    round_started = GameRound.query.filter_by(game_id=game_id).first()
-    if round_started:
+    if page.round_id:
         return redirect(url_for(
             "actualgame",
             game_id=game_id,
-            round_id=round_started.id
+            round_id=page.round_id
         ))
 
-    allplayers = (
-        User.query
-            .join(PlayerGame, PlayerGame.user_id == User.id)
-            .filter(PlayerGame.game_id == game_id)
-            .all()
-    )
     return render_template(
         'gamelobby.html',
         game_id=game_id,
-        game_code=game.code,
-        allplayers=allplayers,
-        host_id=game.host_id
+        game_code=page.code,
+        allplayers=page.players,
+        host_id=page.host_id
     )
 
 @app.route('/joingame', methods=['POST'])
+@query_budget(2)
 @login_required
 def joingamepost():
     game_code = request.form.get('game_code')
@@ -248,35 +513,73 @@ def joingamepost():
     return redirect(url_for('joingame', game_id = game.id))
 
 @app.route('/joingame/<int:game_id>')
+@query_budget(5)
 @login_required
 def joingame(game_id):
-    game = Game.query.get(game_id)
+    game = queries.join_check(game_id, current_user.id)
    
     if not game:
         flash('Error: Invalid code, try again', 'alert')
         return redirect(url_for('dashboard'))
     # check to see if the lobby for the game exists 
+
+    if not game.active:
+        flash('That game has already ended.', 'alert')
+        return redirect(url_for('dashboard'))
     
-    repeatplayer = PlayerGame.query.filter_by(game_id = game_id, user_id = current_user.id).first()
-    if repeatplayer:
+    if game.is_member:
         flash("YOU ARE ALREADY IN THE GAME!!!!!!", 'alert')
         return redirect(url_for('dashboard'))
 
-    limitplayers = PlayerGame.query.filter_by(game_id = game_id).all()
-    if len(limitplayers) >= 4:
+    if game.players >= SEATS:
         flash("THIS GAME IS FULL LIL BRO", "alert")
         return redirect(url_for('dashboard'))
     
 
 
-    newplayer = PlayerGame(game_id = game_id, user_id = current_user.id, score = 0)
-    # create a new player by adding them to the game lobby and set the score = 0
-    db.session.add(newplayer)
-    db.session.commit()
+    # the check above is only a shortcut; take_seat() is what keeps a game
+    # from filling past SEATS when several people join at once
+    if not matchmaker.take_seat(game_id, current_user.id):
+        if queries.is_member(game_id, current_user.id):
+            return redirect(url_for('lobby', game_id = game_id))
+        flash("THIS GAME IS FULL LIL BRO", "alert")
+        return redirect(url_for('dashboard'))
+    store.drop(game_id)
+    broker.publish(game_id, 'player-joined', user_id=current_user.id)
 
     return redirect(url_for('lobby', game_id = game_id))
 
+@app.route('/quickmatch', methods=['POST'])
+@query_budget(3)
+@login_required
+def quickmatch_join():
+    try:
+        matchmaker.join(current_user.id)
+    except QueueFull:
+        flash('Quick match is full right now, try again in a moment.', 'alert')
+        return redirect(url_for('dashboard'))
+    return redirect(url_for('quickmatch'))
+
+@app.route('/quickmatch')
+@query_budget(3)
+@login_required
+def quickmatch():
+    game_id = matchmaker.status(current_user.id)
+    if game_id is None:
+        return redirect(url_for('dashboard'))
+    if game_id is not True:
+        return redirect(url_for('lobby', game_id = game_id))
+    return render_template('quickmatch.html', max_wait=matchmaker.max_wait)
+
+@app.route('/quickmatch/cancel', methods=['POST'])
+@query_budget(2)
+@login_required
+def quickmatch_cancel():
+    matchmaker.leave(current_user.id)
+    return redirect(url_for('dashboard'))
+
 @app.route('/leavegame/<int:game_id>')
+@query_budget(12)
 @login_required
 def leavegame(game_id):
     game = Game.query.get(game_id)
@@ -284,39 +587,26 @@ def leavegame(game_id):
         flash("Game not found.", "alert")
         return redirect(url_for('dashboard'))
 
- 
+    if current_user.id == game.host_id:
+        reaper.delete_games([game_id])
+        return redirect(url_for('dashboard'))
+
     pg = PlayerGame.query.filter_by(game_id=game_id, user_id=current_user.id).first()
     if pg is not None:
         db.session.delete(pg)
-
- 
-    if current_user.id == game.host_id:
-        rounds = GameRound.query.filter_by(game_id=game_id).all()
-        round_ids = [r.id for r in rounds]
-        for r in rounds:
-            Responses.query.filter_by(round_id=r.id).delete()
-
-        Vote.query.filter(Vote.round_id.in_(round_ids)).delete(synchronize_session=False)
-        GameRound.query.filter_by(game_id=game_id).delete()
-        PlayerGame.query.filter_by(game_id=game_id).delete()
-        db.session.delete(game)
-
         db.session.commit()
-        return redirect(url_for('dashboard'))
-
 
     remaining = PlayerGame.query.filter_by(game_id=game_id).count()
     if remaining == 0:
-        rounds = GameRound.query.filter_by(game_id=game_id).all()
-        for r in rounds:
-            Responses.query.filter_by(round_id=r.id).delete()
-        GameRound.query.filter_by(game_id=game_id).delete()
-        db.session.delete(game)
+        reaper.delete_games([game_id])
+        return redirect(url_for('dashboard'))
 
-    db.session.commit()
+    store.drop(game_id)
+    broker.publish(game_id, 'player-left', user_id=current_user.id)
     return redirect(url_for('dashboard'))
 
 @app.route('/kickplayer/<int:game_id>/<int:user_id>')
+@query_budget(5)
 @login_required
 def kickplayer(game_id, user_id):
     game = Game.query.get(game_id)
@@ -337,10 +627,33 @@ def kickplayer(game_id, user_id):
 
     db.session.delete(pg)
     db.session.commit()
+    store.drop(game_id)
+    broker.publish(game_id, 'player-kicked', user_id=user_id)
     return redirect(url_for('lobby', game_id=game_id))
 
 
+@app.route('/events/<int:game_id>')
+@query_budget(2)
+@login_required
+def events(game_id):
+    if not queries.is_member(game_id, current_user.id):
+        return ('', 204)
+    if not admission.open_stream():
+        return admission.busy()
+
+    # EventSource sends Last-Event-ID on reconnect, pages send ?since= on first connect
+    last_seq = request.headers.get('Last-Event-ID', type=int)
+    if last_seq is None:
+        last_seq = request.args.get('since', 0, type=int)
+
+    return Response(
+        admission.streaming(stream(broker, game_id, last_seq, retry_ms=admission.poll_interval_ms())),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/startgame/<int:game_id>')
+@query_budget(6)
 @login_required
 
 def startgame(game_id):
@@ -355,45 +668,45 @@ def startgame(game_id):
         flash("Only host can start game !!", "alert")
         return redirect(url_for('lobby', game_id=game_id))
     
-    from random import sample
-    ingredientslist = Ingredients.query.all()
-    pickingredient = sample(ingredientslist, 3)
-    ingredientpicked = ", ".join([i.name for i in pickingredient])
+    catalog.new_deck(game_id)
+    ingredientpicked = ", ".join(catalog.draw(game_id))
 
     round = GameRound(game_id = game_id, ingredients = ingredientpicked, phase = "submit")
 
     db.session.add(round)
     db.session.commit()
+    store.round_started(game_id, round.id, round.ingredients, game.round_num)
+    broker.publish(game_id, 'round-started', round_id=round.id)
 
     return redirect(url_for('actualgame', game_id = game_id, round_id = round.id))
 
 @app.route('/game/<int:game_id>/<int:round_id>')
+@query_budget(2)
 @login_required
 def actualgame(game_id, round_id):
 
-    game = Game.query.get(game_id)
-    if not game:
+    page = queries.round_page(game_id, round_id, current_user.id)
+    if not page:
         flash("This game no longer exists.", "warning")
         return redirect(url_for('dashboard'))
 
-    pg = PlayerGame.query.filter_by(game_id=game_id, user_id=current_user.id).first()
-    if not pg:
+    if not page.is_member:
         flash("You are no longer in this game.", "warning")
         return redirect(url_for('dashboard'))
 
-    round_obj = GameRound.query.get_or_404(round_id)
-    if round_obj.game_id != game_id:
-        flash("Round does not belong to this game.", "alert")
-        return redirect(url_for("dashboard"))
+    # missing, or a round of some other game
+    if page.round is None:
+        abort(404)
 
     return render_template(
         'actualgame.html',
         game_id=game_id,
-        round=round_obj
+        round=page.round
     )
     
 
 @app.route('/submitanswer/<int:game_id>/<int:round_id>', methods=["POST"])
+@query_budget(12)
 @login_required
 
 def submitanswer(game_id, round_id):
@@ -403,34 +716,56 @@ def submitanswer(game_id, round_id):
         flash("Invalid answer, please try again!", "alert")
         return redirect(url_for('actualgame', game_id = game_id, round_id = round_id))
     
-    answer_norm = " ".join(answer.strip().lower().split())
-    existing = Responses.query.filter_by(round_id=round_id, text=answer_norm).first()
+    game = store.get(game_id)
+    if game is None:
+        flash("This game no longer exists.", "warning")
+        return redirect(url_for('dashboard'))
+
+    response_id, status = store.submit(game, round_id, current_user.id, answer)
 
-    if existing:
+    if status == 'duplicate':
         flash("This answer has already been submitted, please try again!", "alert")
         return redirect(url_for('actualgame', game_id = game_id, round_id = round_id))
-    
-    new_answers = Responses(round_id = round_id, user_id = current_user.id, text = answer, votes = 0)
-    db.session.add(new_answers)
-    db.session.commit()     
+
+    if status == 'similar':
+        flash("Someone already submitted an answer too close to that one, please try another!", "alert")
+        return redirect(url_for('actualgame', game_id = game_id, round_id = round_id))
+
+    if status == 'closed':
+        flash("Answers are closed for this round.", "alert")
+        return redirect(url_for('votingwait', game_id = game_id, round_id = round_id))
+
+    if status == 'stale':
+        if game.round is None:
+            return redirect(url_for('lobby', game_id = game_id))
+        flash("That round is over.", "alert")
+        return redirect(url_for('actualgame', game_id = game_id, round_id = game.round.id))
+
+    broker.publish(game_id, 'answer-submitted', round_id=round_id)
 
     return redirect(url_for('votingwait', game_id = game_id, round_id = round_id))
 
 
 @app.route('/votingwait/<int:game_id>/<int:round_id>')
+@query_budget(6)
+@admission.poll
 @login_required
+@etag_by_version
 def votingwait(game_id, round_id):
-    players = PlayerGame.query.filter_by(game_id=game_id).all()
-    responses = Responses.query.filter_by(round_id=round_id).all()
-
-    if len(players) == 0:
+    game = store.get(game_id)
+    if game is None or not game.players:
         flash("No players found for this game.", "alert")
         return redirect(url_for("dashboard"))
 
-
-    if len(responses) >= len(players):
+    rnd = store.round(game, round_id)
+    if rnd is None:
+        abort(404)
+    if rnd.phase != 'submit':
         return redirect(url_for('voting', game_id=game_id, round_id=round_id))
 
+    players = game.player_list()
+    responses = rnd.answer_list()
+
     return render_template(
         'votingwait.html',
         game_id=game_id,
@@ -440,19 +775,25 @@ def votingwait(game_id, round_id):
     )
 
 @app.route('/votingwait_votes/<int:game_id>/<int:round_id>')
+@query_budget(6)
+@admission.poll
 @login_required
+@etag_by_version
 def votingwait_votes(game_id, round_id):
-    players = PlayerGame.query.filter_by(game_id=game_id).all()
-    vote_count = Vote.query.filter_by(round_id=round_id).count()
-
-    if len(players) == 0:
+    game = store.get(game_id)
+    if game is None or not game.players:
         flash("No players found for this game.", "alert")
         return redirect(url_for("dashboard"))
 
- 
-    if vote_count >= len(players):
+    rnd = store.round(game, round_id)
+    if rnd is None:
+        abort(404)
+    if rnd.phase == 'results':
         return redirect(url_for('endround', game_id=game_id, round_id=round_id))
 
+    players = game.player_list()
+    vote_count = len(rnd.votes)
+
     return render_template(
         'votingwait_votes.html',
         game_id=game_id,
@@ -463,81 +804,77 @@ def votingwait_votes(game_id, round_id):
     )
 
 @app.route('/continue/<int:game_id>/<int:current_round_id>')
+@query_budget(9)
 @login_required
 def continue_round(game_id, current_round_id):
-    game = Game.query.get_or_404(game_id)
-
-
-    next_round = (
-        GameRound.query
-        .filter(GameRound.game_id == game_id, GameRound.id > current_round_id)
-        .order_by(GameRound.id.asc())
-        .first()
-    )
-    if next_round:
-        return redirect(url_for('actualgame', game_id=game_id, round_id=next_round.id))
+    game = store.get(game_id)
+    if game is None:
+        abort(404)
 
- 
-    if game.round_num >= 3:
+    next_round_id = advance_round(game, current_round_id)
+    if next_round_id is None:
         return redirect(url_for('winner', game_id=game_id))
 
-    game.round_num += 1
-
-    from random import sample
-    ingredientslist = Ingredients.query.all()
-    ingredientpicked = ", ".join(i.name for i in sample(ingredientslist, 3))
-
-    newround = GameRound(game_id=game_id, ingredients=ingredientpicked, phase="submit")
-    db.session.add(newround)
-    db.session.commit()
-
-    latest = GameRound.query.filter_by(game_id=game_id).order_by(GameRound.id.desc()).first()
-    return redirect(url_for('actualgame', game_id=game_id, round_id=newround.id))
+    return redirect(url_for('actualgame', game_id=game_id, round_id=next_round_id))
 
 @app.route('/voting/<int:game_id>/<int:round_id>')
+@query_budget(6)
 @login_required
+@etag_by_version
 
 def voting(game_id, round_id):
-    round = GameRound.query.get(round_id)
-    responses = Responses.query.filter_by(round_id = round_id).all()
+    game = store.get(game_id)
+    rnd = store.round(game, round_id) if game else None
+    responses = rnd.answer_list() if rnd else []
 
     return render_template('voting.html', game_id = game_id, round_id = round_id, responses = responses)
 
 
 @app.route('/addvote/<int:game_id>/<int:round_id>/<int:response_id>', methods = ["POST"])
+@query_budget(14)
 @login_required
 def addvote(game_id, round_id, response_id):
-    resp = Responses.query.get_or_404(response_id)
+    game = store.get(game_id)
+    if game is None:
+        abort(404)
+
+    status = store.vote(game, round_id, current_user.id, response_id)
 
+    if status == 'missing':
+        abort(404)
 
-    if resp.user_id == current_user.id:
+    if status == 'own':
         flash("You cannot vote for your own answer!!", "alert")
         return redirect(url_for('voting', game_id=game_id, round_id=round_id))
 
-    existing = Vote.query.filter_by(round_id=round_id, voter_id=current_user.id).first()
-    if existing:
+    if status == 'duplicate':
         flash("You already voted this round.", "alert")
         return redirect(url_for('votingwait_votes', game_id=game_id, round_id=round_id))
 
+    if status == 'stale':
+        flash("That round is over.", "alert")
+        return redirect(url_for('votingwait_votes', game_id=game_id, round_id=round_id))
 
-    db.session.add(Vote(round_id=round_id, voter_id=current_user.id, response_id=response_id))
-
-
-    resp.votes += 1
-    scorer = PlayerGame.query.filter_by(game_id=game_id, user_id=resp.user_id).first()
-    if scorer:
-        scorer.score += 1
+    if status == 'closed':
+        if game.round.phase == 'submit':
+            flash("Voting hasn't started yet.", "alert")
+            return redirect(url_for('votingwait', game_id=game_id, round_id=round_id))
+        flash("Voting is over for this round.", "alert")
+        return redirect(url_for('votingwait_votes', game_id=game_id, round_id=round_id))
 
-    db.session.commit()
+    broker.publish(game_id, 'vote-cast', round_id=round_id)
 
     return redirect(url_for('votingwait_votes', game_id=game_id, round_id=round_id))
 
 
 
 @app.route('/endround/<int:game_id>/<int:round_id>')
+@query_budget(6)
 @login_required
 def endround(game_id, round_id):
-    game = Game.query.get_or_404(game_id)
+    game = store.get(game_id)
+    if game is None:
+        abort(404)
 
 
     if game.round_num >= 3:
@@ -547,10 +884,14 @@ def endround(game_id, round_id):
     return redirect(url_for('roundresults', game_id=game_id, round_id=round_id))
 
 @app.route('/roundresults/<int:game_id>/<int:round_id>')
+@query_budget(6)
 @login_required
+@etag_by_version
 def roundresults(game_id, round_id):
-    game = Game.query.get_or_404(game_id)
-    players = PlayerGame.query.filter_by(game_id = game_id).order_by(PlayerGame.score.desc()).all()
+    game = store.get(game_id)
+    if game is None:
+        abort(404)
+    players = game.player_list()
 
     return render_template(
         "roundresults.html",
@@ -562,33 +903,85 @@ def roundresults(game_id, round_id):
 
 
 @app.route('/winner/<int:game_id>')
+@query_budget(10)
 @login_required
 def winner(game_id):
-    players = PlayerGame.query.filter_by(game_id = game_id).order_by(PlayerGame.score.desc()).all()
-
-    if not players:
+    game = store.get(game_id)
+    if game is None or current_user.id not in game.players:
         return redirect(url_for('dashboard'))
-    
-    winner = max(players, key=lambda p:p.score)
+
+    # only the last round's results end the game
+    rnd = game.round
+    if rnd is None or game.round_num < 3 or rnd.phase != 'results':
+        if rnd is None:
+            return redirect(url_for('lobby', game_id=game_id))
+        return redirect(url_for('actualgame', game_id=game_id, round_id=rnd.id))
+
+    # player_list() is already sorted by score
+    players = game.player_list()
+    winner = players[0]
+    # a no-op for everyone after the first
+    finish_game(game_id, players)
 
     return render_template("winner.html", winner = winner, highestscore = winner.score, players = players)
 
-@app.route('/waitround/<int:game_id>')
+@app.route('/leaderboard')
+@query_budget(2)
 @login_required
-def waitround(game_id):
-    game = Game.query.get_or_404(game_id)
+def leaderboard_page():
+    page = max(request.args.get('page', 1, type=int), 1)
+    rows, has_next = leaderboard.page(db.session, UserStats, User, page)
+    return render_template('leaderboard.html', rows=rows, page=page, has_next=has_next, per_page=25)
+
+@app.route('/api/leaderboard')
+@query_budget(1)
+def leaderboard_api():
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 25, type=int), 1), 100)
+    rows, has_next = leaderboard.page(db.session, UserStats, User, page, per_page)
+    return jsonify(
+        page=page,
+        per_page=per_page,
+        has_next=has_next,
+        players=[
+            {'user_id': r.user_id, 'display_name': r.display_name, 'wins': r.wins,
+             'votes_received': r.votes_received, 'games_played': r.games_played}
+            for r in rows
+        ]
+    )
 
-    game.round_num += 1
+@app.route('/api/games/<int:game_id>/history')
+@query_budget(7)
+@login_required
+def game_history(game_id):
+    # a finished game, archived or not, as JSON lines; the record is read
+    # with the first event, the rest is built from it
+    replay = archive.replay(game_id)
+    first = next(replay, None)
+    if first is None:
+        abort(404)
 
-    from random import sample
-    ingredientslist = Ingredients.query.all()
-    ingredientpicked = ", ".join(i.name for i in sample(ingredientslist, 3))
+    def lines():
+        yield json.dumps(first) + '\n'
+        for event in replay:
+            yield json.dumps(event) + '\n'
 
-    newround = GameRound(game_id=game_id, ingredients=ingredientpicked)
-    db.session.add(newround)
-    db.session.commit()
+    return Response(lines(), mimetype='application/x-ndjson')
+
+@app.route('/waitround/<int:game_id>')
+@query_budget(6)
+@admission.poll
+@login_required
+def waitround(game_id):
+    game = store.get(game_id)
+    if game is None or game.round is None:
+        abort(404)
+
+    next_round_id = advance_round(game, game.round.id)
+    if next_round_id is None:
+        return redirect(url_for('winner', game_id=game_id))
 
-    return redirect(url_for('actualgame', game_id=game_id, round_id=newround.id))
+    return redirect(url_for('actualgame', game_id=game_id, round_id=next_round_id))
 
 
 
@@ -596,4 +989,7 @@ def waitround(game_id):
 
     
 if __name__ == '__main__':
+    # development server; serve.py runs the app with several worker processes
+    with app.app_context():
+        migrations.upgrade(db.engine)
     app.run(debug=True)
@@ -1,135 +1,33 @@
-from hello import app, db, User, Ingredients
-from werkzeug.security import generate_password_hash, check_password_hash
-
-with app.app_context():
-    db.drop_all()
-    db.create_all()
-
-    # Users
-    Steven = User(username = "Steven10", display_name="Steven", password_hash=generate_password_hash("Steven123"))
-    db.session.add(Steven)
-    db.session.commit()
-
-    Max = User(username = "Max10", display_name="Max", password_hash=generate_password_hash("Max123"))
-    db.session.add(Max)
-    db.session.commit()
-
-    Ian = User(username = "Ian10", display_name="Ian", password_hash=generate_password_hash("Ian123"))
-    db.session.add(Ian)
-    db.session.commit()
-
-    Chris = User(username = "Chris10", display_name="Chris", password_hash=generate_password_hash("Chris123"))
-    db.session.add(Chris)
-    db.session.commit()
-
-
-    # Ingredients
-    
-
-    # Veggies
-    Carrot = Ingredients(name = "Carrot", category = "Vegetables")
-    db.session.add(Carrot)
-    db.session.commit()
-
-    Onions = Ingredients(name = "Onions", category = "Vegetables")
-    db.session.add(Onions)
-    db.session.commit()
-
-    Spinach = Ingredients(name = "Spinach", category = "Vegetables")
-    db.session.add(Spinach)
-    db.session.commit()
-
-    Potato = Ingredients(name = "Potato", category = "Vegetables")
-    db.session.add(Potato)
-    db.session.commit()
-
-    Beans = Ingredients(name = "Beans", category = "Vegetables")
-    db.session.add(Beans)
-    db.session.commit()
-
-    Broccoli = Ingredients(name = "Broccoli", category = "Vegetables")
-    db.session.add(Broccoli)
-    db.session.commit()
-
-    Eggplant = Ingredients(name = "Eggplant", category = "Vegetables")
-    db.session.add(Eggplant)
-    db.session.commit()
-
-
-    Corn = Ingredients(name = "Corn", category = "Vegetables")
-    db.session.add(Corn)
-    db.session.commit()
-
-    Yams = Ingredients(name = "Yams", category = "Vegetables")
-    db.session.add(Yams)
-    db.session.commit()
-
-    #  Meats
-    Beef = Ingredients(name = "Beef", category = "Meats")
-    db.session.add(Beef)
-    db.session.commit()
-
-    Chicken = Ingredients(name = "Chicken", category = "Meats")
-    db.session.add(Chicken)
-    db.session.commit()
-
-    Pork = Ingredients(name = "Pork", category = "Meats")
-    db.session.add(Pork)
-    db.session.commit()
-
-    Ham = Ingredients(name = "Ham", category = "Meats")
-    db.session.add(Ham)
-    db.session.commit()
-
-    Turkey = Ingredients(name = "Turkey", category = "Meats")
-    db.session.add(Turkey)
-    db.session.commit()
-
-    Bacon = Ingredients(name = "Bacon", category = "Meats")
-    db.session.add(Bacon)
-    db.session.commit()
-
-    Lamb = Ingredients(name = "Lamb", category = "Meats")
-    db.session.add(Lamb)
-    db.session.commit()
-
-    Tuna = Ingredients(name = "Tuna", category = "Meats")
-    db.session.add(Tuna)
-    db.session.commit()
-
-    Samon = Ingredients(name = "Salmon", category = "Meats")
-    db.session.add(Samon)
-    db.session.commit()
-
-
-    
-
+from hello import app, db
+import migrations
+import loader
+
+USERS = [
+    {'username': "Steven10", 'display_name': "Steven", 'password': "Steven123"},
+    {'username': "Max10", 'display_name': "Max", 'password': "Max123"},
+    {'username': "Ian10", 'display_name': "Ian", 'password': "Ian123"},
+    {'username': "Chris10", 'display_name': "Chris", 'password': "Chris123"},
+]
+
+INGREDIENTS = {
+    "Vegetables": ["Carrot", "Onions", "Spinach", "Potato", "Beans", "Broccoli", "Eggplant", "Corn", "Yams"],
+    "Meats": ["Beef", "Chicken", "Pork", "Ham", "Turkey", "Bacon", "Lamb", "Tuna", "Salmon"],
     # Extra stuff idk lol
-
-    Cheese = Ingredients(name = "Cheese", category = "Extra")
-    db.session.add(Cheese)
-    db.session.commit()
-
-    Bread = Ingredients(name = "Bread", category = "Extra")
-    db.session.add(Bread)
-    db.session.commit()
-
-    Tortilla = Ingredients(name = "Tortilla", category = "Extra")
-    db.session.add(Tortilla)
-    db.session.commit()
-
-    Noodles = Ingredients(name = "Noodles", category = "Extra")
-    db.session.add(Noodles)
-    db.session.commit()
-
-
-
-
-
-
-
-
-
-
-    
-    
+    "Extra": ["Cheese", "Bread", "Tortilla", "Noodles"],
+}
+
+# guarded so hash worker processes that re-import this module don't rebuild the database
+if __name__ == '__main__':
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        migrations.stamp(db.engine)
+
+        # one transaction; bigger catalogs go through `python loader.py ingredients`
+        with db.engine.begin() as conn:
+            tables = db.metadata.tables
+            loader.load_users(conn, tables, USERS, app.config['PASSWORD_HASH_METHOD'], hash_workers=len(USERS))
+            loader.load_ingredients(conn, tables, (
+                {'name': name, 'category': category}
+                for category, names in INGREDIENTS.items() for name in names
+            ))
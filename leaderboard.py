@@ -0,0 +1,128 @@
+"""Cross-game leaderboard.
+
+user_stats holds one row per player with running totals. finish_game() adds a
+game's results in the same transaction that marks it inactive, so each game is
+counted exactly once and the leaderboard page is a plain indexed read. Games
+of fewer than MIN_PLAYERS don't count. To rebuild the table from the finished
+games still in player_game plus the ones the reaper archived, run
+
+    python leaderboard.py rebuild
+"""
+from sqlalchemy import select, text
+
+MIN_PLAYERS = 2
+
+
+def record_game(session, UserStats, players):
+    # players: (user_id, score) for everyone in the finished game
+    if len(players) < MIN_PLAYERS:
+        return
+    top = max(score for _, score in players)
+    # an upsert, so two finishing games that share a new player can't both
+    # try to insert their row
+    if session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    table = UserStats.__table__
+    stmt = insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id],
+        set_={
+            'games_played': table.c.games_played + stmt.excluded.games_played,
+            'wins': table.c.wins + stmt.excluded.wins,
+            'votes_received': table.c.votes_received + stmt.excluded.votes_received,
+        },
+    )
+    session.execute(stmt, [
+        {'user_id': user_id, 'games_played': 1, 'wins': 1 if score == top else 0, 'votes_received': score}
+        for user_id, score in players
+    ])
+
+
+def page(session, UserStats, User, page=1, per_page=25):
+    rows = session.execute(
+        select(
+            UserStats.user_id, User.display_name, UserStats.wins,
+            UserStats.votes_received, UserStats.games_played,
+        )
+        .join(User, User.id == UserStats.user_id)
+        .order_by(UserStats.wins.desc(), UserStats.votes_received.desc(), UserStats.user_id)
+        .limit(per_page + 1)
+        .offset((page - 1) * per_page)
+    ).all()
+    # one extra row tells us whether there's a next page without a COUNT(*)
+    return rows[:per_page], len(rows) > per_page
+
+
+# totals for the finished games from :first_game on, one row per player who
+# isn't on the leaderboard yet
+_TOTALS = text(
+    "INSERT INTO user_stats (user_id, games_played, wins, votes_received) "
+    "SELECT pg.user_id, COUNT(*), "
+    "       SUM(CASE WHEN pg.score = top.best THEN 1 ELSE 0 END), "
+    "       SUM(COALESCE(pg.score, 0)) "
+    "FROM player_game pg "
+    "JOIN game g ON g.id = pg.game_id AND NOT g.active "
+    "JOIN (SELECT game_id, MAX(score) AS best FROM player_game WHERE game_id >= :first_game"
+    "      GROUP BY game_id HAVING COUNT(*) >= :min_players) top "
+    "  ON top.game_id = pg.game_id "
+    "WHERE NOT EXISTS (SELECT 1 FROM user_stats s WHERE s.user_id = pg.user_id) "
+    "GROUP BY pg.user_id"
+)
+
+
+def record_new_players(conn, first_game):
+    """Adds the finished games from `first_game` on to user_stats, for
+    players who aren't on it yet (loader.py's synthetic games only seat the
+    users it just made)."""
+    conn.execute(_TOTALS, {'first_game': first_game, 'min_players': MIN_PLAYERS})
+
+
+def rebuild(conn, archived=()):
+    """Recomputes user_stats from the finished games in player_game and
+    `archived`, archive records of the games that have been deleted from it
+    (archive.scan()). Works on a Session or a Connection; the caller commits."""
+    conn.execute(text("DELETE FROM user_stats"))
+    conn.execute(_TOTALS, {'first_game': 0, 'min_players': MIN_PLAYERS})
+
+    totals = {}   # user id -> [games_played, wins, votes_received]
+    for record in archived:
+        players = [(uid, score or 0) for uid, _, score in record['players'] if uid is not None]
+        if len(players) < MIN_PLAYERS:
+            continue
+        top = max(score for _, score in players)
+        for user_id, score in players:
+            t = totals.setdefault(user_id, [0, 0, 0])
+            t[0] += 1
+            t[1] += score == top
+            t[2] += score
+    if not totals:
+        return
+    existing = set(conn.execute(text("SELECT user_id FROM user_stats")).scalars())
+    rows = [{'user_id': uid, 'games': t[0], 'wins': t[1], 'votes': t[2]} for uid, t in totals.items()]
+    added = [row for row in rows if row['user_id'] in existing]
+    new = [row for row in rows if row['user_id'] not in existing]
+    if added:
+        conn.execute(text(
+            "UPDATE user_stats SET games_played = games_played + :games, wins = wins + :wins, "
+            "votes_received = votes_received + :votes WHERE user_id = :user_id"
+        ), added)
+    if new:
+        conn.execute(text(
+            "INSERT INTO user_stats (user_id, games_played, wins, votes_received) "
+            "VALUES (:user_id, :games, :wins, :votes)"
+        ), new)
+
+
+if __name__ == '__main__':
+    import sys
+    from hello import app, archive, db
+
+    if sys.argv[1:] != ['rebuild']:
+        sys.exit("usage: python leaderboard.py rebuild")
+    with app.app_context():
+        rebuild(db.session, archive.scan())
+        db.session.commit()
+        count = db.session.execute(text("SELECT COUNT(*) FROM user_stats")).scalar()
+    print(f"rebuilt stats for {count} players")
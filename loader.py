@@ -0,0 +1,322 @@
+"""Bulk data loading.
+
+    python loader.py ingredients catalog.csv          # name,category
+    python loader.py users people.jsonl --hash-workers 4
+    python loader.py synthetic --users 1000000 --games 250000
+
+Input files are streamed, never read whole: CSV with a header row, JSON Lines,
+or a JSON array of objects (the format follows the extension, or --format).
+Rows go in with executemany-style batched inserts, all inside one transaction
+per command, so a failed load leaves nothing behind. Ingredients and users
+that already exist (same name / username) are skipped.
+
+User rows carry either a `password_hash` or a plain `password`; plain ones are
+hashed with PASSWORD_HASH_METHOD, on --hash-workers processes when that's more
+than 0.
+
+`synthetic` appends finished games for load testing: users, games, players,
+rounds, answers and votes with consistent vote counts and scores, and adds
+them to the leaderboard. Every synthetic user's password is --password, hashed
+once. The games are stamped as just finished, and the reaper archives and
+deletes finished games FINISHED_GAME_TTL seconds later; run the server with
+REAPER_INTERVAL=0 (or a long FINISHED_GAME_TTL) to keep them in the live
+tables while testing.
+"""
+import csv
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from sqlalchemy import func, insert, select, text
+from werkzeug.security import generate_password_hash
+
+import leaderboard
+from codes import retired_code
+
+BATCH_SIZE = 5000
+
+
+# reading
+
+def read_rows(path, fmt=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt == 'csv':
+        with open(path, newline='', encoding='utf-8') as f:
+            yield from csv.DictReader(f)
+    elif fmt in ('jsonl', 'ndjson'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    elif fmt == 'json':
+        with open(path, encoding='utf-8') as f:
+            yield from _json_array(f)
+    else:
+        raise ValueError(f"don't know how to read {path!r} (use --format csv, json or jsonl)")
+
+
+def _json_array(f, chunk_size=1 << 16):
+    # decode one object at a time out of a top-level array
+    decoder = json.JSONDecoder()
+    buf = f.read(chunk_size).lstrip()
+    if not buf.startswith('['):
+        raise ValueError("expected a JSON array")
+    buf = buf[1:]
+    while True:
+        buf = buf.lstrip().lstrip(',').lstrip()
+        if buf.startswith(']'):
+            return
+        try:
+            obj, end = decoder.raw_decode(buf)
+        except json.JSONDecodeError:
+            more = f.read(chunk_size)
+            if not more:
+                raise
+            buf += more
+            continue
+        yield obj
+        buf = buf[end:]
+        if len(buf) < chunk_size:
+            buf += f.read(chunk_size)
+
+
+def batched(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+# inserting
+
+def insert_ignore(conn, table):
+    # skip rows that hit a unique constraint
+    stmt = insert(table)
+    if conn.dialect.name == 'sqlite':
+        return stmt.prefix_with('OR IGNORE')
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        return pg_insert(table).on_conflict_do_nothing()
+    return stmt
+
+
+def load_ingredients(conn, tables, rows, batch_size=BATCH_SIZE):
+    table = tables['ingredients']
+    stmt = insert_ignore(conn, table)
+    count = 0
+    for batch in batched(rows, batch_size):
+        conn.execute(stmt, [
+            {'name': row['name'].strip(), 'category': (row.get('category') or '').strip() or None}
+            for row in batch
+        ])
+        count += len(batch)
+    return count
+
+
+def _hash(method, password):
+    return generate_password_hash(password, method)
+
+
+def load_users(conn, tables, rows, method, hash_workers=0, batch_size=BATCH_SIZE):
+    table = tables['user']
+    stmt = insert_ignore(conn, table)
+    pool = ProcessPoolExecutor(hash_workers) if hash_workers > 0 else None
+    count = 0
+    try:
+        for batch in batched(rows, batch_size):
+            plain = [row for row in batch if not row.get('password_hash')]
+            if plain:
+                passwords = [row['password'] for row in plain]
+                hasher = partial(_hash, method)
+                hashes = pool.map(hasher, passwords, chunksize=16) if pool else map(hasher, passwords)
+                for row, password_hash in zip(plain, hashes):
+                    row['password_hash'] = password_hash
+            conn.execute(stmt, [
+                {'username': row['username'],
+                 'display_name': row.get('display_name') or row['username'],
+                 'password_hash': row['password_hash']}
+                for row in batch
+            ])
+            count += len(batch)
+    finally:
+        if pool:
+            pool.shutdown()
+    return count
+
+
+# synthetic data
+
+def _next_id(conn, table):
+    return (conn.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+
+
+def _next_game_id(conn, tables):
+    # past every id ever handed out, not just the live ones: the reaper
+    # deletes archived games and their ids must never come back
+    used = [
+        conn.execute(select(func.max(tables['game'].c.id))).scalar(),
+        conn.execute(select(func.max(tables['archived_game'].c.game_id))).scalar(),
+    ]
+    if conn.dialect.name == 'sqlite':
+        used.append(conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'game'")).scalar())
+    return max(n or 0 for n in used) + 1
+
+
+def _sync_sequences(conn, tables, names):
+    # explicit ids don't move a server database's sequences; catch them up
+    # so the app's own inserts don't collide with the loaded rows
+    if conn.dialect.name != 'postgresql':
+        return
+    for name in names:
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('\"{name}\"', 'id'),"
+            f" (SELECT COALESCE(MAX(id), 1) FROM \"{name}\"))"
+        ))
+
+
+def generate(conn, tables, users, games, players=4, rounds=3, password='password',
+             method='pbkdf2:sha256', seed=None, batch_size=BATCH_SIZE, progress=print):
+    rng = random.Random(seed)
+    t = tables
+    counts = dict.fromkeys(('user', 'game', 'player_game', 'game_round', 'responses', 'vote'), 0)
+
+    # users
+    password_hash = generate_password_hash(password, method)
+    first_user = _next_id(conn, t['user'])
+    for start in range(0, users, batch_size):
+        conn.execute(insert(t['user']), [
+            {'id': uid, 'username': f"synthetic{uid}", 'display_name': f"Player {uid}",
+             'password_hash': password_hash}
+            for uid in range(first_user + start, first_user + min(start + batch_size, users))
+        ])
+    counts['user'] = users
+    _sync_sequences(conn, t, ['user'])
+    progress(f"users        {users}")
+    if not games:
+        return counts
+    user_ids = range(first_user, first_user + users)
+    if users < players:
+        raise ValueError(f"need at least {players} users for {players}-player games")
+
+    ingredients = conn.execute(select(t['ingredients'].c.name)).scalars().all() or [
+        f"Ingredient {i}" for i in range(30)
+    ]
+    ids = {name: _next_id(conn, t[name]) for name in ('player_game', 'game_round', 'responses', 'vote')}
+    ids['game'] = _next_game_id(conn, t)
+    first_game = ids['game']
+    pending = {name: [] for name in ids}
+    now = time.time()
+
+    def flush():
+        # parents before children so foreign keys hold on every backend
+        for name in ('game', 'player_game', 'game_round', 'responses', 'vote'):
+            if pending[name]:
+                conn.execute(insert(t[name]), pending[name])
+                counts[name] += len(pending[name])
+                pending[name].clear()
+
+    for n in range(games):
+        game_id = ids['game']
+        ids['game'] += 1
+        seated = rng.sample(user_ids, players)
+        scores = dict.fromkeys(seated, 0)
+
+        for _ in range(rounds):
+            round_id = ids['game_round']
+            ids['game_round'] += 1
+            pending['game_round'].append({
+                'id': round_id, 'game_id': game_id, 'phase': 'results',
+                'ingredients': ", ".join(rng.sample(ingredients, min(3, len(ingredients)))),
+            })
+            answers = []
+            for uid in seated:
+                answers.append([ids['responses'], uid, 0])
+                ids['responses'] += 1
+            for voter in seated:
+                answer = rng.choice([a for a in answers if a[1] != voter])
+                answer[2] += 1
+                scores[answer[1]] += 1
+                pending['vote'].append({'id': ids['vote'], 'round_id': round_id,
+                                        'voter_id': voter, 'response_id': answer[0]})
+                ids['vote'] += 1
+            for response_id, uid, votes in answers:
+                pending['responses'].append({'id': response_id, 'round_id': round_id, 'user_id': uid,
+                                             'text': f"dish {response_id}", 'text_norm': f"dish {response_id}",
+                                             'votes': votes})
+
+        pending['game'].append({
+            'id': game_id, 'host_id': seated[0], 'round_num': rounds, 'active': False,
+            'code': retired_code(game_id), 'last_activity': now,
+        })
+        for seat, uid in enumerate(seated):
+            pending['player_game'].append({'id': ids['player_game'], 'game_id': game_id,
+                                           'user_id': uid, 'score': scores[uid],
+                                           'seat': seat})
+            ids['player_game'] += 1
+
+        if len(pending['vote']) >= batch_size:
+            flush()
+        if (n + 1) % 10000 == 0:
+            progress(f"games        {n + 1}")
+    flush()
+    _sync_sequences(conn, t, ('game', 'player_game', 'game_round', 'responses', 'vote'))
+    leaderboard.record_new_players(conn, first_game)
+    for name in ('game', 'player_game', 'game_round', 'responses', 'vote'):
+        progress(f"{name:<12} {counts[name]}")
+    return counts
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    from hello import app, db
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('ingredients', help='load an ingredient catalog')
+    p.add_argument('path')
+    p.add_argument('--format', choices=('csv', 'json', 'jsonl'))
+
+    p = sub.add_parser('users', help='load users')
+    p.add_argument('path')
+    p.add_argument('--format', choices=('csv', 'json', 'jsonl'))
+    p.add_argument('--hash-workers', type=int, default=os.cpu_count() or 1,
+                   help='processes hashing plain passwords; 0 hashes inline')
+
+    p = sub.add_parser('synthetic', help='generate finished games for load testing')
+    p.add_argument('--users', type=int, default=1000)
+    p.add_argument('--games', type=int, default=1000)
+    p.add_argument('--players', type=int, default=4)
+    p.add_argument('--rounds', type=int, default=3)
+    p.add_argument('--password', default='password')
+    p.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with app.app_context():
+        tables = db.metadata.tables
+        method = app.config['PASSWORD_HASH_METHOD']
+        with db.engine.begin() as conn:
+            if args.command == 'ingredients':
+                count = load_ingredients(conn, tables, read_rows(args.path, args.format), args.batch_size)
+            elif args.command == 'users':
+                count = load_users(conn, tables, read_rows(args.path, args.format), method,
+                                   args.hash_workers, args.batch_size)
+            else:
+                counts = generate(conn, tables, args.users, args.games, args.players, args.rounds,
+                                  args.password, method, args.seed, args.batch_size)
+                count = sum(counts.values())
+                if app.config['REAPER_INTERVAL'] > 0:
+                    print(f"note: the reaper archives these games {app.config['FINISHED_GAME_TTL']}s "
+                          "after they finished; set REAPER_INTERVAL=0 to keep them live", file=sys.stderr)
+    elapsed = time.perf_counter() - started
+    print(f"{count} rows in {elapsed:.1f}s ({count / elapsed if elapsed else 0:.0f} rows/s)", file=sys.stderr)
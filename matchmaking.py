@@ -0,0 +1,398 @@
+"""Quick match and seat allocation.
+
+Seats
+-----
+Every player_game row has a seat, 0 to SEATS - 1, and (game_id, seat) is
+unique. take_seat() fills the lowest free seat of an open game with a single
+INSERT ... SELECT, so a full game inserts nothing; two joins that pick the
+same seat at once collide on the index and the loser picks again. However
+many join at once, a game can't get more than SEATS players.
+
+Quick match
+-----------
+POST /quickmatch puts the player in an in-memory queue and nothing else, so
+joining costs no queries. A matcher thread takes everyone who's waiting as
+groups of SEATS, lingering MATCH_BATCH_MS after the first arrival so a burst
+is handled together, and creates all of their games (host is whoever waited
+longest) and seats in one transaction. Someone who has waited MATCH_MAX_WAIT
+seconds gets a smaller game as long as there are MATCH_MIN_PLAYERS of them.
+The waiting page reloads until its player has a game, then goes to the lobby.
+
+Where the queue lives is up to MATCH_BACKEND:
+
+local
+    in memory, as above, for a single process (the default).
+database
+    the match_queue table, shared by every worker process (serve.py picks it
+    when it starts more than one). Joining inserts a row; each worker's
+    matcher looks at the table every MATCH_POLL_INTERVAL seconds and, once
+    there's a group to seat, takes the write lock with a no-op update of the
+    waiting rows before reading them, so only one worker seats a given
+    player. Their rows get the game id, and the waiting page deletes its row
+    when it picks the game up.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+from sqlalchemy import bindparam, delete, exists, func, insert, literal, select, union_all, update
+from sqlalchemy.exc import IntegrityError
+
+from codes import codes
+
+log = logging.getLogger(__name__)
+
+SEATS = 4
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Matchmaker:
+    def __init__(self, min_players=2, max_wait=10, batch_ms=20, queue_limit=10000, poll_interval=0.1):
+        self.min_players = min_players
+        self.max_wait = max_wait
+        self.batch_ms = batch_ms
+        self.queue_limit = queue_limit
+        self.poll_interval = poll_interval
+        self.shared = False
+        self.waiting = OrderedDict()   # user id -> when they joined, oldest first
+        self.matched = {}              # user id -> (game id, when)
+        self.games = 0
+        self.players = 0
+        self.wait_seconds = 0.0        # summed over matched players
+        self._thread = None
+        self._pruned = 0.0
+        self._cond = threading.Condition()
+
+    def init_app(self, app, db, **models):
+        self.app = app
+        self.db = db
+        self.m = SimpleNamespace(**models)
+        self.min_players = app.config.get('MATCH_MIN_PLAYERS', self.min_players)
+        self.max_wait = app.config.get('MATCH_MAX_WAIT', self.max_wait)
+        self.batch_ms = app.config.get('MATCH_BATCH_MS', self.batch_ms)
+        self.queue_limit = app.config.get('MATCH_QUEUE_LIMIT', self.queue_limit)
+        self.poll_interval = app.config.get('MATCH_POLL_INTERVAL', self.poll_interval)
+        kind = app.config.get('MATCH_BACKEND', 'local')
+        if kind not in ('local', 'database'):
+            raise ValueError(f"unknown MATCH_BACKEND {kind!r}")
+        self.shared = kind == 'database'
+
+    # seats
+
+    def take_seat(self, game_id, user_id, attempts=5):
+        """Seats `user_id` in an open game and commits. False if the game is
+        full, over or already has them."""
+        m = self.m
+        pg = m.PlayerGame
+        taken = select(pg.seat).where(pg.game_id == game_id, pg.seat.is_not(None))
+        # the lowest free seat is 0 or one past a taken one
+        candidates = union_all(
+            select(literal(0).label('seat')),
+            select((pg.seat + 1).label('seat')).where(pg.game_id == game_id),
+        ).subquery()
+        free = (
+            select(func.min(candidates.c.seat))
+            .where(candidates.c.seat < SEATS, candidates.c.seat.not_in(taken))
+            .scalar_subquery()
+        )
+        stmt = insert(pg).from_select(
+            ['game_id', 'user_id', 'score', 'seat'],
+            select(literal(game_id), literal(user_id), literal(0), free).where(
+                free.is_not(None),
+                exists().where(m.Game.id == game_id, m.Game.active.is_(True)),
+                ~exists().where(pg.game_id == game_id, pg.user_id == user_id),
+            ),
+        )
+        session = self.db.session
+        for _ in range(attempts):
+            try:
+                seated = session.execute(stmt).rowcount
+                session.commit()
+                return seated == 1
+            except IntegrityError:
+                # someone took that seat first
+                session.rollback()
+        return False
+
+    # the queue
+
+    def join(self, user_id):
+        if self.shared:
+            return self._join_shared(user_id)
+        with self._cond:
+            if user_id in self.waiting or user_id in self.matched:
+                return
+            if len(self.waiting) >= self.queue_limit:
+                raise QueueFull()
+            self.waiting[user_id] = time.monotonic()
+            self._ensure_started()
+            # the matcher only cares when there's a first group or a first
+            # pair that might have to go as a smaller game
+            if len(self.waiting) in (SEATS, self.min_players):
+                self._cond.notify()
+
+    def leave(self, user_id):
+        if self.shared:
+            q = self.m.MatchQueue
+            self.db.session.execute(delete(q).where(q.user_id == user_id, q.game_id.is_(None)))
+            self.db.session.commit()
+            return
+        with self._cond:
+            self.waiting.pop(user_id, None)
+
+    def status(self, user_id):
+        """The game `user_id` was put in (handed out once), True while they're
+        still waiting, None if they aren't in the queue."""
+        if self.shared:
+            return self._status_shared(user_id)
+        with self._cond:
+            if user_id in self.matched:
+                return self.matched.pop(user_id)[0]
+            return True if user_id in self.waiting else None
+
+    def stats(self):
+        if self.shared:
+            q = self.m.MatchQueue
+            waiting, oldest = self.db.session.execute(
+                select(func.count(), func.min(q.joined_at)).where(q.game_id.is_(None))
+            ).one()
+            now = time.time()
+        else:
+            with self._cond:
+                waiting = len(self.waiting)
+                oldest = next(iter(self.waiting.values()), None)
+            now = time.monotonic()
+        with self._cond:
+            return {
+                'waiting': waiting,
+                'oldest_wait': now - oldest if oldest is not None else 0.0,
+                'games': self.games,
+                'players': self.players,
+                'wait_seconds': self.wait_seconds,
+            }
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._thread is None:
+                target = self._run_shared if self.shared else self._run
+                self._thread = threading.Thread(target=target, name='matchmaker', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            groups = self._next_groups()
+            try:
+                with self.app.app_context():
+                    self._create(groups)
+            except Exception:
+                log.exception("couldn't create %d quick match games", len(groups))
+                with self._cond:
+                    # back to the front of the queue, in their old order
+                    for user_id, joined in reversed([p for group in groups for p in group]):
+                        self.waiting[user_id] = joined
+                        self.waiting.move_to_end(user_id, last=False)
+                time.sleep(1)
+
+    def _next_groups(self):
+        # blocks until there's at least one group to seat
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._forget_matched(now)
+                if len(self.waiting) >= SEATS:
+                    # let the rest of a burst arrive
+                    deadline = now + self.batch_ms / 1000
+                    while (remaining := deadline - time.monotonic()) > 0:
+                        self._cond.wait(remaining)
+                    groups = self._take(time.monotonic())
+                    if groups:
+                        # unless they left while we lingered
+                        return groups
+                elif len(self.waiting) >= max(self.min_players, 1):
+                    oldest = next(iter(self.waiting.values()))
+                    if now - oldest >= self.max_wait:
+                        return self._take(now)
+                    self._cond.wait(oldest + self.max_wait - now)
+                else:
+                    self._cond.wait(self.max_wait)
+
+    def _take(self, now):
+        groups = self._groups(list(self.waiting.items()), now)
+        for group in groups:
+            for user_id, _ in group:
+                del self.waiting[user_id]
+        return groups
+
+    def _groups(self, queue, now):
+        # every full group, and whoever's left over if they've waited long enough
+        n = len(queue) // SEATS * SEATS
+        rest = queue[n:]
+        if len(rest) >= max(self.min_players, 1) and now - rest[0][1] >= self.max_wait:
+            n = len(queue)
+        return [queue[i:i + SEATS] for i in range(0, n, SEATS)]
+
+    def _forget_matched(self, now):
+        # players who never came back for their game
+        if now - self._pruned < 60:
+            return
+        self._pruned = now
+        for user_id, (_, at) in list(self.matched.items()):
+            if now - at > 60:
+                del self.matched[user_id]
+
+    def _seat(self, session, groups):
+        # inserts a game per group with its players seated, uncommitted, and
+        # returns their ids and rows; on a join code another worker just
+        # took, rolls back and raises
+        m = self.m
+        games = [{'host_id': group[0][0], 'round_num': 1, 'active': True, 'code': codes.allocate(),
+                  'last_activity': time.time()} for group in groups]
+        try:
+            game_ids = session.execute(
+                insert(m.Game).returning(m.Game.id, sort_by_parameter_order=True), games
+            ).scalars().all()
+            session.execute(insert(m.PlayerGame), [
+                {'game_id': game_id, 'user_id': user_id, 'score': 0, 'seat': seat}
+                for game_id, group in zip(game_ids, groups)
+                for seat, (user_id, _) in enumerate(group)
+            ])
+        except IntegrityError:
+            self._discard(session, games)
+            raise
+        return game_ids, games
+
+    def _discard(self, session, games):
+        session.rollback()
+        for game in games:
+            codes.release(game['code'])
+
+    def _count(self, game_ids, groups, now):
+        with self._cond:
+            for group in groups:
+                self.wait_seconds += sum(now - joined for _, joined in group)
+                self.players += len(group)
+            self.games += len(game_ids)
+
+    def _create(self, groups):
+        session = self.db.session
+        for _ in range(3):
+            try:
+                game_ids, _ = self._seat(session, groups)
+                session.commit()
+                break
+            except IntegrityError:
+                # a code another worker just took; draw again
+                pass
+        else:
+            raise RuntimeError("no free join codes")
+
+        now = time.monotonic()
+        with self._cond:
+            for game_id, group in zip(game_ids, groups):
+                for user_id, _ in group:
+                    self.matched[user_id] = (game_id, now)
+        self._count(game_ids, groups, now)
+
+    # the shared queue
+
+    def _join_shared(self, user_id):
+        q = self.m.MatchQueue
+        session = self.db.session
+        waiting = select(func.count()).select_from(q).where(q.game_id.is_(None)).scalar_subquery()
+        stmt = insert(q).from_select(
+            ['user_id', 'joined_at'],
+            select(literal(user_id), literal(time.time())).where(
+                waiting < self.queue_limit,
+                ~exists().where(q.user_id == user_id),
+            ),
+        )
+        try:
+            if not session.execute(stmt).rowcount:
+                # already queued, or the queue is full
+                if session.execute(select(q.user_id).where(q.user_id == user_id)).first() is None:
+                    session.rollback()
+                    raise QueueFull()
+            session.commit()
+        except IntegrityError:
+            # a second click that got there first
+            session.rollback()
+        self._ensure_started()
+
+    def _status_shared(self, user_id):
+        q = self.m.MatchQueue
+        session = self.db.session
+        game_id = session.execute(select(q.game_id).where(q.user_id == user_id)).first()
+        if game_id is None:
+            return None
+        if game_id[0] is None:
+            # a worker that was restarted picks the matching back up
+            self._ensure_started()
+            return True
+        session.execute(delete(q).where(q.user_id == user_id))
+        session.commit()
+        return game_id[0]
+
+    def _run_shared(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                with self.app.app_context():
+                    self._match_shared()
+            except Exception:
+                log.exception("couldn't match the shared quick match queue")
+                time.sleep(1)
+
+    def _match_shared(self):
+        q = self.m.MatchQueue
+        session = self.db.session
+        now = time.time()
+        if now - self._pruned >= 60:
+            # players who never came back for their game
+            self._pruned = now
+            session.execute(delete(q).where(q.game_id.is_not(None), q.matched_at < now - 60))
+            session.commit()
+
+        waiting, oldest = session.execute(
+            select(func.count(), func.min(q.joined_at)).where(q.game_id.is_(None))
+        ).one()
+        if waiting < SEATS and (waiting < max(self.min_players, 1) or now - oldest < self.max_wait):
+            session.rollback()
+            return
+
+        # a no-op write: the write lock on SQLite, the waiting rows' locks on a
+        # server database, before the queue is read
+        session.execute(update(q).where(q.game_id.is_(None)).values(joined_at=q.joined_at))
+        queue = session.execute(
+            select(q.user_id, q.joined_at).where(q.game_id.is_(None))
+            .order_by(q.joined_at, q.user_id).limit(self.queue_limit)
+        ).all()
+        groups = self._groups([tuple(row) for row in queue], now)
+        if not groups:
+            session.rollback()
+            return
+        try:
+            game_ids, games = self._seat(session, groups)
+        except IntegrityError:
+            # a code another worker just took; the next pass draws again
+            return
+        table = q.__table__
+        claimed = session.execute(
+            update(table).where(table.c.user_id == bindparam('b_user_id'), table.c.game_id.is_(None))
+            .values(game_id=bindparam('b_game_id'), matched_at=now),
+            [{'b_user_id': user_id, 'b_game_id': game_id}
+             for game_id, group in zip(game_ids, groups) for user_id, _ in group],
+        ).rowcount
+        if claimed != sum(len(group) for group in groups):
+            # another worker's matcher seated some of them first
+            self._discard(session, games)
+            return
+        session.commit()
+        self._count(game_ids, groups, now)
+
+
+matchmaker = Matchmaker()
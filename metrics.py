@@ -0,0 +1,226 @@
+"""Request and SQL instrumentation.
+
+Every request records its latency, how many SQL statements it ran and how long
+they took, per endpoint. A request that runs more statements than its view's
+@query_budget(n), or QUERY_BUDGET for views without one, logs a warning
+(that's usually an N+1); with QUERY_BUDGET_STRICT it fails instead, so tests
+and benchmarks catch it. /metrics serves it all in Prometheus text format.
+
+Setting PROFILE_SLOW_REQUESTS to a number of seconds turns on a sampling
+profiler: PROFILE_SAMPLE_RATE of requests run under cProfile and the ones
+slower than the threshold are dumped to PROFILE_DIR (instance/profiles by
+default) for `python -m pstats`.
+"""
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RATE_WINDOW = 60   # seconds the recent request rates are averaged over
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(n):
+    """Caps the SQL statements a view may run per request; put it right
+    under @app.route."""
+    def decorate(view):
+        view.query_budget = n
+        return view
+    return decorate
+
+
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+class RateWindow:
+    # requests per second over the last RATE_WINDOW seconds, one slot a second
+    __slots__ = ('seconds', 'counts')
+
+    def __init__(self):
+        self.seconds = [0] * RATE_WINDOW
+        self.counts = [0] * RATE_WINDOW
+
+    def hit(self, now):
+        second = int(now)
+        slot = second % RATE_WINDOW
+        if self.seconds[slot] != second:
+            self.seconds[slot] = second
+            self.counts[slot] = 0
+        self.counts[slot] += 1
+
+    def rate(self, now):
+        oldest = int(now) - RATE_WINDOW
+        return sum(n for s, n in zip(self.seconds, self.counts) if s > oldest) / RATE_WINDOW
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = defaultdict(Histogram)     # endpoint -> Histogram
+        self.requests = defaultdict(int)          # (endpoint, status) -> count
+        self.queries = defaultdict(int)           # endpoint -> statements
+        self.query_seconds = defaultdict(float)   # endpoint -> seconds in SQL
+        self.over_budget = defaultdict(int)       # endpoint -> requests over budget
+        self.recent = defaultdict(RateWindow)     # endpoint -> RateWindow
+        self.collectors = []                      # callables returning extra lines
+
+    def init_app(self, app, db):
+        self.query_budget = app.config.get('QUERY_BUDGET', 20)
+        self.strict = app.config.get('QUERY_BUDGET_STRICT', False)
+        self.profile_threshold = app.config.get('PROFILE_SLOW_REQUESTS', 0)
+        self.profile_rate = app.config.get('PROFILE_SAMPLE_RATE', 0.05)
+        self.profile_dir = app.config.get('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles')
+
+        app.before_request(self._before)
+        app.after_request(self._after)
+        app.teardown_request(self._teardown)
+        app.add_url_rule('/metrics', 'metrics', self.render)
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._before_cursor)
+            event.listen(db.engine, 'after_cursor_execute', self._after_cursor)
+
+    # request hooks
+
+    def _before(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_query_seconds = 0.0
+        g.metrics_profile = None
+        if self.profile_threshold and random.random() < self.profile_rate:
+            g.metrics_profile = cProfile.Profile()
+            g.metrics_profile.enable()
+
+    def _budget(self):
+        view = current_app.view_functions.get(request.endpoint)
+        return getattr(view, 'query_budget', self.query_budget)
+
+    def _after(self, response):
+        g.metrics_status = response.status_code
+        if self.strict and not g.get('metrics_over_budget'):
+            queries, budget = g.get('metrics_queries', 0), self._budget()
+            if queries > budget:
+                # once; the error page comes back through here
+                g.metrics_over_budget = True
+                raise QueryBudgetExceeded(f"{request.endpoint} ran {queries} SQL statements, budget {budget}")
+        return response
+
+    def _teardown(self, exc):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or 'unmatched'
+        queries = g.pop('metrics_queries', 0)
+        query_seconds = g.pop('metrics_query_seconds', 0.0)
+        status = 500 if exc is not None else g.get('metrics_status', 200)
+        budget = self._budget()
+
+        with self._lock:
+            self.latency[endpoint].observe(elapsed)
+            self.requests[(endpoint, status)] += 1
+            self.recent[endpoint].hit(time.time())
+            self.queries[endpoint] += queries
+            self.query_seconds[endpoint] += query_seconds
+            if queries > budget:
+                self.over_budget[endpoint] += 1
+
+        if queries > budget:
+            log.warning("%s ran %d SQL statements (budget %d) in %.1f ms",
+                        request.path, queries, budget, elapsed * 1000)
+
+        profile = g.pop('metrics_profile', None)
+        if profile is not None:
+            profile.disable()
+            if elapsed >= self.profile_threshold:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                path = os.path.join(self.profile_dir, f"{endpoint}-{int(time.time() * 1000)}.prof")
+                profile.dump_stats(path)
+                log.warning("%s took %.1f ms, profile saved to %s", request.path, elapsed * 1000, path)
+
+    # SQL hooks; statements run outside a request (the writer, the reaper)
+    # aren't attributed to anyone
+
+    def _before_cursor(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    def _after_cursor(self, conn, cursor, statement, parameters, context, executemany):
+        if not has_request_context():
+            return
+        started = conn.info.get('metrics_started')
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        g.metrics_queries = g.get('metrics_queries', 0) + 1
+        g.metrics_query_seconds = g.get('metrics_query_seconds', 0.0) + elapsed
+
+    def rates(self):
+        """Requests per second per endpoint over the last minute, in this
+        process."""
+        now = time.time()
+        with self._lock:
+            return {endpoint: w.rate(now) for endpoint, w in self.recent.items()}
+
+    # exposition
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines.append('# TYPE http_request_duration_seconds histogram')
+            for endpoint, h in sorted(self.latency.items()):
+                cumulative = 0
+                for bound, n in zip(BUCKETS, h.counts):
+                    cumulative += n
+                    lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+                lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {h.count}')
+                lines.append(f'http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {h.total:.6f}')
+                lines.append(f'http_request_duration_seconds_count{{endpoint="{endpoint}"}} {h.count}')
+
+            lines.append('# TYPE http_requests_total counter')
+            for (endpoint, status), n in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{endpoint="{endpoint}",status="{status}"}} {n}')
+
+            lines.append('# TYPE db_statements_total counter')
+            for endpoint, n in sorted(self.queries.items()):
+                lines.append(f'db_statements_total{{endpoint="{endpoint}"}} {n}')
+
+            lines.append('# TYPE db_statement_seconds_total counter')
+            for endpoint, s in sorted(self.query_seconds.items()):
+                lines.append(f'db_statement_seconds_total{{endpoint="{endpoint}"}} {s:.6f}')
+
+            lines.append('# TYPE db_query_budget_exceeded_total counter')
+            for endpoint, n in sorted(self.over_budget.items()):
+                lines.append(f'db_query_budget_exceeded_total{{endpoint="{endpoint}"}} {n}')
+
+        for collect in self.collectors:
+            lines.extend(collect())
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
@@ -0,0 +1,236 @@
+"""Versioned schema migrations.
+
+init_db.py builds a fresh database from the models and stamps it as current;
+an existing database is brought up to date with
+
+    python migrations.py
+
+which runs every migration newer than the one recorded in `schema_version`,
+each in its own transaction. hello.py does the same on startup. Migrations
+only upgrade a database that has the app's tables; an empty one is refused
+and has to go through init_db.py. New migrations go at the bottom with the
+next version number and must leave the schema matching the models, on SQLite
+and on PostgreSQL (check `conn.dialect.name` where the DDL differs).
+"""
+import time
+
+from sqlalchemy import inspect, text
+
+import leaderboard
+from gamestate import normalize
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+
+def _ensure_table(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        " version INTEGER PRIMARY KEY,"
+        " name VARCHAR(128) NOT NULL,"
+        " applied_at FLOAT NOT NULL)"
+    ))
+
+
+def _applied(conn):
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+
+def _record(conn, version, name):
+    conn.execute(
+        text("INSERT INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+        {'v': version, 'n': name, 't': time.time()}
+    )
+
+
+def upgrade(engine):
+    with engine.begin() as conn:
+        if not inspect(conn).has_table('player_game'):
+            raise RuntimeError("the database has no tables yet; build it with `python init_db.py`")
+        _ensure_table(conn)
+        applied = _applied(conn)
+
+    ran = []
+    for version, name, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            fn(conn)
+            _record(conn, version, name)
+        ran.append((version, name))
+    return ran
+
+
+def stamp(engine):
+    # for a database that create_all() just built from the current models
+    with engine.begin() as conn:
+        _ensure_table(conn)
+        applied = _applied(conn)
+        for version, name, _ in MIGRATIONS:
+            if version not in applied:
+                _record(conn, version, name)
+
+
+@migration(1, "hot path indexes")
+def hot_path_indexes(conn):
+    # a player can only be in a game once; keep the first row of any duplicates
+    conn.execute(text(
+        "DELETE FROM player_game WHERE id NOT IN "
+        "(SELECT MIN(id) FROM player_game GROUP BY game_id, user_id)"
+    ))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uniq_player_per_game ON player_game (game_id, user_id)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_player_game_user_id ON player_game (user_id)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_game_round_game_id ON game_round (game_id, id)"
+    ))
+    # responses.round_id and vote.round_id are already the leading columns of
+    # uniq_response_per_round and uniq_vote_per_round
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_responses_user_id ON responses (user_id)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_vote_response_id ON vote (response_id)"
+    ))
+
+
+@migration(2, "game last activity")
+def game_last_activity(conn):
+    conn.execute(text("ALTER TABLE game ADD COLUMN last_activity FLOAT"))
+    conn.execute(text("UPDATE game SET last_activity = :now"), {'now': time.time()})
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_game_active_last_activity ON game (active, last_activity)"
+    ))
+
+
+
+@migration(3, "user stats")
+def user_stats(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS user_stats ("
+        " user_id INTEGER NOT NULL PRIMARY KEY REFERENCES \"user\" (id),"
+        " games_played INTEGER NOT NULL DEFAULT 0,"
+        " wins INTEGER NOT NULL DEFAULT 0,"
+        " votes_received INTEGER NOT NULL DEFAULT 0)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_user_stats_rank ON user_stats (wins, votes_received)"
+    ))
+    # backfill from the games that already finished
+    leaderboard.rebuild(conn)
+
+
+@migration(4, "normalized answers")
+def normalized_answers(conn):
+    conn.execute(text("ALTER TABLE responses ADD COLUMN text_norm VARCHAR(256)"))
+    # backfill a round at a time; answers that only differed in case or
+    # spacing keep theirs apart with the response id so the index can go on
+    page = text(
+        "SELECT id, round_id, text FROM responses"
+        " WHERE round_id > :round_id OR (round_id = :round_id AND id > :id)"
+        " ORDER BY round_id, id LIMIT 5000"
+    )
+    update = text("UPDATE responses SET text_norm = :norm WHERE id = :id")
+    last, seen = (-1, -1), set()
+    while True:
+        rows = conn.execute(page, {'round_id': last[0], 'id': last[1]}).fetchall()
+        if not rows:
+            break
+        batch = []
+        for response_id, round_id, answer in rows:
+            if round_id != last[0]:
+                seen = set()
+            last = (round_id, response_id)
+            norm = normalize(answer or "")
+            if norm in seen:
+                norm = f"{norm}#{response_id}"
+            seen.add(norm)
+            batch.append({'id': response_id, 'norm': norm})
+        conn.execute(update, batch)
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uniq_response_norm_per_round ON responses (round_id, text_norm)"
+    ))
+
+
+@migration(5, "game archive")
+def game_archive(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS archived_game ("
+        " game_id INTEGER NOT NULL PRIMARY KEY,"
+        " segment INTEGER NOT NULL,"
+        " start INTEGER NOT NULL,"
+        " length INTEGER NOT NULL,"
+        " finished_at FLOAT)"
+    ))
+    # rebuild game with AUTOINCREMENT so the ids of archived (deleted) games
+    # aren't handed out again; SQLite can't add it in place. Other databases'
+    # sequences never go back, so there's nothing to do there
+    if conn.dialect.name != 'sqlite':
+        return
+    conn.execute(text(
+        "CREATE TABLE game_new ("
+        " id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,"
+        " host_id INTEGER REFERENCES \"user\" (id),"
+        " round_num INTEGER,"
+        " active BOOLEAN,"
+        " code VARCHAR(8) NOT NULL UNIQUE,"
+        " last_activity FLOAT)"
+    ))
+    conn.execute(text(
+        "INSERT INTO game_new (id, host_id, round_num, active, code, last_activity)"
+        " SELECT id, host_id, round_num, active, code, last_activity FROM game"
+    ))
+    conn.execute(text("DROP TABLE game"))
+    conn.execute(text("ALTER TABLE game_new RENAME TO game"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_game_active_last_activity ON game (active, last_activity)"
+    ))
+
+
+@migration(6, "player seats")
+def player_seats(conn):
+    conn.execute(text("ALTER TABLE player_game ADD COLUMN seat INTEGER"))
+    # existing players sit in the order they joined; a game that was overfilled
+    # before seats existed keeps its extra players in seats past the last one
+    conn.execute(text(
+        "UPDATE player_game SET seat = ("
+        " SELECT count(*) FROM player_game AS earlier"
+        " WHERE earlier.game_id = player_game.game_id AND earlier.id < player_game.id)"
+    ))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uniq_seat_per_game ON player_game (game_id, seat)"
+    ))
+
+
+
+@migration(7, "match queue")
+def match_queue(conn):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS match_queue ("
+        " user_id INTEGER NOT NULL PRIMARY KEY REFERENCES \"user\" (id),"
+        " joined_at FLOAT NOT NULL,"
+        " game_id INTEGER,"
+        " matched_at FLOAT)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_match_queue_waiting ON match_queue (game_id, joined_at)"
+    ))
+
+if __name__ == '__main__':
+    from hello import app, db
+
+    with app.app_context():
+        ran = upgrade(db.engine)
+    for version, name in ran:
+        print(f"applied {version:04d} {name}")
+    if not ran:
+        print("schema is up to date")
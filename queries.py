@@ -0,0 +1,86 @@
+"""Pre-shaped reads for the pages that still go to the database.
+
+The polled game pages (voting, the waiting pages, results, winner) are served
+from gamestate.store. What's left reads the game row, the viewer's seat and
+maybe a round, and used to do that one query at a time. Each fetcher here
+returns everything its view needs in one statement, however many players
+there are.
+
+Routes declare how many statements they may run with @query_budget (see
+metrics.py); QUERY_BUDGET_STRICT=1 turns going over into an error, for tests
+and benchmarks.
+"""
+from collections import namedtuple
+from types import SimpleNamespace
+
+from sqlalchemy import exists, func, select
+
+LobbyPage = namedtuple('LobbyPage', 'code host_id round_id is_member players')
+LobbyPlayer = namedtuple('LobbyPlayer', 'id display_name')
+RoundPage = namedtuple('RoundPage', 'is_member round')
+JoinCheck = namedtuple('JoinCheck', 'active is_member players')
+
+
+class ViewQueries:
+    def init_app(self, app, db, **models):
+        self.db = db
+        self.m = SimpleNamespace(**models)
+
+    def _member(self, game_id, user_id):
+        m = self.m
+        return exists().where(m.PlayerGame.game_id == game_id, m.PlayerGame.user_id == user_id)
+
+    def lobby(self, game_id, user_id):
+        """The game's code and host, its first round if it started, whether
+        `user_id` is in it and everyone who is, in join order. None if there's
+        no such game."""
+        m = self.m
+        first_round = (
+            select(func.min(m.GameRound.id)).where(m.GameRound.game_id == game_id).scalar_subquery()
+        )
+        rows = self.db.session.execute(
+            select(m.Game.code, m.Game.host_id, first_round, m.User.id, m.User.display_name)
+            .select_from(m.Game)
+            .outerjoin(m.PlayerGame, m.PlayerGame.game_id == m.Game.id)
+            .outerjoin(m.User, m.User.id == m.PlayerGame.user_id)
+            .where(m.Game.id == game_id)
+            .order_by(m.PlayerGame.id)
+        ).all()
+        if not rows:
+            return None
+        code, host_id, round_id = rows[0][:3]
+        players = [LobbyPlayer(uid, name) for _, _, _, uid, name in rows if uid is not None]
+        return LobbyPage(code, host_id, round_id, any(p.id == user_id for p in players), players)
+
+    def round_page(self, game_id, round_id, user_id):
+        """Whether `user_id` is in the game and the round if it belongs to it.
+        None if there's no such game."""
+        m = self.m
+        row = self.db.session.execute(
+            select(m.Game.id, self._member(game_id, user_id), m.GameRound)
+            .select_from(m.Game)
+            .outerjoin(m.GameRound, (m.GameRound.id == round_id) & (m.GameRound.game_id == m.Game.id))
+            .where(m.Game.id == game_id)
+        ).first()
+        if row is None:
+            return None
+        return RoundPage(row[1], row[2])
+
+    def join_check(self, game_id, user_id):
+        """Whether the game is still open, whether `user_id` is already in it
+        and how many players it has. None if there's no such game."""
+        m = self.m
+        seats = (
+            select(func.count()).select_from(m.PlayerGame)
+            .where(m.PlayerGame.game_id == game_id).scalar_subquery()
+        )
+        row = self.db.session.execute(
+            select(m.Game.active, self._member(game_id, user_id), seats).where(m.Game.id == game_id)
+        ).first()
+        return JoinCheck(*row) if row is not None else None
+
+    def is_member(self, game_id, user_id):
+        return self.db.session.execute(select(self._member(game_id, user_id))).scalar()
+
+
+queries = ViewQueries()
@@ -0,0 +1,140 @@
+"""Background cleanup of abandoned and finished games.
+
+Games whose players just close the tab never reach leavegame, so a reaper
+thread periodically records which games saw activity (from the event broker)
+into game.last_activity and tears down games that have been idle too long, or
+finished a while ago, a bounded batch at a time. Finished games are written
+to the archive (archive.py) first. leavegame uses the same delete_games()
+cascade.
+"""
+import logging
+import threading
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import bindparam, delete, select, update
+
+from archive import archive
+from catalog import catalog
+from codes import codes
+from events import broker
+from gamestate import store
+
+log = logging.getLogger(__name__)
+
+
+class Reaper:
+    def __init__(self, interval=60, idle_timeout=1800, finished_ttl=600, batch_size=200):
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.finished_ttl = finished_ttl
+        self.batch_size = batch_size
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = []
+
+    def init_app(self, app, db, **models):
+        self.app = app
+        self.db = db
+        self.m = SimpleNamespace(**models)
+        self.interval = app.config.get('REAPER_INTERVAL', self.interval)
+        self.idle_timeout = app.config.get('GAME_IDLE_TIMEOUT', self.idle_timeout)
+        self.finished_ttl = app.config.get('FINISHED_GAME_TTL', self.finished_ttl)
+        self.batch_size = app.config.get('REAPER_BATCH_SIZE', self.batch_size)
+        # start with the first request so scripts importing the app don't
+        app.before_request(self._ensure_started)
+
+    def _ensure_started(self):
+        if self._thread is None and self.interval > 0:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='reaper', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self.app.app_context():
+                    self.run_once()
+            except Exception:
+                log.exception("reaper pass failed")
+
+    def run_once(self, now=None):
+        now = now or time.time()
+        self.record_activity()
+
+        # games closed last pass have had time to deliver 'game-closed'
+        # delete_games adds to it from request threads
+        with self._lock:
+            closed, self._closed = self._closed, []
+        for game_id in closed:
+            broker.forget(game_id)
+
+        m = self.m
+        reaped = 0
+        for condition, finished in (
+            ((m.Game.active.is_(True)) & (m.Game.last_activity < now - self.idle_timeout), False),
+            ((m.Game.active.is_(False)) & (m.Game.last_activity < now - self.finished_ttl), True),
+        ):
+            while True:
+                ids = self.db.session.execute(
+                    select(m.Game.id).where(condition).limit(self.batch_size)
+                ).scalars().all()
+                if not ids:
+                    break
+                if finished and archive.enabled:
+                    # committed together with the deletes
+                    archive.store(ids)
+                self.delete_games(ids)
+                reaped += len(ids)
+        if reaped:
+            log.info("reaped %d games", reaped)
+        return reaped
+
+    def record_activity(self):
+        activity = broker.drain_activity()
+        if not activity:
+            return
+        table = self.m.Game.__table__
+        self.db.session.execute(
+            update(table)
+            .where(table.c.id == bindparam('game_id'))
+            .values(last_activity=bindparam('at')),
+            [{'game_id': game_id, 'at': at} for game_id, at in activity.items()]
+        )
+        self.db.session.commit()
+
+    def delete_games(self, game_ids):
+        """Deletes games and everything hanging off them with one statement per
+        table, then forgets them in the in-process caches."""
+        m = self.m
+        session = self.db.session
+        game_ids = list(game_ids)
+
+        # queued answers/votes must land before we delete underneath them
+        store.flush()
+
+        live_codes = session.execute(
+            select(m.Game.code).where(m.Game.id.in_(game_ids), m.Game.active.is_(True))
+        ).scalars().all()
+        round_ids = select(m.GameRound.id).where(m.GameRound.game_id.in_(game_ids))
+
+        session.execute(delete(m.Vote).where(m.Vote.round_id.in_(round_ids)))
+        session.execute(delete(m.Responses).where(m.Responses.round_id.in_(round_ids)))
+        session.execute(delete(m.GameRound).where(m.GameRound.game_id.in_(game_ids)))
+        session.execute(delete(m.PlayerGame).where(m.PlayerGame.game_id.in_(game_ids)))
+        session.execute(delete(m.Game).where(m.Game.id.in_(game_ids)))
+        session.commit()
+
+        for code in live_codes:
+            codes.release(code)
+        for game_id in game_ids:
+            store.drop(game_id)
+            catalog.discard(game_id)
+            broker.publish(game_id, 'game-closed')
+        with self._lock:
+            self._closed.extend(game_ids)
+
+
+reaper = Reaper()
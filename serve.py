@@ -0,0 +1,117 @@
+"""Production entry point.
+
+    python serve.py --workers 4 --port 8000
+
+The parent process brings the schema up to date, opens the listening socket
+and forks the workers, which all accept on that socket and each run a threaded
+WSGI server. A worker that dies is replaced; SIGINT/SIGTERM stops them all.
+
+With more than one worker, events go through the shared SQLite log
+(EVENT_BACKEND=sqlite), game state is written through
+(GAMESTATE_WRITE_BEHIND=0) and the quick match queue is kept in the database
+(MATCH_BACKEND=database) unless those are set explicitly. The same settings
+work under any other pre-forking server, e.g.
+
+    EVENT_BACKEND=sqlite GAMESTATE_WRITE_BEHIND=0 MATCH_BACKEND=database gunicorn -w 4 --threads 8 hello:app
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+
+def run_worker(sock, access_log):
+    from werkzeug.serving import make_server
+    from hello import app, db, store
+
+    # connections opened by the parent must not be shared with it
+    with app.app_context():
+        db.engine.dispose(close=False)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if not access_log:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    try:
+        server.serve_forever()
+    finally:
+        store.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=os.environ.get('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1)))
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--access-log', action='store_true', help='log every request to stderr')
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        os.environ.setdefault('EVENT_BACKEND', 'sqlite')
+        os.environ.setdefault('GAMESTATE_WRITE_BEHIND', '0')
+        os.environ.setdefault('MATCH_BACKEND', 'database')
+
+    from hello import app, db
+    import migrations
+
+    with app.app_context():
+        for version, name in migrations.upgrade(db.engine):
+            print(f"applied {version:04d} {name}")
+        db.engine.dispose()
+
+    sock = socket.create_server((args.host, args.port), backlog=args.backlog)
+    sock.set_inheritable(True)
+    print(f"serving on http://{args.host}:{sock.getsockname()[1]} with {args.workers} worker(s)", flush=True)
+
+    children = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(sock, args.access_log)
+            finally:
+                os._exit(0)
+        children[pid] = time.monotonic()
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(args.workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = children.pop(pid, None)
+        if stopping or started is None:
+            continue
+        print(f"worker {pid} exited with status {status}, restarting", file=sys.stderr, flush=True)
+        if time.monotonic() - started < 1:
+            # crashing on startup; don't spin
+            time.sleep(1)
+        spawn()
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
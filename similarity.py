@@ -0,0 +1,109 @@
+"""Near-duplicate answers.
+
+Exact repeats are caught by the normalized key (gamestate.normalize) and its
+unique index. This catches the ones that are only almost the same: plurals
+("taco" / "tacos") and small typos ("spagetti" / "spaghetti").
+
+Each round keeps an NgramIndex of its answers: every answer is reduced to a
+rough key (normalized, each word singularized) and split into character
+trigrams, and an inverted index maps a trigram to the answers containing it.
+A new answer only gets compared with answers it shares a trigram with.
+
+When the two keys differ in exactly one word, that word decides: it's a near
+duplicate only if the words are a typo apart (one edit per six letters, so
+"ham" / "jam" and "soup" / "stew" are different dishes). Otherwise it's one
+when the Dice coefficient of the two trigram sets reaches the threshold.
+"""
+from collections import defaultdict
+
+
+def singular(word):
+    # crude, but it only has to map both spellings to the same key
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and word.endswith(('ches', 'shes', 'xes', 'oes')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+
+def fold(norm):
+    return " ".join(singular(w) for w in norm.split())
+
+
+def within_edits(a, b, limit):
+    # Levenshtein distance <= limit, giving up on a row once it can't be
+    if abs(len(a) - len(b)) > limit:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return False
+        previous = current
+    return previous[-1] <= limit
+
+
+def typo(a, b):
+    # short words are too easy to turn into other words
+    limit = min(len(a), len(b)) // 6
+    return bool(limit) and within_edits(a, b, limit)
+
+
+def one_word_apart(a, b):
+    # the differing words if `a` and `b` differ in exactly one word, else None
+    words_a, words_b = a.split(), b.split()
+    if len(words_a) != len(words_b):
+        return None
+    diff = [(x, y) for x, y in zip(words_a, words_b) if x != y]
+    return diff[0] if len(diff) == 1 else None
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class NgramIndex:
+    __slots__ = ('threshold', 'keys', 'ids', 'grams', 'postings')
+
+    def __init__(self, threshold=0.9):
+        self.threshold = threshold
+        self.keys = {}                     # folded key -> answer id
+        self.ids = {}                      # answer id -> folded key
+        self.grams = {}                    # answer id -> its trigrams
+        self.postings = defaultdict(set)   # trigram -> answer ids
+
+    def add(self, answer_id, norm):
+        key = fold(norm)
+        grams = trigrams(key)
+        self.keys.setdefault(key, answer_id)
+        self.ids[answer_id] = key
+        self.grams[answer_id] = grams
+        for gram in grams:
+            self.postings[gram].add(answer_id)
+
+    def match(self, norm):
+        """The id of an answer close enough to `norm` to count as the same
+        one, or None."""
+        key = fold(norm)
+        if key in self.keys:
+            return self.keys[key]
+        if not self.threshold:
+            return None
+        grams = trigrams(key)
+        shared = defaultdict(int)
+        for gram in grams:
+            for answer_id in self.postings.get(gram, ()):
+                shared[answer_id] += 1
+        for answer_id, n in shared.items():
+            words = one_word_apart(key, self.ids[answer_id])
+            if words is not None:
+                if typo(*words):
+                    return answer_id
+            elif 2 * n / (len(grams) + len(self.grams[answer_id])) >= self.threshold:
+                return answer_id
+        return None
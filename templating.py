@@ -0,0 +1,67 @@
+"""Template caching.
+
+Compiled templates are kept on disk (JINJA_BYTECODE_CACHE_DIR, default
+instance/jinja_cache) so a freshly started worker loads bytecode instead of
+parsing every template again.
+
+The polled game pages wrap their shared parts in
+
+    {% call cached_fragment('lobby-players', game_id, event_seq, is_host) %}
+      ...
+    {% endcall %}
+
+which renders the block once per (name, game_id, state version, *vary) and
+hands every later request the same markup. The state version is the game's
+event sequence number (see events.py), so anything that changes what a
+fragment shows must publish an event, which it already has to for the pages
+to reload. Anything that differs between viewers goes in `vary`.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+
+
+class FragmentCache:
+    def __init__(self, size=2000):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.size = app.config.get('FRAGMENT_CACHE_SIZE', self.size)
+        cache_dir = app.config.get('JINJA_BYTECODE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        app.jinja_env.globals['cached_fragment'] = self.fragment
+
+    def fragment(self, name, game_id, version, *vary, caller):
+        key = (name, game_id, version) + vary
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+
+        # rendered outside the lock; two requests racing on a new version
+        # both render and the second one's copy wins, which is harmless
+        html = Markup(caller())
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = html
+            # versions only go up, so old ones fall off the end on their own
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return html
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+fragments = FragmentCache()
@@ -0,0 +1,96 @@
+"""Shared fixtures.
+
+hello builds the app from the environment when it's first imported, so the
+settings the tests rely on are set here, before any test imports it: a
+throwaway SQLite database, no reaper thread, no load shedding and strict
+query budgets (a route going over its budget raises QueryBudgetExceeded).
+"""
+import itertools
+import os
+import re
+import sys
+import tempfile
+
+import pytest
+
+# the app is a flat set of modules at the top of the repo
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp = tempfile.mkdtemp(prefix='pantry-tests-')
+os.environ.update({
+    'DATABASE_URL': 'sqlite:///' + os.path.join(_tmp, 'test.db'),
+    'EVENT_DB': os.path.join(_tmp, 'events.db'),
+    'ARCHIVE_DIR': os.path.join(_tmp, 'archive'),
+    'REAPER_INTERVAL': '0',
+    'ADMISSION_CAPACITY': '0',
+    'QUERY_BUDGET_STRICT': '1',
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+})
+
+INGREDIENTS = ["Carrot", "Onions", "Spinach", "Potato", "Beans", "Broccoli", "Beef", "Chicken",
+               "Pork", "Ham", "Turkey", "Bacon", "Cheese", "Bread", "Tortilla", "Noodles"]
+
+_names = itertools.count()
+
+
+@pytest.fixture(scope='session')
+def app():
+    import hello
+    import migrations
+
+    hello.app.config['TESTING'] = True
+    with hello.app.app_context():
+        hello.db.create_all()
+        migrations.stamp(hello.db.engine)
+        hello.db.session.add_all(hello.Ingredients(name=n) for n in INGREDIENTS)
+        hello.db.session.commit()
+    return hello.app
+
+
+@pytest.fixture
+def users(app):
+    """Makes `n` users and returns their ids."""
+    import hello
+
+    def make(n):
+        names = [f"player{next(_names)}" for _ in range(n)]
+        with app.app_context():
+            hello.db.session.add_all(
+                hello.User(username=name, display_name=name, password_hash='-') for name in names
+            )
+            hello.db.session.commit()
+            return [hello.User.query.filter_by(username=name).one().id for name in names]
+    return make
+
+
+@pytest.fixture
+def players(app, users):
+    """`n` logged-in test clients, each with its `user_id`."""
+    def make(n):
+        clients = []
+        for user_id in users(n):
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['_user_id'] = str(user_id)
+                sess['_fresh'] = True
+            client.user_id = user_id
+            clients.append(client)
+        return clients
+    return make
+
+
+@pytest.fixture
+def started_game(players):
+    """A game of `n` players with its first round open for answers:
+    (game id, round id, clients), host first."""
+    def start(n=4):
+        clients = players(n)
+        resp = clients[0].get('/creategame')
+        game_id = int(re.search(r'/gamelobby/(\d+)', resp.location).group(1))
+        for client in clients[1:]:
+            assert '/gamelobby/' in client.get(f'/joingame/{game_id}').location
+        resp = clients[0].get(f'/startgame/{game_id}')
+        round_id = int(re.search(r'/game/\d+/(\d+)', resp.location).group(1))
+        return game_id, round_id, clients
+    return start
@@ -0,0 +1,75 @@
+"""Finished games read back from the archive the way they were played, from
+whichever segment they landed in."""
+import json
+
+from sqlalchemy import select, update
+
+DISHES = ["apple pie", "beef stew", "fish tacos", "green salad"]
+
+
+def finished_game(app, started_game):
+    # one round answered and voted on, then the game closed
+    import hello
+
+    game_id, round_id, clients = started_game(4)
+    for dish, client in zip(DISHES, clients):
+        client.post(f'/submitanswer/{game_id}/{round_id}', data={'answer': f"{dish} {game_id}"})
+    hello.store.flush()
+    with app.app_context():
+        ids = dict(hello.db.session.execute(
+            select(hello.Responses.user_id, hello.Responses.id).where(hello.Responses.round_id == round_id)
+        ).all())
+    for i, client in enumerate(clients):
+        target = ids[clients[(i + 1) % len(clients)].user_id]
+        client.post(f'/addvote/{game_id}/{round_id}/{target}')
+    hello.store.flush()
+    with app.app_context():
+        hello.db.session.execute(update(hello.Game).where(hello.Game.id == game_id).values(active=False))
+        hello.db.session.commit()
+    hello.store.drop(game_id)
+    return game_id, clients
+
+
+def test_games_round_trip_across_a_segment_boundary(app, started_game, monkeypatch):
+    import hello
+    from archive import archive
+
+    games = [finished_game(app, started_game) for _ in range(3)]
+    game_ids = [game_id for game_id, _ in games]
+    # a member per game, and a new segment for every store() after the first
+    monkeypatch.setattr(archive, 'block_games', 1)
+    monkeypatch.setattr(archive, 'segment_bytes', 1)
+    with app.app_context():
+        before = {r['id']: r for r in archive.records(game_ids)}
+        replays = {game_id: list(archive.replay(game_id)) for game_id in game_ids}
+        for batch in (game_ids[:2], game_ids[2:]):
+            assert archive.store(batch) == len(batch)
+            hello.reaper.delete_games(batch)
+
+        entries = {e.game_id: e for e in hello.db.session.execute(
+            select(hello.ArchivedGame).where(hello.ArchivedGame.game_id.in_(game_ids))
+        ).scalars()}
+        first, second, third = (entries[game_id] for game_id in game_ids)
+        assert first.segment == second.segment and third.segment == first.segment + 1
+        assert second.start == first.start + first.length
+
+        assert hello.db.session.get(hello.Game, game_ids[0]) is None
+        for game_id in game_ids:
+            assert archive.load(game_id) == before[game_id]
+            assert list(archive.replay(game_id)) == replays[game_id]
+        scanned = {r['id']: r for r in archive.scan() if r['id'] in before}
+        assert scanned == before
+
+    record = before[game_ids[2]]
+    (rnd,) = record['rounds']
+    assert sorted(text for _, _, text, _ in rnd['answers']) == sorted(f"{d} {game_ids[2]}" for d in DISHES)
+    assert len(rnd['votes']) == 4
+    assert sum(score for _, _, score in record['players']) == 4
+
+    # and over the API, from both segments
+    for game_id, clients in (games[0], games[2]):
+        resp = clients[0].get(f'/api/games/{game_id}/history')
+        assert resp.status_code == 200
+        events = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        # JSON turns the scores' user ids into strings
+        assert events == json.loads(json.dumps(replays[game_id]))
@@ -0,0 +1,73 @@
+"""Polled pages answer a matching If-None-Match with a 304 until the game's
+event sequence moves."""
+import contextlib
+import re
+
+from sqlalchemy import event
+
+
+@contextlib.contextmanager
+def counting(app):
+    import hello
+
+    statements = []
+
+    def count(*_):
+        statements.append(1)
+
+    with app.app_context():
+        engine = hello.db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+
+def test_lobby_304_until_someone_joins(app, players):
+    host, guest = players(2)
+    resp = host.get('/creategame')
+    game_id = int(re.search(r'/gamelobby/(\d+)', resp.location).group(1))
+    url = f'/gamelobby/{game_id}'
+
+    first = host.get(url)
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+    with counting(app) as statements:
+        again = host.get(url, headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.headers['ETag'] == etag
+    assert not again.get_data()
+    assert statements == []
+
+    guest.get(f'/joingame/{game_id}')
+    changed = host.get(url, headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_voting_wait_304_until_the_next_answer(app, started_game):
+    game_id, round_id, clients = started_game(4)
+    first, second = clients[:2]
+    first.post(f'/submitanswer/{game_id}/{round_id}', data={'answer': "apple pie"})
+    url = f'/votingwait/{game_id}/{round_id}'
+
+    resp = first.get(url)
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+    assert first.get(url, headers={'If-None-Match': etag}).status_code == 304
+
+    second.post(f'/submitanswer/{game_id}/{round_id}', data={'answer': "beef stew"})
+    resp = first.get(url, headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.headers['ETag'] != etag
+
+
+def test_etags_are_per_viewer(app, started_game):
+    game_id, round_id, clients = started_game(4)
+    url = f'/votingwait/{game_id}/{round_id}'
+    for client in clients[:2]:
+        client.post(f'/submitanswer/{game_id}/{round_id}', data={'answer': f"dish {client.user_id}"})
+    etag = clients[0].get(url).headers['ETag']
+    # the same version of the game, but someone else's page
+    assert clients[1].get(url, headers={'If-None-Match': etag}).status_code == 200
@@ -0,0 +1,122 @@
+"""The write-behind store: answers and votes are queued in memory, land in the
+database when the store flushes, and a game loaded back from the database is
+the game that was being played."""
+import contextlib
+
+from sqlalchemy import func, insert, select
+
+DISHES = ["apple pie", "beef stew", "fish tacos", "green salad"]
+
+
+@contextlib.contextmanager
+def writer_paused(app, game_id):
+    # the background writer flushes under this lock, so holding it keeps the
+    # queued ops queued; the submit and vote routes only flush when they
+    # load the game, so it's loaded first
+    import hello
+    with app.app_context():
+        hello.store.get(game_id)
+    with hello.store._flush_lock:
+        yield
+
+
+def saved(app, round_id):
+    import hello
+    with app.app_context():
+        session = hello.db.session
+        answers = dict(session.execute(
+            select(hello.Responses.user_id, hello.Responses.text).where(hello.Responses.round_id == round_id)
+        ).all())
+        votes = dict(session.execute(
+            select(hello.Vote.voter_id, hello.Vote.response_id).where(hello.Vote.round_id == round_id)
+        ).all())
+        phase = session.get(hello.GameRound, round_id).phase
+    return answers, votes, phase
+
+
+def play_round(game_id, round_id, clients):
+    import hello
+
+    for dish, client in zip(DISHES, clients):
+        client.post(f'/submitanswer/{game_id}/{round_id}', data={'answer': dish})
+    rnd = hello.store.get(game_id).round
+    by_user = {a.user_id: a.id for a in rnd.answer_list()}
+    for i, client in enumerate(clients):
+        target = by_user[clients[(i + 1) % len(clients)].user_id]
+        client.post(f'/addvote/{game_id}/{round_id}/{target}')
+
+
+def test_answers_and_votes_land_on_flush(app, started_game):
+    import hello
+
+    game_id, round_id, clients = started_game(4)
+    with writer_paused(app, game_id):
+        play_round(game_id, round_id, clients)
+        rnd = hello.store.get(game_id).round
+        assert rnd.phase == 'results' and len(rnd.answers) == 4 and len(rnd.votes) == 4
+        assert saved(app, round_id) == ({}, {}, 'submit')
+    hello.store.flush()
+
+    answers, votes, phase = saved(app, round_id)
+    assert answers == {c.user_id: dish for dish, c in zip(DISHES, clients)}
+    assert votes == rnd.votes
+    assert phase == 'results'
+    with app.app_context():
+        scores = hello.db.session.execute(
+            select(func.sum(hello.PlayerGame.score)).where(hello.PlayerGame.game_id == game_id)
+        ).scalar()
+    assert scores == 4
+
+
+def test_a_reloaded_game_matches_the_one_in_memory(app, started_game):
+    import hello
+
+    game_id, round_id, clients = started_game(4)
+    with writer_paused(app, game_id):
+        play_round(game_id, round_id, clients)
+        live = hello.store.get(game_id)
+        hello.store.drop(game_id)
+    # the reload flushes what's queued before reading it back
+    with app.app_context():
+        loaded = hello.store.get(game_id)
+    assert loaded is not live
+    assert loaded.round.id == live.round.id
+    assert loaded.round.phase == live.round.phase == 'results'
+    assert loaded.round.answer_list() == live.round.answer_list()
+    assert loaded.round.votes == live.round.votes
+    assert loaded.player_list() == live.player_list()
+
+
+def test_a_failed_flush_reloads_the_game(app, started_game):
+    import hello
+    from gamestate import normalize
+
+    game_id, round_id, clients = started_game(4)
+    first, second = clients[:2]
+    with writer_paused(app, game_id):
+        first.post(f'/submitanswer/{game_id}/{round_id}', data={'answer': "apple pie"})
+        (taken,) = hello.store.get(game_id).round.answers
+        # another worker inserts its own answer under that id first
+        with app.app_context():
+            hello.db.session.execute(insert(hello.Responses).values(
+                id=taken, round_id=round_id, user_id=second.user_id, text="beef stew",
+                text_norm=normalize("beef stew"), votes=0,
+            ))
+            hello.db.session.commit()
+    hello.store.flush()
+
+    # the game was dropped rather than left showing an answer that isn't saved
+    assert game_id not in hello.store._games
+    with app.app_context():
+        rnd = hello.store.get(game_id).round
+    assert [(a.id, a.user_id) for a in rnd.answer_list()] == [(taken, second.user_id)]
+
+    # and the next answer gets an id past the one that was taken
+    first.post(f'/submitanswer/{game_id}/{round_id}', data={'answer': "apple pie"})
+    hello.store.flush()
+    with app.app_context():
+        ids = dict(hello.db.session.execute(
+            select(hello.Responses.user_id, hello.Responses.id).where(hello.Responses.round_id == round_id)
+        ).all())
+    assert ids[second.user_id] == taken
+    assert ids[first.user_id] > taken
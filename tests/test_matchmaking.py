@@ -0,0 +1,210 @@
+"""Seat allocation and the shared quick match queue."""
+import re
+import threading
+import time
+from collections import Counter
+
+import pytest
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from matchmaking import SEATS, Matchmaker
+
+
+def open_game(app, players, n):
+    # a game in its lobby with the host and n - 1 others seated
+    clients = players(n)
+    resp = clients[0].get('/creategame')
+    game_id = int(re.search(r'/gamelobby/(\d+)', resp.location).group(1))
+    for client in clients[1:]:
+        client.get(f'/joingame/{game_id}')
+    return game_id, clients
+
+
+def seats(app, game_id):
+    import hello
+    with app.app_context():
+        return hello.db.session.execute(
+            select(hello.PlayerGame.seat).where(hello.PlayerGame.game_id == game_id)
+        ).scalars().all()
+
+
+def test_full_game_turns_the_fifth_player_away(app, players, users):
+    import hello
+
+    game_id, _ = open_game(app, players, SEATS)
+    assert sorted(seats(app, game_id)) == list(range(SEATS))
+    (fifth,) = users(1)
+    with app.app_context():
+        assert hello.matchmaker.take_seat(game_id, fifth) is False
+    late = players(1)[0]
+    assert '/dashboard' in late.get(f'/joingame/{game_id}').location
+    assert len(seats(app, game_id)) == SEATS
+
+
+def test_concurrent_joins_never_share_a_seat(app, players, users):
+    import hello
+
+    game_id, _ = open_game(app, players, 1)
+    joiners = users(8)
+    barrier = threading.Barrier(len(joiners))
+    seated = []
+
+    def join(user_id):
+        with app.app_context():
+            barrier.wait()
+            seated.append(hello.matchmaker.take_seat(game_id, user_id))
+
+    threads = [threading.Thread(target=join, args=(uid,)) for uid in joiners]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert seated.count(True) == SEATS - 1
+    assert sorted(seats(app, game_id)) == list(range(SEATS))
+
+
+def test_take_seat_retries_a_seat_collision(app, players, users, monkeypatch):
+    import hello
+
+    game_id, _ = open_game(app, players, 1)
+    (user_id,) = users(1)
+    with app.app_context():
+        session = hello.db.session
+        execute = session.execute
+        calls = []
+
+        def collide_once(*args, **kwargs):
+            # as if another worker's join had just taken the seat
+            calls.append(1)
+            if len(calls) == 1:
+                raise IntegrityError("INSERT", {}, Exception("UNIQUE constraint failed"))
+            return execute(*args, **kwargs)
+
+        monkeypatch.setattr(session, 'execute', collide_once)
+        assert hello.matchmaker.take_seat(game_id, user_id) is True
+    assert len(calls) == 2
+    assert sorted(seats(app, game_id)) == [0, 1]
+
+
+@pytest.fixture
+def shared(app):
+    """A database-backed matchmaker against an empty match_queue, without its
+    polling thread; tests run its passes themselves."""
+    import hello
+
+    def make():
+        mm = Matchmaker()
+        mm.init_app(app, hello.db, Game=hello.Game, PlayerGame=hello.PlayerGame, MatchQueue=hello.MatchQueue)
+        mm.max_wait = 60
+        mm.shared = True
+        mm._ensure_started = lambda: None
+        return mm
+
+    with app.app_context():
+        hello.db.session.execute(delete(hello.MatchQueue))
+        hello.db.session.commit()
+    return make
+
+
+def queue(app, user_ids, waited=0):
+    import hello
+    with app.app_context():
+        now = time.time()
+        hello.db.session.execute(insert(hello.MatchQueue), [
+            {'user_id': uid, 'joined_at': now - waited + i / 1000} for i, uid in enumerate(user_ids)
+        ])
+        hello.db.session.commit()
+
+
+def test_shared_queue_join_status_and_leave(app, users, shared):
+    mm = shared()
+    ids = users(SEATS + 1)
+    with app.app_context():
+        for uid in ids:
+            mm.join(uid)
+        mm.join(ids[0])
+        assert mm.status(ids[0]) is True
+        mm.leave(ids[-1])
+        assert mm.status(ids[-1]) is None
+        mm._match_shared()
+        game_id = mm.status(ids[0])
+        assert isinstance(game_id, int) and game_id is not True
+        # handed out once
+        assert mm.status(ids[0]) is None
+        assert all(mm.status(uid) == game_id for uid in ids[1:SEATS])
+
+
+def test_two_shared_matchers_never_seat_a_player_twice(app, users, shared):
+    import hello
+
+    matchers = [shared(), shared()]
+    ids = users(10 * SEATS)
+    queue(app, ids)
+    barrier = threading.Barrier(len(matchers))
+
+    def run(mm):
+        barrier.wait()
+        for _ in range(20):
+            with app.app_context():
+                mm._match_shared()
+
+    threads = [threading.Thread(target=run, args=(mm,)) for mm in matchers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with app.app_context():
+        session = hello.db.session
+        placed = Counter(session.execute(
+            select(hello.PlayerGame.user_id).where(hello.PlayerGame.user_id.in_(ids))
+        ).scalars())
+        sizes = session.execute(
+            select(func.count()).select_from(hello.PlayerGame)
+            .where(hello.PlayerGame.user_id.in_(ids)).group_by(hello.PlayerGame.game_id)
+        ).scalars().all()
+        claimed = dict(session.execute(
+            select(hello.MatchQueue.user_id, hello.MatchQueue.game_id).where(hello.MatchQueue.user_id.in_(ids))
+        ).all())
+    assert set(placed) == set(ids) and set(placed.values()) == {1}
+    assert sorted(sizes) == [SEATS] * 10
+    assert sum(m.players for m in matchers) == len(ids)
+    assert None not in claimed.values()
+
+
+def test_shared_matcher_backs_off_when_another_claimed_first(app, users, shared, monkeypatch):
+    import hello
+    from codes import codes
+
+    mm = shared()
+    ids = users(SEATS)
+    queue(app, ids)
+    with app.app_context():
+        games_before = hello.db.session.execute(select(func.count()).select_from(hello.Game)).scalar()
+    seat = mm._seat
+    drawn = []
+
+    def seat_then_lose_one(session, groups):
+        game_ids, games = seat(session, groups)
+        drawn.extend(game['code'] for game in games)
+        # another worker's matcher seats one of them before the claim
+        session.execute(
+            hello.MatchQueue.__table__.update()
+            .where(hello.MatchQueue.user_id == ids[0]).values(game_id=-1)
+        )
+        return game_ids, games
+
+    monkeypatch.setattr(mm, '_seat', seat_then_lose_one)
+    with app.app_context():
+        mm._match_shared()
+        session = hello.db.session
+        games_after = session.execute(select(func.count()).select_from(hello.Game)).scalar()
+        waiting = session.execute(
+            select(func.count()).select_from(hello.MatchQueue).where(hello.MatchQueue.game_id.is_(None))
+        ).scalar()
+    # the whole pass was rolled back and its join codes handed back
+    assert games_after == games_before
+    assert waiting == SEATS
+    assert mm.games == 0
+    assert drawn and not set(drawn) & (codes._live or set())
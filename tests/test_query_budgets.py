@@ -0,0 +1,150 @@
+"""Every route stays within its @query_budget.
+
+QUERY_BUDGET_STRICT is on for the tests (see conftest.py), so a request that
+runs more statements than its budget raises QueryBudgetExceeded out of the
+test client. The game is played warm (from the in-memory store) and cold
+(the game and the user reloaded before every request), which is what the
+budgets are sized for.
+"""
+import re
+
+import pytest
+
+DISHES = ["apple pie", "beef stew", "fish tacos", "green salad"]
+
+
+def ok(resp):
+    assert resp.status_code < 500, resp.status_code
+    return resp
+
+
+def links(resp, pattern):
+    return [int(x) for x in re.findall(pattern, resp.get_data(as_text=True))]
+
+
+def test_signup_login_and_dashboard(app):
+    client = app.test_client()
+    ok(client.get('/'))
+    ok(client.get('/signup'))
+    resp = ok(client.post('/signup', data={'username': 'budget', 'password': 'pw', 'display_name': 'Budget'}))
+    assert '/login' in resp.location
+    ok(client.get('/login'))
+    resp = ok(client.post('/login', data={'username': 'budget', 'password': 'pw'}))
+    assert '/dashboard' in resp.location
+    ok(client.get('/dashboard'))
+    ok(client.get('/logout'))
+
+
+@pytest.mark.parametrize('cold', [False, True], ids=['warm', 'cold'])
+def test_game_flow(app, players, cold):
+    import hello
+
+    clients = players(4)
+    outsider = players(1)[0]
+    game_id = None
+
+    def get(client, url, **kwargs):
+        if cold and game_id is not None:
+            hello.store.drop(game_id)
+            hello.user_cache.invalidate(client.user_id)
+        return ok(client.get(url, **kwargs))
+
+    def post(client, url, data=None):
+        if cold and game_id is not None:
+            hello.store.drop(game_id)
+            hello.user_cache.invalidate(client.user_id)
+        return ok(client.post(url, data=data or {}))
+
+    host = clients[0]
+    resp = get(host, '/creategame')
+    game_id = int(re.search(r'/gamelobby/(\d+)', resp.location).group(1))
+    with app.app_context():
+        code = hello.db.session.get(hello.Game, game_id).code
+    resp = post(clients[1], '/joingame', {'game_code': code})
+    assert resp.location.endswith(f'/joingame/{game_id}')
+    for client in clients[1:]:
+        assert '/gamelobby/' in get(client, f'/joingame/{game_id}').location
+        get(client, f'/gamelobby/{game_id}')
+    # the lobby's polled reload, and its 304
+    resp = get(host, f'/gamelobby/{game_id}')
+    get(host, f'/gamelobby/{game_id}', headers={'If-None-Match': resp.headers['ETag']})
+    get(outsider, f'/events/{game_id}')
+
+    resp = get(host, f'/startgame/{game_id}')
+    round_id = int(re.search(r'/game/\d+/(\d+)', resp.location).group(1))
+    for number in range(3):
+        for i, client in enumerate(clients):
+            get(client, f'/game/{game_id}/{round_id}')
+            post(client, f'/submitanswer/{game_id}/{round_id}', {'answer': f"{DISHES[i]} {number}"})
+            resp = get(client, f'/votingwait/{game_id}/{round_id}')
+            if resp.status_code == 200:
+                get(client, f'/votingwait/{game_id}/{round_id}',
+                    headers={'If-None-Match': resp.headers['ETag']})
+
+        for client in clients:
+            page = get(client, f'/voting/{game_id}/{round_id}')
+            # the first answer that isn't their own
+            response_id = links(page, rf'/addvote/{game_id}/{round_id}/(\d+)')[0]
+            post(client, f'/addvote/{game_id}/{round_id}/{response_id}')
+            get(client, f'/votingwait_votes/{game_id}/{round_id}')
+
+        for client in clients:
+            resp = get(client, f'/endround/{game_id}/{round_id}')
+            if number < 2:
+                get(client, f'/roundresults/{game_id}/{round_id}')
+        if number < 2:
+            next_ids = set()
+            for client in clients:
+                resp = get(client, f'/continue/{game_id}/{round_id}')
+                next_ids.add(int(re.search(r'/game/\d+/(\d+)', resp.location).group(1)))
+            assert len(next_ids) == 1
+            get(host, f'/waitround/{game_id}')
+            round_id = next_ids.pop()
+
+    for client in clients:
+        assert get(client, f'/winner/{game_id}').status_code == 200
+    get(host, '/leaderboard')
+    get(host, '/leaderboard?page=2')
+    get(host, '/api/leaderboard')
+    hello.store.flush()
+    assert get(host, f'/api/games/{game_id}/history').status_code == 200
+
+    # and once it's been archived
+    with app.app_context():
+        hello.archive.store([game_id])
+        hello.reaper.delete_games([game_id])
+    assert get(host, f'/api/games/{game_id}/history').status_code == 200
+    assert get(host, '/api/games/999999/history').status_code == 404
+
+
+def test_lobby_management(app, players):
+    host, guest, kicked = players(3)
+    resp = ok(host.get('/creategame'))
+    game_id = int(re.search(r'/gamelobby/(\d+)', resp.location).group(1))
+    for client in (guest, kicked):
+        ok(client.get(f'/joingame/{game_id}'))
+    ok(guest.get(f'/kickplayer/{game_id}/{kicked.user_id}'))
+    ok(host.get(f'/kickplayer/{game_id}/{kicked.user_id}'))
+    ok(guest.get(f'/leavegame/{game_id}'))
+    ok(host.get(f'/leavegame/{game_id}'))
+
+
+def test_quickmatch_pages(app, players):
+    (client,) = players(1)
+    assert '/quickmatch' in ok(client.post('/quickmatch')).location
+    assert ok(client.get('/quickmatch')).status_code == 200
+    ok(client.post('/quickmatch/cancel'))
+    assert '/dashboard' in ok(client.get('/quickmatch')).location
+
+
+@pytest.mark.parametrize('url', [
+    '/admin/', '/admin/user/', '/admin/ingredients/', '/admin/playergame/', '/admin/gameround/',
+    '/admin/responses/', '/admin/responses/?page=1000', '/admin/livegames/',
+    '/admin/responses/ajax/lookup/?name=user&query=player',
+    '/admin/responses/ajax/lookup/?name=round&query=1',
+    '/metrics',
+])
+def test_admin_and_metrics(app, started_game, url):
+    # something to list
+    started_game(4)
+    assert ok(app.test_client().get(url)).status_code == 200
@@ -0,0 +1,39 @@
+import pytest
+
+from gamestate import normalize
+from similarity import NgramIndex
+
+
+def match(first, second, threshold=0.9):
+    index = NgramIndex(threshold)
+    index.add(1, normalize(first))
+    return index.match(normalize(second))
+
+
+@pytest.mark.parametrize('first, second', [
+    ("chicken noodle soup", "chicken noodle stew"),
+    ("ham sandwich", "jam sandwich"),
+    ("tomato soup", "potato soup"),
+    ("fried rice", "fried rice bowl"),
+    ("pasta bake", "pasta cake"),
+    ("dish 3 0 1", "dish 3 0 2"),
+    ("dish 123 2 1", "dish 123 2 3"),
+])
+def test_different_dishes_are_let_in(first, second):
+    assert match(first, second) is None
+
+
+@pytest.mark.parametrize('first, second', [
+    ("tacos", "taco"),
+    ("fish tacos", "Fish Taco"),
+    ("spaghetti", "spagetti"),
+    ("spaghetti bolognese", "spagetti bolognese"),
+    ("grilled cheese", "griled cheese"),
+    ("cherries jubilee", "cherry jubilee"),
+])
+def test_plurals_and_typos_are_duplicates(first, second):
+    assert match(first, second) == 1
+
+
+def test_zero_threshold_turns_the_check_off():
+    assert match("spaghetti", "spagetti", threshold=0) is None
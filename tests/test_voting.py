@@ -0,0 +1,149 @@
+"""One vote per player per round, never for their own answer, and a round
+that advances exactly once however many players ask at the same time."""
+import re
+import threading
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+DISHES = ["apple pie", "beef stew", "fish tacos", "green salad"]
+
+
+def submit_all(game_id, round_id, clients):
+    for dish, client in zip(DISHES, clients):
+        client.post(f'/submitanswer/{game_id}/{round_id}', data={'answer': dish})
+
+
+def answers(app, round_id):
+    # user id -> response id, once the queued answers are in
+    import hello
+    hello.store.flush()
+    with app.app_context():
+        return dict(hello.db.session.execute(
+            select(hello.Responses.user_id, hello.Responses.id).where(hello.Responses.round_id == round_id)
+        ).all())
+
+
+def votes_by(app, round_id, voter_id):
+    import hello
+    hello.store.flush()
+    with app.app_context():
+        return hello.db.session.execute(
+            select(hello.Vote.response_id).where(hello.Vote.round_id == round_id, hello.Vote.voter_id == voter_id)
+        ).scalars().all()
+
+
+def test_second_vote_is_turned_away(app, started_game):
+    game_id, round_id, clients = started_game(4)
+    submit_all(game_id, round_id, clients)
+    ids = answers(app, round_id)
+    voter = clients[0]
+    first, second = ids[clients[1].user_id], ids[clients[2].user_id]
+
+    assert '/votingwait_votes/' in voter.post(f'/addvote/{game_id}/{round_id}/{first}').location
+    resp = voter.post(f'/addvote/{game_id}/{round_id}/{second}')
+    assert '/votingwait_votes/' in resp.location
+    assert votes_by(app, round_id, voter.user_id) == [first]
+
+
+def test_concurrent_votes_from_one_player_count_once(app, started_game):
+    game_id, round_id, clients = started_game(4)
+    submit_all(game_id, round_id, clients)
+    ids = answers(app, round_id)
+    voter = clients[0]
+    targets = [ids[c.user_id] for c in clients[1:]]
+    barrier = threading.Barrier(len(targets))
+
+    def vote(response_id):
+        barrier.wait()
+        voter.post(f'/addvote/{game_id}/{round_id}/{response_id}')
+
+    threads = [threading.Thread(target=vote, args=(t,)) for t in targets]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(votes_by(app, round_id, voter.user_id)) == 1
+
+
+def test_vote_for_own_answer_is_turned_away(app, started_game):
+    game_id, round_id, clients = started_game(4)
+    submit_all(game_id, round_id, clients)
+    voter = clients[0]
+    own = answers(app, round_id)[voter.user_id]
+
+    resp = voter.post(f'/addvote/{game_id}/{round_id}/{own}')
+    assert resp.location.endswith(f'/voting/{game_id}/{round_id}')
+    assert votes_by(app, round_id, voter.user_id) == []
+    # and the voting page doesn't offer it
+    page = voter.get(f'/voting/{game_id}/{round_id}').get_data(as_text=True)
+    assert f'/addvote/{game_id}/{round_id}/{own}' not in page
+
+
+def test_record_vote_rejects_duplicates_and_own_answers(app, started_game):
+    import hello
+    from gamestate import record_vote
+
+    game_id, round_id, clients = started_game(4)
+    submit_all(game_id, round_id, clients)
+    ids = answers(app, round_id)
+    voter, other = clients[0].user_id, clients[1].user_id
+    m = hello.store.m
+    with app.app_context():
+        session = hello.db.session
+        assert record_vote(session, m, game_id, round_id, voter, ids[voter]) is False
+        assert record_vote(session, m, game_id, round_id, voter, ids[other]) is True
+        session.commit()
+        with pytest.raises(IntegrityError):
+            record_vote(session, m, game_id, round_id, voter, ids[clients[2].user_id])
+        session.rollback()
+        assert session.execute(
+            select(hello.Responses.votes).where(hello.Responses.id == ids[other])
+        ).scalar() == 1
+
+
+def test_racing_advances_start_one_round(app, started_game):
+    import hello
+
+    game_id, round_id, clients = started_game(4)
+    submit_all(game_id, round_id, clients)
+    ids = answers(app, round_id)
+    for i, client in enumerate(clients):
+        target = ids[clients[(i + 1) % len(clients)].user_id]
+        client.post(f'/addvote/{game_id}/{round_id}/{target}')
+    hello.store.flush()
+
+    # each caller has its own copy of the game, as two workers would
+    copies = []
+    with app.app_context():
+        for _ in range(4):
+            copies.append(hello.store._load(game_id))
+    assert all(c.round.phase == 'results' for c in copies)
+    barrier = threading.Barrier(len(copies))
+    results = []
+
+    def advance(game):
+        with app.test_request_context():
+            barrier.wait()
+            results.append(hello.advance_round(game, round_id))
+
+    threads = [threading.Thread(target=advance, args=(c,)) for c in copies]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with app.app_context():
+        rounds = hello.db.session.execute(
+            select(func.count()).select_from(hello.GameRound).where(hello.GameRound.game_id == game_id)
+        ).scalar()
+        round_num = hello.db.session.get(hello.Game, game_id).round_num
+    assert rounds == 2
+    assert round_num == 2
+    assert len(results) == len(copies) and len(set(results)) == 1 and results[0] > round_id
+
+    # and through the route, everyone lands in that round
+    for client in clients:
+        resp = client.get(f'/continue/{game_id}/{round_id}')
+        assert int(re.search(r'/game/\d+/(\d+)', resp.location).group(1)) == results[0]